@@ -13,6 +13,7 @@ Agent Classes and Functions for the multigrid ABM
 3. calc_mean_gap: Mean gap (multi-preference)
 4. find_cands_min: Candidate list, minimum gap (single preference) 
 5. find_cands_min_mean: Candidate list, minimum mean gap (multi-preference)
+5.1 find_best_cities: Minimum mean gap and candidate list in one pass over a window (multi-preference)
 
 ####### City Functions
 6. get_prefs: Extract resident preferences from resident neighbors
@@ -21,60 +22,156 @@ Agent Classes and Functions for the multigrid ABM
 9. calc_mode_prefs: (multi-preference) Find mode preferences over neighboring residents
 10. calc_mean_prefs_weighted (multi-preference) Calculate mean preferences over neighboring residents weighted to 
     favor residents with more resources
+11. calc_mean_prefs_from_sums (multi-preference) Weighted mean preferences from the model's running per-cell sums
+12. aggregate_prefs: (multi-preference) Any aggregation kernel over one city's neighboring residents
 
+####### Storage
+13. compact_prefs: Preferences as one contiguous array in the smallest integer type that holds them
+
+Residents and cities keep no arrays of their own: a resident's preferences are a row of the model's
+resident_preferences array and a city's spending a row of the model's city_spending array (views, no copies),
+so bulk analysis reads the model arrays directly. Both classes use __slots__; mesa's Agent has none, so
+instances still have a __dict__, but nothing is put in it.
 '''
 #############################################################
 # 0 Required Packages
 from mesa import Agent
 import random
 import numpy as np
-from scipy import stats as st #for mode function
+from Aggregation import get_aggregator  # batched aggregation kernels (mean, weighted mean, median, mode, trimmed mean)
 
 ##### 1
 #1.1 Resident Class
 class Resident(Agent):
-    def __init__(self, id, model, preferences, resources):  # unique id, model, preferences, *resources*
+    __slots__ = ('unique_id', 'model', 'pos', 'row', 'resources', 'current_city', 'next_city', 'current_gap')
+
+    # row: the resident's row of model.resident_preferences, None for its id
+    # preferences: copied into the model's row, None if the row already holds them (models made in bulk)
+    def __init__(self, id, model, preferences, resources, row=None):  # unique id, model, preferences, *resources*
         super().__init__(id, model)  # super lets you take args from other classes, in this case model
-        self.preferences = preferences #assign preference values, store as array?
+        self.row = id if row is None else row
+        if preferences is not None:
+            self.preferences = preferences  # copied into the model's row
         self.resources = resources
         self.current_city = None #need to start w/ city at current position
+        self.next_city = None  # city picked to move to, between decide and advance
+        self.current_gap = None  # gap to the current city, as of the last decide
+
+    @property
+    def preferences(self):  # view of the resident's row of the model's preference array
+        return self.model.resident_preferences[self.row]
+
+    @preferences.setter
+    def preferences(self, preferences):
+        self.model.resident_preferences[self.row] = preferences
 
     '''Make interior of step code vary based on value passed in initialization. I.e. customize behavior of agent class'''
-    def step(self):
-        ''' turn this into a setup function?'''
-        mean_gaps = []  # initialize list of overall gaps b/t pref and cities' spending
-        #neighboring cities to iterate over
+    def step(self):  # decide and move straight away (sequential activation)
+        self.decide()
+        self.advance()
+
+    def decide(self):  # pick a city to move to (or none), from the cities' current spending, without moving yet
+        self.next_city = None
+        # neighboring cities to iterate over, from the model's tables of torus windows (one per radius)
         # agents with more resources iterate over (look at) more cities
-        for neighbor in self.model.grid.iter_neighbors(self.pos, moore=True, include_center=True, radius=self.resources):
-            if isinstance(neighbor, City) and neighbor.pos == self.pos:  # calculate metric for current city
-                current_gap = calc_mean_gap(self, neighbor)  # currently calculating mean gap
-            if isinstance(neighbor, City):  # calculate metrics for all other neighboring cities
-                mean_gaps.append(calc_mean_gap(self, neighbor))  # currently calculating mean gap
-        self.model.gap += current_gap  # add current gap to model level tally
-        min_gap = min(mean_gaps)  # find smallest spending gap
+        # with the city index (wide windows, search='index') only the Moore neighborhood is scanned, the index finds
+        # the smallest gap in the rest of the window
+        index = self.model.get_city_index(self.resources)
+        x_table, y_table, near, center = self.model.get_window_tables(self.resources if index is None else 1)
+        x, y = self.pos
+        cells = (x_table[x][:, None] + y_table[y]).ravel()  # flat index of every city in the window, in mesa's order
+        spending = self.model.city_spending[cells]  # one row per city
+        mean_gaps = np.mean(abs(spending - self.preferences), axis=1)  # mean gap to every city (as calc_mean_gap)
+        current_gap = mean_gaps[center]  # gap to the current city
+        if self.model.occupancy_changed is not None:  # active-set scheduling keeps running totals over every resident
+            self.model.replace_gap(self.current_gap, current_gap)
+        else:
+            self.model.gap += current_gap  # add current gap to model level tally
+            if self.model.summary is not None:
+                self.model.summary.add_gap(current_gap)  # add current gap to the step's gap distribution
+        self.current_gap = current_gap
+        evaluations = len(cells)
+        min_gap = None
+        if index is not None:  # smallest gap in the whole window, starting from the best neighbor
+            min_gap, opened = index.window_min(x, y, self.resources, self.preferences, mean_gaps.min())
+            evaluations += opened
+        min_gap, candidates = find_best_cities(mean_gaps, cells, near, min_gap)  # find smallest spending gap and the cities next door that have it
+        if self.model.profiler is not None:  # cities looked at, gaps computed and candidates found
+            self.model.profiler.count('neighbor_visits', evaluations)
+            self.model.profiler.count('gap_evaluations', evaluations)
+            self.model.profiler.count('candidates', len(candidates))
         if min_gap < current_gap:  # if there's a city with a smaller overall gap than the current one...
-            candidates = find_cands_min_mean(self, min_gap)
             if candidates:  # if there are cities with closer spending, move to one
-                new_city = random.choice(candidates)
-                self.model.grid.move_agent(self, new_city.pos)
-                self.current_city = new_city
+                self.next_city = self.model.cities[random.choice(candidates)]
+
+    def advance(self):  # move to the city picked in decide, if any
+        if self.next_city is not None:
+            self.model.move_resident(self, self.next_city.pos)  # moves on the grid and updates the model's per-cell sums
+            self.current_city = self.next_city
+            self.next_city = None
 
 # 1.2 City Class
 class City(Agent):
-    def __init__(self, id, model, spending_levels):  # id, model, spending level
+    __slots__ = ('unique_id', 'model', 'pos', 'row', 'aggregation', 'neighborhood', 'next_spending_levels')
+
+    # aggregation: how the city turns its neighbors' preferences into spending, a name from Aggregation.AGGREGATORS
+    #   or a kernel, None for the model's
+    # row: the city's row of model.city_spending, None for the next city's (cities are made in cell order)
+    # spending_levels: copied into the model's row, None if the row already holds them (models made in bulk)
+    def __init__(self, id, model, spending_levels, aggregation=None, row=None):  # id, model, spending level
         super().__init__(id, model)
-        self.spending_levels = spending_levels
+        self.row = len(model.cities) if row is None else row
+        if spending_levels is not None:
+            self.spending_levels = spending_levels  # copied into the model's row
+        self.aggregation = model.aggregation if aggregation is None else aggregation
+        self.neighborhood = None  # x and y index arrays of the cells around the city, set on first step
+        self.next_spending_levels = None  # spending worked out in decide, set in advance
+
+    @property
+    def spending_levels(self):  # view of the city's row of the model's spending array
+        return self.model.city_spending[self.row]
+
+    @spending_levels.setter
+    def spending_levels(self, spending_levels):
+        self.model.city_spending[self.row] = spending_levels
+        self.model.spending_version += 1  # so the city index knows it's stale
 
     '''Make interior of step code vary based on value passed in initialization. I.e. customize behavior of agent class'''
     def step(self):  # City looks at residents in and around it and adjusts spending to match mean preference, if there are residents
-        resident_preferences = [] # initialize list to hold preferences, convert to array later
-        for neighbor in self.model.grid.iter_neighbors(self.pos, moore = True, include_center=True):  # find preferences of all neighboring residents
-            if isinstance(neighbor, Resident):  # check if neighbor is a Resident
-                resident_preferences.append(neighbor.preferences)  # append preferences to list
-        if resident_preferences:  # if resident preferences list isn't empty (i.e. there's at least 1 neighboring resident)
-            num_prefs = np.size(resident_preferences[0])  # Get the number of preferences in each preference array
-            self.spending_levels = calc_mean_prefs_weighted(resident_preferences, num_prefs)  # calc 'optimal' preferences over all residents and set spending levels equal to it
-        self.model.spending_levels.append(self.spending_levels)  # add spending to model level array of spending levels
+        self.decide()
+        self.advance()
+
+    def decide(self):  # work out new spending from the residents around the city, without changing it yet
+        self.next_spending_levels = self.spending_levels
+        if self.neighborhood is None:  # cities don't move, so the neighborhood only has to be looked up once
+            cells = self.model.grid.get_neighborhood(self.pos, moore=True, include_center=True)
+            self.neighborhood = tuple(np.array(cells).T)
+        # add up the model's running sums over the neighboring cells instead of visiting every neighboring resident
+        count = self.model.cell_counts[self.neighborhood].sum()
+        if self.model.profiler is not None:
+            self.model.profiler.count('neighbor_visits', len(self.neighborhood[0]))  # cells summed over
+        if count == 0:  # no neighboring residents, spending stays
+            return
+        if self.aggregation == 'mean':  # means only need the sums
+            self.next_spending_levels = self.model.cell_prefs[self.neighborhood].sum(axis=0) / count
+        elif self.aggregation != 'weighted_mean':  # other kernels need every neighbor's preferences, done for all cities at once
+            aggregated, _ = self.model.get_neighborhood_aggregates(self.aggregation)
+            self.next_spending_levels = aggregated[self.pos[0] * self.model.height + self.pos[1]]
+        else:
+            # calc 'optimal' preferences over all residents and set spending levels equal to it
+            self.next_spending_levels = calc_mean_prefs_from_sums(self.model.cell_weighted_prefs[self.neighborhood].sum(axis=0),
+                                                                  self.model.cell_resources[self.neighborhood].sum(),
+                                                                  self.model.cell_prefs[self.neighborhood].sum(axis=0),
+                                                                  count)
+
+    def advance(self):  # set spending to what was worked out in decide
+        # (next_spending_levels may be a view of the current spending, so compare before writing it over)
+        if self.model.spending_changed is not None and not np.array_equal(self.next_spending_levels, self.spending_levels):
+            self.model.spending_changed[self.pos] = True  # tell residents that look here (active-set scheduling)
+        self.spending_levels = self.next_spending_levels
+        # add spending to the step's running mean and variance (active-set scheduling adds every city's at once)
+        if self.model.summary is not None and self.model.occupancy_changed is None:
+            self.model.summary.add_spending(self.spending_levels)
 
 
 ############################################################################### Resident Functions
@@ -101,37 +198,63 @@ def find_cands_min_mean(self, min_gap):  # creates a list of candidates from nei
             if isinstance(neighbor, City) and np.mean(abs(neighbor.spending_levels - self.preferences)) == min_gap]
 
 
+##### 5.1 find_best_cities: Minimum mean gap and candidate list in one pass over a window (multi-preference)
+# min_gap: smallest gap in a wider window, if found elsewhere (CityIndex.window_min), None for the smallest in this one
+def find_best_cities(mean_gaps, cells, near, min_gap=None):  # gaps and flat cell indices of a window, positions of the Moore neighborhood in it
+    if min_gap is None:
+        min_gap = mean_gaps.min()  # smallest gap anywhere in the window
+    # candidates are the neighboring cities with that gap (same as find_cands_min_mean, without scanning the grid again)
+    return min_gap, [cells[i] for i in near if mean_gaps[i] == min_gap]
+
+
 ############################################################################### City functions
 # 6. get_prefs: Extract resident preferences from resident neighbors (no need for dedicated function yet)
 def get_prefs(neighbor):
     return neighbor.preferences
 
 # 7. calc_mean_prefs: (multi-preference) Calculate mean preferences over neighboring residents
+#       (the calc_*_prefs functions run a kernel from Aggregation.py on the residents as a single group)
 def calc_mean_prefs (resident_preferences, num_prefs):
-    spending_levels = [None] * num_prefs  # create empty list to fill with mean preferences
-    for i in range(0, num_prefs):
-        ithelements = [arr[i] for arr in resident_preferences]  # get ith element of each array
-        spending_levels[i] = np.mean(ithelements)  # take mean of ith elements of the arrays
-    return spending_levels
+    return aggregate_prefs('mean', resident_preferences, num_prefs)
 
 # 8. calc_mean_pref: (single preference) Calculate mean preference over neighboring residents (just repackages np.mean)
 def calc_mean_pref (resident_preferences):
     return np.mean(resident_preferences)
 
-# 9. calc_mode_pref: (multi-preference) Find mode preferences over neighboring residents
+# 9. calc_mode_pref: (multi-preference) Find mode preferences over neighboring residents (integer preferences)
 def calc_mode_prefs (resident_preferences, num_prefs):
-    spending_levels = [None] * num_prefs  # create empty list to fill with mode preferences
-    for i in range(0, num_prefs):
-        ithelements = [arr[i] for arr in resident_preferences]  # get ith element(list of prefs) of each array
-        spending_levels[i] = st.mode(ithelements)  # take mode of ith elements of the arrays
-    return spending_levels
+    return aggregate_prefs('mode', resident_preferences, num_prefs)
 
 # 10. calc_mean_prefs_weighted (multi-preference) Calculate mean preferences over neighboring residents weighted
 #       to favor residents with more resources
+#       (falls back to the unweighted mean if nobody has resources)
 def calc_mean_prefs_weighted (resident_preferences, num_prefs, resident_resources):
-    spending_levels = [None] * num_prefs # create empty list to fill with weighted mean preferences
-    for i in range(0, num_prefs):
-        ithprefs = [arr[i] for arr in resident_preferences]  # get ith element of each preference array
-        resources = [resident_resources]
-        spending_levels[i] = np.average([ithprefs], weights=[resources])  # take mean of ith elements of the arrays, weighted by resources
-    return spending_levels
\ No newline at end of file
+    return aggregate_prefs('weighted_mean', resident_preferences, num_prefs, resident_resources)
+
+# 11. calc_mean_prefs_from_sums (multi-preference) Weighted mean preferences from the model's running per-cell sums
+#       (summed resource-weighted preferences, resources, preferences and resident count), same result as calc_mean_prefs_weighted
+def calc_mean_prefs_from_sums (weighted_prefs, resources, prefs, count):
+    if resources == 0:  # no resources to weight by, fall back to the unweighted mean
+        return prefs / count
+    return weighted_prefs / resources
+
+# 12. aggregate_prefs: (multi-preference) Any aggregation kernel (name or function, see Aggregation.py) over one city's
+#       neighboring residents, stacked into one (residents, P) array
+def aggregate_prefs (aggregation, resident_preferences, num_prefs, resident_resources=None):
+    values = np.asarray(resident_preferences).reshape(-1, num_prefs)
+    weights = np.ones(len(values)) if resident_resources is None else np.asarray(resident_resources, dtype=float)
+    return get_aggregator(aggregation)(values, weights, np.zeros(len(values), dtype=np.intp), 1)[0]
+
+
+############################################################################### Storage
+# 13. compact_prefs: Preferences as one contiguous (residents, P) array, integer preferences (e.g. 1-20) in the
+#       smallest signed integer type that holds them (int8 for 1-20), anything else as given
+def compact_prefs (resident_preferences):
+    preferences = np.ascontiguousarray(resident_preferences)
+    if not np.issubdtype(preferences.dtype, np.integer):
+        return preferences
+    low, high = (preferences.min(), preferences.max()) if preferences.size else (0, 0)
+    for dtype in (np.int8, np.int16, np.int32, np.int64):
+        if np.iinfo(dtype).min <= low and high <= np.iinfo(dtype).max:
+            return preferences.astype(dtype)
+    return preferences
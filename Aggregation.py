@@ -0,0 +1,126 @@
+'''
+Preference aggregation kernels: how a city turns its residents' preferences into spending
+'''
+################### Table of Contents ######################
+'''
+0. Required packages
+1. group_counts: Rows in each group
+2. sort_within_groups: Rows ordered by group, each column sorted within its group
+3. Kernels
+    3.1 group_mean: Mean preferences
+    3.2 group_weighted_mean: Mean preferences weighted by resources (plain mean where a group has no resources)
+    3.3 group_median: Median preferences
+    3.4 group_mode: Most common preferences (integer preferences, smallest value on ties, like scipy.stats.mode)
+    3.5 group_trimmed_mean: Mean preferences without the top and bottom proportion (like scipy.stats.trim_mean)
+4. AGGREGATORS: Kernels by name, get_aggregator
+
+Every kernel takes the same arguments:
+    values: (rows, P) stacked preferences, one row per resident (per resident and city it counts for)
+    weights: (rows,) resources of the residents
+    groups: (rows,) which city (group) each row belongs to, any order
+    num_groups: number of cities
+and returns (num_groups, P) aggregated preferences, nan for groups without rows. One city's
+residents are a single group (groups all 0); all cities at once are one call with a group per city.
+Each kernel is a fixed number of whole-array operations (bincount, sort) per preference column at most,
+whatever the number of cities.
+'''
+#############################################################
+# 0 Required Packages
+import numpy as np
+
+TRIM_PROPORTION = 0.1  # default share cut from each end by the trimmed mean
+
+
+##### 1. group_counts: Rows in each group
+def group_counts(groups, num_groups):
+    return np.bincount(groups, minlength=num_groups)
+
+def group_sums(values, weights, groups, num_groups):  # per-group column sums of values (times weights, if given)
+    rows, num_prefs = values.shape
+    flat = (groups[:, None] * num_prefs + np.arange(num_prefs)).ravel()  # flat (group, preference) index
+    products = values if weights is None else values * weights[:, None]
+    return np.bincount(flat, weights=products.ravel(), minlength=num_groups * num_prefs).reshape(num_groups, num_prefs)
+
+
+##### 2. sort_within_groups: Rows ordered by group, each column sorted within its group
+def sort_within_groups(values, groups, num_groups):  # returns sorted values, each row's group, and each group's first row
+    counts = group_counts(groups, num_groups)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    order = np.argsort(groups, kind='stable')
+    row_groups = groups[order]
+    ordered = values[order]
+    for j in range(values.shape[1]):  # sort each column within groups (lexsort: last key, groups, sorts first)
+        ordered[:, j] = ordered[np.lexsort((ordered[:, j], row_groups)), j]
+    return ordered, row_groups, starts
+
+
+##### 3. Kernels
+# 3.1 group_mean: Mean preferences
+def group_mean(values, weights, groups, num_groups):
+    counts = group_counts(groups, num_groups)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return group_sums(values, None, groups, num_groups) / counts[:, None]
+
+# 3.2 group_weighted_mean: Mean preferences weighted by resources (plain mean where a group has no resources)
+def group_weighted_mean(values, weights, groups, num_groups):
+    total_weights = np.bincount(groups, weights=weights, minlength=num_groups)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weighted = group_sums(values, weights, groups, num_groups) / total_weights[:, None]
+    return np.where((total_weights > 0)[:, None], weighted, group_mean(values, weights, groups, num_groups))
+
+# 3.3 group_median: Median preferences
+def group_median(values, weights, groups, num_groups):
+    ordered, _, starts = sort_within_groups(np.asarray(values, dtype=float), groups, num_groups)
+    counts = group_counts(groups, num_groups)
+    medians = np.full((num_groups, values.shape[1]), np.nan)
+    filled = counts > 0
+    low = starts[filled] + (counts[filled] - 1) // 2  # middle row (odd count) or the two middle rows (even count)
+    high = starts[filled] + counts[filled] // 2
+    medians[filled] = (ordered[low] + ordered[high]) / 2
+    return medians
+
+# 3.4 group_mode: Most common preferences (integer preferences, smallest value on ties, like scipy.stats.mode)
+def group_mode(values, weights, groups, num_groups):
+    values = np.asarray(values)
+    modes = np.full((num_groups, values.shape[1]), np.nan)
+    if len(values) == 0:
+        return modes
+    if not np.array_equal(values, np.round(values)):
+        raise ValueError('mode aggregation needs integer preferences')
+    values = values.astype(np.int64)
+    low = values.min()
+    span = int(values.max() - low) + 1  # possible values
+    num_prefs = values.shape[1]
+    # count every (group, preference, value) at once, then take the most common value (argmax takes the smallest on ties)
+    flat = ((groups[:, None] * num_prefs + np.arange(num_prefs)) * span + (values - low)).ravel()
+    tallies = np.bincount(flat, minlength=num_groups * num_prefs * span).reshape(num_groups, num_prefs, span)
+    filled = group_counts(groups, num_groups) > 0
+    modes[filled] = tallies[filled].argmax(axis=2) + low
+    return modes
+
+# 3.5 group_trimmed_mean: Mean preferences without the top and bottom proportion (like scipy.stats.trim_mean)
+def group_trimmed_mean(values, weights, groups, num_groups, proportion=TRIM_PROPORTION):
+    ordered, row_groups, starts = sort_within_groups(np.asarray(values, dtype=float), groups, num_groups)
+    counts = group_counts(groups, num_groups)
+    cut = (proportion * counts).astype(int)  # rows cut from each end of each group
+    rank = np.arange(len(ordered)) - starts[row_groups]  # position within the group
+    kept = (rank >= cut[row_groups]) & (rank < (counts - cut)[row_groups])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return group_sums(ordered[kept], None, row_groups[kept], num_groups) / (counts - 2 * cut)[:, None]
+
+
+##### 4. AGGREGATORS: Kernels by name
+AGGREGATORS = {
+    'mean': group_mean,
+    'weighted_mean': group_weighted_mean,
+    'median': group_median,
+    'mode': group_mode,
+    'trimmed_mean': group_trimmed_mean,
+}
+
+def get_aggregator(aggregation):  # a name from AGGREGATORS, or a kernel (e.g. functools.partial(group_trimmed_mean, proportion=0.2))
+    if callable(aggregation):
+        return aggregation
+    if aggregation not in AGGREGATORS:
+        raise ValueError('aggregation must be one of %s, or a kernel' % ', '.join(AGGREGATORS))
+    return AGGREGATORS[aggregation]
@@ -0,0 +1,261 @@
+'''
+Array-backed step engine for the multigrid ABM
+'''
+################### Table of Contents ######################
+'''
+0. Required packages
+1. axis_bounds: Per-resident torus window bounds along one grid axis (same clipping as mesa)
+2. window_offsets: Torus neighborhood offsets, in the order mesa iterates them
+3. window_tables: Flat cell indices of every torus window of one radius (shared by all agents, see multigridmodel)
+    3.1 window_any: Cells whose torus window holds at least one flagged cell (for active-set scheduling)
+4. calc_gaps: Mean gap between residents' preferences and the spending of the cities they look at
+5. scan_windows: Smallest gap in every resident's window, plus current gaps and gaps to the Moore neighborhood
+6. move_residents: Move residents to the neighboring city they picked
+7. neighborhood_spending: Weighted mean preference around every city
+    7.1 cell_sums: Residents, resources and (weighted) preferences in every cell
+    7.2 neighborhood_means: Weighted mean preference over every cell's Moore neighborhood, from cell sums
+    7.3 neighborhood_aggregate: Any aggregation kernel over every cell's Moore neighborhood (one grid)
+8. resident_work: Cities looked at, gaps computed and candidates found in a resident phase (for the profiler)
+9. ArrayEngine Class
+    9.1 resident_step: Every resident compares cities and (maybe) moves
+    9.2 city_step: Every city sets spending to the weighted mean preference of its neighborhood
+    9.3 position_hash: Hash of resident positions (Steady_State.py), resident i has id i as in the agent version
+
+The engine keeps city spending as one (width, height, P) array, indexed [x, y] like mesa's grid
+and in the same order as coord_iter (so init_spending_lvls reshapes into it without copying),
+and residents as parallel position/preference/resource arrays.
+Residents never affect each other during the resident phase (cities only update afterwards),
+and cities only read resident positions, so both phases can be done as whole-array operations.
+The Resident and City classes in Agents.py stay the reference implementation:
+with the same seeds the engine makes the same moves and the same spending as they do.
+The kernels (4-7) work on a batch of grids with a leading axis, so replicate ensembles (Ensemble.py)
+can share them; the engine's one grid is a batch of one. They also work on a strip of a grid padded
+with halo rows, as long as no window reaches past the halo (Tiled_Engine.py).
+'''
+#############################################################
+# 0 Required Packages
+import random  # global random, Resident.step picks among tied cities with it
+import numpy as np
+from Steady_State import position_hash
+from Aggregation import get_aggregator
+
+
+##### 1. axis_bounds: Per-resident torus window bounds along one grid axis
+def axis_bounds(radius, size):  # radius can be a single value or an array of radii
+    max_radius = size // 2  # window can't be wider than the grid
+    radius = np.minimum(radius, max_radius)
+    # on an even axis a full-width window would reach the same cell from both sides, mesa drops the last offset
+    upper = radius - ((radius == max_radius) & (size % 2 == 0))
+    return -radius, upper  # lowest and highest offset (inclusive)
+
+##### 2. window_offsets: Torus neighborhood offsets, in the order mesa iterates them
+def window_offsets(radius, width, height):
+    x_low, x_high = axis_bounds(radius, width)
+    y_low, y_high = axis_bounds(radius, height)
+    # x offset outer, y offset inner, same as MultiGrid.get_neighborhood
+    return [(dx, dy) for dx in range(int(x_low), int(x_high) + 1) for dy in range(int(y_low), int(y_high) + 1)]
+
+##### 3. window_tables: Flat cell indices of every torus window of one radius
+def window_tables(radius, width, height):
+    x_low, x_high = axis_bounds(radius, width)
+    y_low, y_high = axis_bounds(radius, height)
+    dx = np.arange(x_low, x_high + 1)
+    dy = np.arange(y_low, y_high + 1)
+    # already wrapped, x part pre-multiplied so a window is x_table[x][:, None] + y_table[y] (flat index x * height + y)
+    x_table = ((np.arange(width)[:, None] + dx) % width) * height
+    y_table = (np.arange(height)[:, None] + dy) % height
+    # where the Moore neighborhood (radius 1) and the center sit in a flattened window (x offset outer, like mesa)
+    near = np.array([(i - x_low) * len(dy) + (j - y_low) for i, j in window_offsets(1, width, height)
+                     if x_low <= i <= x_high and y_low <= j <= y_high], dtype=np.intp)
+    center = -x_low * len(dy) - y_low
+    return x_table, y_table, near, center
+
+# 3.1 window_any: Cells whose torus window of one radius holds at least one flagged cell
+def window_any(flags, radius):  # flags: (width, height) bool
+    width, height = flags.shape
+    x_low, x_high = axis_bounds(radius, width)
+    y_low, y_high = axis_bounds(radius, height)
+    # windows are rectangles, so look along x then along y
+    rows = np.zeros_like(flags)
+    for dx in range(int(x_low), int(x_high) + 1):
+        rows |= np.roll(flags, -dx, axis=0)  # cell (x, y) picks up cell (x + dx, y)
+    found = np.zeros_like(flags)
+    for dy in range(int(y_low), int(y_high) + 1):
+        found |= np.roll(rows, -dy, axis=1)
+    return found
+
+##### 4. calc_gaps: Mean gap between residents' preferences and the spending of the cities they look at
+def calc_gaps(spending, grid, x, y, preferences):  # same arithmetic as calc_mean_gap, one value per resident
+    return np.mean(abs(spending[grid, x, y] - preferences), axis=-1)
+
+##### 5. scan_windows: Smallest gap in every resident's window, plus current gaps and gaps to the Moore neighborhood
+# works on a batch of grids: spending is (grids, width, height, P), resident x, y and resources (grids, residents),
+# preferences (grids, residents, P)
+def scan_windows(spending, x, y, preferences, resources):
+    grids, width, height, _ = spending.shape
+    grid = np.arange(grids)[:, None]  # which grid each resident is on
+    x_low, x_high = axis_bounds(resources, width)  # each resident's own window
+    y_low, y_high = axis_bounds(resources, height)
+    near = window_offsets(1, width, height)  # Moore neighborhood residents can move to
+    near_gaps = np.empty((len(near),) + x.shape)  # gap to each neighboring city, for picking candidates
+    min_gap = np.full(x.shape, np.inf)
+    # walk the widest window once, shifting every resident's position by the same offset
+    for dx, dy in window_offsets(int(resources.max()), width, height):
+        gaps = calc_gaps(spending, grid, (x + dx) % width, (y + dy) % height, preferences)
+        in_window = (dx >= x_low) & (dx <= x_high) & (dy >= y_low) & (dy <= y_high)
+        np.minimum(min_gap, np.where(in_window, gaps, np.inf), out=min_gap)
+        if (dx, dy) in near:
+            near_gaps[near.index((dx, dy))] = gaps
+        if (dx, dy) == (0, 0):
+            current_gap = gaps
+    return min_gap, current_gap, near, near_gaps
+
+##### 6. move_residents: Move residents to the neighboring city they picked
+# movers: index arrays (grid, resident) of the residents that move, picks: which of their candidates each one picked
+def move_residents(x, y, near, is_candidate, movers, picks, width, height):
+    # row of the picked candidate: first neighbor where the running candidate count passes the pick
+    picked = np.argmax(np.cumsum(is_candidate[(slice(None),) + movers], axis=0) > picks, axis=0)
+    offsets = np.array(near, dtype=np.intp)[picked].reshape(-1, 2)
+    x[movers] = (x[movers] + offsets[:, 0]) % width
+    y[movers] = (y[movers] + offsets[:, 1]) % height
+
+##### 7. neighborhood_spending: Weighted mean preference around every city (on a batch of grids)
+# returns new spending (cities without neighboring residents keep theirs) and the number of residents in each cell
+def neighborhood_spending(spending, x, y, preferences, resources):
+    sums = cell_sums(spending.shape, x, y, preferences, resources)
+    return neighborhood_means(spending, *sums), sums[0]
+
+# 7.1 cell_sums: Residents, resources and (weighted) preferences in every cell, shape is (grids, width, height, P)
+def cell_sums(shape, x, y, preferences, resources):
+    grids, width, height, num_prefs = shape
+    cells = grids * width * height
+    cell = (np.arange(grids)[:, None] * width + x) * height + y  # flat cell index, coord_iter order within a grid
+    resources = np.broadcast_to(resources, x.shape)
+    # per-cell counts, resource totals and (weighted) preference sums
+    counts = np.bincount(cell.ravel(), minlength=cells).reshape(grids, width, height)
+    weights = np.bincount(cell.ravel(), weights=resources.ravel(), minlength=cells).reshape(grids, width, height)
+    pref_cell = (cell[..., None] * num_prefs + np.arange(num_prefs)).ravel()  # flat (cell, preference) index
+    pref_sums = np.bincount(pref_cell, weights=np.broadcast_to(preferences, x.shape + (num_prefs,)).ravel(),
+                            minlength=cells * num_prefs).reshape(shape)
+    weighted_sums = np.bincount(pref_cell, weights=(resources[..., None] * preferences).ravel(),
+                                minlength=cells * num_prefs).reshape(shape)
+    return counts, weights, pref_sums, weighted_sums
+
+# 7.2 neighborhood_means: Weighted mean preference over every cell's Moore neighborhood, from cell sums
+def neighborhood_means(spending, counts, weights, pref_sums, weighted_sums):
+    _, width, height, _ = spending.shape
+    # sum over each city's Moore neighborhood by shifting the whole grid (sums of integers, so order doesn't matter)
+    hood_counts, hood_weights = np.zeros_like(counts), np.zeros_like(weights)
+    hood_prefs, hood_weighted = np.zeros_like(pref_sums), np.zeros_like(weighted_sums)
+    for dx, dy in window_offsets(1, width, height):
+        shift = (-dx, -dy)  # cell (x, y) picks up cell (x + dx, y + dy)
+        hood_counts += np.roll(counts, shift, axis=(1, 2))
+        hood_weights += np.roll(weights, shift, axis=(1, 2))
+        hood_prefs += np.roll(pref_sums, shift, axis=(1, 2))
+        hood_weighted += np.roll(weighted_sums, shift, axis=(1, 2))
+    # weighted mean where residents have resources, plain mean where they have none (as calc_mean_prefs_weighted)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = np.where((hood_weights > 0)[..., None], hood_weighted / hood_weights[..., None],
+                         hood_prefs / hood_counts[..., None])
+    # cities with no neighboring residents keep their spending
+    return np.where((hood_counts > 0)[..., None], means, spending)
+
+
+# 7.3 neighborhood_aggregate: Any aggregation kernel (Aggregation.py) over every cell's Moore neighborhood (one grid)
+# returns aggregated preferences (width * height, P), nan where there are no neighboring residents, and the
+# number of residents around each cell
+def neighborhood_aggregate(aggregator, x, y, preferences, resources, width, height):
+    offsets = window_offsets(1, width, height)
+    # a resident at (x, y) is a neighbor of the city at (x - dx, y - dy) for every Moore offset (dx, dy)
+    groups = np.concatenate([((x - dx) % width) * height + (y - dy) % height for dx, dy in offsets])
+    values = np.tile(preferences, (len(offsets), 1))
+    weights = np.tile(np.asarray(resources, dtype=float), len(offsets))
+    return aggregator(values, weights, groups, width * height), np.bincount(groups, minlength=width * height)
+
+##### 8. resident_work: Cities looked at, gaps computed and candidates found in a resident phase (for the profiler)
+def resident_work(resources, num_candidates, width, height):  # num_candidates: each resident's neighboring candidates
+    x_low, x_high = axis_bounds(resources, width)
+    y_low, y_high = axis_bounds(resources, height)
+    # cities in residents' own windows, gaps computed over the widest window
+    visits = int(((x_high - x_low + 1) * (y_high - y_low + 1)).sum())
+    evaluations = len(window_offsets(int(resources.max()), width, height)) * len(resources)
+    # residents with no resources only look at their own city, their one candidate (as counted by Resident.step)
+    candidates = int(np.where(resources > 0, num_candidates, 1).sum())
+    return {'neighbor_visits': visits, 'gap_evaluations': evaluations, 'candidates': candidates}
+
+
+##### 9. ArrayEngine Class
+class ArrayEngine:
+    def __init__(self, model):
+        self.model = model
+        self.width = model.width
+        self.height = model.height
+        self.preferences = np.asarray(model.resident_preferences)  # (residents, P)
+        self.resources = np.asarray(model.resident_resources)  # (residents,), also each resident's search radius
+        self.num_prefs = self.preferences.shape[1]
+        # city spending as one array, float since cities set spending to means
+        self.spending = np.asarray(model.init_spending_lvls, dtype=float).reshape(self.width, self.height, self.num_prefs)
+        # place residents exactly as the agent version does (given cells, or the same random draws from the model seed)
+        self.x, self.y = model.starting_cells()
+        self.occupied = 0  # cities with at least one resident, counted in city_step
+
+    def step(self):  # residents first, then cities, like the schedule order of the agent version
+        profiler = self.model.profiler
+        if profiler is None:
+            self.resident_step()
+            self.city_step()
+            return
+        profiler.start('residents')
+        self.resident_step()
+        profiler.stop('residents')
+        profiler.start('cities')
+        self.city_step()
+        profiler.stop('cities')
+
+    # 9.1 resident_step: Every resident compares cities and (maybe) moves
+    def resident_step(self):
+        if len(self.x) == 0:
+            return
+        # the engine's single grid is a batch of one for the kernels (x and y are views, so moves land in them)
+        x, y = self.x[None], self.y[None]
+        min_gap, current_gap, near, near_gaps = scan_windows(self.spending[None], x, y, self.preferences[None],
+                                                             self.resources[None])
+        # add current gaps to the model tally one at a time (cumsum keeps the same rounding as the agent version)
+        self.model.gap += np.cumsum(current_gap[0])[-1]
+        if self.model.summary is not None:
+            self.model.summary.add_gaps(current_gap[0])  # add current gaps to the step's gap distribution
+        # movers pick at random among the neighboring cities with the smallest gap, in resident order,
+        # so the global random draws line up with the agent version
+        is_candidate = near_gaps == min_gap
+        num_candidates = is_candidate.sum(axis=0)
+        # if there are cities with closer spending, move to one
+        movers = np.nonzero((min_gap < current_gap) & (num_candidates > 0))
+        picks = np.array([random.choice(range(n)) for n in num_candidates[movers]], dtype=np.intp)  # nth candidate
+        move_residents(x, y, near, is_candidate, movers, picks, self.width, self.height)
+        self.model.movers += len(picks)
+        if self.model.profiler is not None:
+            for counter, n in resident_work(self.resources, num_candidates[0], self.width, self.height).items():
+                self.model.profiler.count(counter, n)
+
+    # 9.2 city_step: Every city sets spending to the weighted mean preference of its neighborhood (or the model's aggregation)
+    def city_step(self):
+        if self.model.aggregation == 'weighted_mean':
+            spending, counts = neighborhood_spending(self.spending[None], self.x[None], self.y[None], self.preferences[None],
+                                                     self.resources[None])
+            self.spending = spending[0]
+        else:
+            aggregated, hood_counts = neighborhood_aggregate(get_aggregator(self.model.aggregation), self.x, self.y,
+                                                             self.preferences, self.resources, self.width, self.height)
+            # cities with no neighboring residents keep their spending
+            self.spending = np.where((hood_counts > 0)[:, None], aggregated,
+                                     self.spending.reshape(-1, self.num_prefs)).reshape(self.spending.shape)
+            counts = np.bincount(self.x * self.height + self.y, minlength=self.width * self.height)
+        self.occupied = np.count_nonzero(counts)  # cities with at least one resident
+        if self.model.profiler is not None:  # every city sums over its Moore neighborhood
+            self.model.profiler.count('neighbor_visits', len(window_offsets(1, self.width, self.height)) * self.width * self.height)
+        if self.model.summary is not None:  # running mean and variance
+            self.model.summary.add_spending_block(self.spending.reshape(self.width * self.height, self.num_prefs))
+
+    # 9.3 position_hash: Hash of resident positions, resident i has id i as in the agent version
+    def position_hash(self):
+        return position_hash(np.arange(len(self.x)), self.x * self.height + self.y)
@@ -0,0 +1,202 @@
+'''
+Batch runner for parameter sweeps and replicates over a process pool
+'''
+################### Table of Contents ######################
+'''
+0. Required packages
+1. Shared arrays
+    1.1 share_arrays: Copy large input arrays into shared memory once, in the parent process
+    1.2 attach_arrays: Pool initializer, maps the shared arrays into each worker without copying them
+2. make_runs: Expand a parameter grid and replicate count into runs with their own seeds
+3. run_model: Run one model in a worker (or read its result back from the cache) and return its rows
+    3.1 run_result: The run's result: per-step reporter, spending trajectory, segregation, how it ended
+    3.2 run_model: The run's rows
+4. iter_batch: Run a batch over a process pool, yielding each run's rows as it finishes
+5. run_batch: Run a batch and gather all the rows in one (tidy) data frame
+
+Models are given by name ('multigrid', 'mini' or 'schelling', see Models.py). The tiled engine starts
+worker processes of its own, which pool workers can't, so batches don't take engine='tiled'. Every
+run's model is closed once it's done (recording files, profiler).
+
+Like mesa's batch_run, parameters map names to a value or a list of values, and every combination
+is run `replicates` times. Large arrays that are the same for every run (preferences, initial spending)
+go in `arrays` instead: they are put in shared memory once rather than pickled into every task.
+Inputs that change from run to run can come from `setup(params, rng)`, a module-level function
+called in the worker that returns extra constructor arguments.
+Each run gets its own seed (spawned from the batch seed), used for the global random, NumPy's global
+random and the model's own random number generator.
+With a checkpoint (Checkpoint.py), every run forks the saved model instead of building a new one: its
+parameters override the saved settings, its seed reseeds the saved random states, and it runs max_steps
+more steps from where the saved model was.
+With a cache (Run_Cache.py), runs that were run before with the same model, arguments, seed, step cap and
+code are read back from disk instead of run again, so a repeated sweep, or the rest of an interrupted one,
+only simulates the runs it hasn't got. run_result gives one run's full result, e.g. for a notebook.
+'''
+#############################################################
+# 0 Required Packages
+import itertools
+import multiprocessing as mp
+import os
+import random
+from multiprocessing import shared_memory
+import numpy as np
+from Models import MODELS, load_model_class, load_model_module
+from Run_Cache import RunCache, run_key, model_result
+from Checkpoint import load_snapshot, fork
+
+##### 1. Shared arrays
+_shared = {}  # in workers: name -> (SharedMemory, array view)
+_snapshots = {}  # in workers: checkpoint path -> snapshot, read once per worker
+
+# 1.1 share_arrays: Copy large input arrays into shared memory once, in the parent process
+def share_arrays(arrays):  # returns the shared memory blocks (to free later) and specs to attach to them by
+    blocks, specs = [], {}
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        block = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+        blocks.append(block)
+        specs[name] = (block.name, array.shape, array.dtype.str)
+    return blocks, specs
+
+# 1.2 attach_arrays: Pool initializer, maps the shared arrays into each worker without copying them
+def attach_arrays(specs):
+    for name, (block_name, shape, dtype) in specs.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        array = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+        array.flags.writeable = False  # shared by every run, models must not change it in place
+        _shared[name] = (block, array)
+
+
+##### 2. make_runs: Expand a parameter grid and replicate count into runs with their own seeds
+def make_runs(parameters, replicates=1, seed=None):
+    names = list(parameters)
+    # a list (or other iterable) of values is swept over, anything else (including strings) is fixed
+    values = [list(value) if hasattr(value, '__iter__') and not isinstance(value, (str, np.ndarray)) else [value]
+              for value in parameters.values()]
+    combinations = list(itertools.product(*values))
+    seeds = np.random.SeedSequence(seed).spawn(len(combinations) * replicates)  # independent per-run seeds
+    runs = []
+    for i, combination in enumerate(combinations):
+        for replicate in range(replicates):
+            run_id = i * replicates + replicate
+            runs.append({'run_id': run_id, 'replicate': replicate, 'seed': int(seeds[run_id].generate_state(1)[0]),
+                         'params': dict(zip(names, combination))})
+    if any(run['params'].get('engine') == 'tiled' for run in runs):  # pool workers are daemons, they can't have children
+        raise ValueError("engine='tiled' can't run in a batch: its worker processes can't be started from the pool's "
+                         "(sweep with engine='array', or run tiled models one at a time)")
+    return runs
+
+
+##### 3. run_model: Run one model in a worker (or read its result back from the cache) and return its rows
+# 3.1 run_result: The run's result (see Run_Cache.model_result), from the cache if it was run before
+def run_result(model_name, run, max_steps, setup=None, checkpoint=None, cache=None):
+    model_class = load_model_class(model_name)
+    reporter = MODELS[model_name][3]
+    seed = run['seed']
+    random.seed(seed)  # agents pick among tied cities / empty cells with the global random
+    np.random.seed(seed)
+    kwargs = dict(run['params'])
+    kwargs.update({name: array for name, (_, array) in _shared.items()})
+    if setup is not None:  # run-specific inputs
+        kwargs.update(setup(run['params'], np.random.default_rng(seed)))
+    if cache is not None:  # keyed on the final constructor arguments, so shared arrays and setup's inputs count too
+        key = run_key(MODELS[model_name][2], kwargs, seed, max_steps, checkpoint)
+        result = cache.get(key)
+        if result is not None:
+            return result
+    if checkpoint is None:
+        model = model_class(seed=seed, **kwargs)
+    else:  # fork the saved model, this run's parameters override its settings
+        if checkpoint not in _snapshots:
+            _snapshots[checkpoint] = load_snapshot(checkpoint)
+        record_path = _snapshots[checkpoint][0]['settings'].get('record_path')
+        if record_path is not None and 'record_path' not in kwargs:  # a directory of its own under the saved model's
+            kwargs['record_path'] = os.path.join(record_path, 'run_%d' % run['run_id'])
+        model = fork(_snapshots[checkpoint], [kwargs], seeds=[seed])[0]
+    try:
+        start = model.schedule.steps  # 0, or the saved model's steps
+        while model.running and model.schedule.steps < start + max_steps:
+            model.step()
+        # per-step reporter, from the recorder when the model has one, else the data collector
+        if getattr(model, 'recorder', None) is not None:
+            series = model.recorder.gap
+        else:
+            series = model.datacollector.model_vars[reporter]
+        segregation = load_model_module(model_name).get_segregation(model) if model_name == 'schelling' else None
+        result = model_result(model, series, segregation)
+    finally:  # recording files, and the tiled engine's workers, don't outlive the run
+        if hasattr(model, 'close'):
+            model.close()
+    if cache is not None:
+        cache.put(key, result)
+    return result
+
+# 3.2 run_model: The run's rows
+def run_model(model_name, run, max_steps, data_collection_period=-1, setup=None, checkpoint=None, cache=None):
+    reporter = MODELS[model_name][3]
+    result = run_result(model_name, run, max_steps, setup, checkpoint, cache)
+    series = result['series']
+    # the runner's own columns and scalar parameters go on every row (arrays don't fit in a tidy frame)
+    base = {'run_id': run['run_id'], 'replicate': run['replicate'], 'seed': run['seed']}
+    base.update({name: value for name, value in run['params'].items() if np.ndim(value) == 0})
+    base['steps'] = int(result['steps'])
+    base['running'] = bool(result['running'])
+    if 'stop_reason' in result:  # min_gap, fixed_point or cycle (None if it hit max_steps)
+        base['stop_reason'] = str(result['stop_reason']) or None
+    if 'segregation' in result:
+        base['segregation'] = float(result['segregation'])
+    if data_collection_period == -1:  # last step only
+        steps = range(len(series))[-1:]
+    else:  # every nth step
+        steps = range(data_collection_period - 1, len(series), data_collection_period)
+    return [dict(base, step=step + 1, **{reporter: float(series[step])}) for step in steps] or [base]
+
+def _run_task(task):  # unpack a task in the worker
+    return run_model(*task)
+
+
+##### 4. iter_batch: Run a batch over a process pool, yielding each run's rows as it finishes
+# model: 'multigrid', 'mini' or 'schelling'
+# parameters: constructor arguments, each a value or a list of values to sweep over (every combination is run)
+# replicates: runs per combination
+# arrays: constructor arguments that are large arrays, the same for every run (shared memory)
+# setup: module-level function setup(params, rng) returning run-specific constructor arguments
+# data_collection_period: -1 for the last step only, n for every nth step
+# checkpoint: file saved with Checkpoint.save_checkpoint to fork every run from (max_steps more steps each), None
+#   to build every model from scratch
+# cache: RunCache (Run_Cache.py) or directory of one: runs found there are read back instead of run, and finished runs
+#   are stored, so repeating a batch, or one stopped halfway, only runs what's missing (give a seed, else every
+#   batch draws new run seeds and nothing is found)
+def iter_batch(model, parameters, replicates=1, seed=None, arrays=None, setup=None, max_steps=100,
+               data_collection_period=-1, processes=None, checkpoint=None, cache=None):
+    runs = make_runs(parameters, replicates, seed)
+    if isinstance(cache, str):
+        cache = RunCache(cache)
+    tasks = [(model, run, max_steps, data_collection_period, setup, checkpoint, cache) for run in runs]
+    if mp.get_start_method() == 'fork':  # workers are copies of this process: import the model (mesa, pandas) here,
+        load_model_module(model)  # once, instead of in every worker of every pool
+    blocks, specs = share_arrays(arrays or {})
+    try:
+        with mp.Pool(processes, initializer=attach_arrays, initargs=(specs,)) as pool:
+            for rows in pool.imap_unordered(_run_task, tasks):
+                yield rows
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+
+##### 5. run_batch: Run a batch and gather all the rows in one (tidy) data frame
+def run_batch(model, parameters, replicates=1, seed=None, arrays=None, setup=None, max_steps=100,
+              data_collection_period=-1, processes=None, progress=None, checkpoint=None, cache=None):  # progress(finished, total) is called per run
+    import pandas as pd  # only the parent process needs it
+    rows = []
+    total = len(make_runs(parameters, replicates))
+    for finished, run_rows in enumerate(iter_batch(model, parameters, replicates, seed, arrays, setup, max_steps,
+                                                   data_collection_period, processes, checkpoint, cache), start=1):
+        rows.extend(run_rows)
+        if progress is not None:
+            progress(finished, total)
+    return pd.DataFrame(rows).sort_values(['run_id', 'step'] if rows and 'step' in rows[0] else ['run_id'],
+                                          ignore_index=True)
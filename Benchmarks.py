@@ -0,0 +1,164 @@
+'''
+Benchmarks for model construction and step throughput
+'''
+################### Table of Contents ######################
+'''
+0. Required packages
+1. Suites: Benchmark cases, varying one parameter at a time around a base case
+2. make_model: Build a model for a case from seeded random inputs
+3. time_case: Time construction and steps for one case
+4. run_suite: Time every case in a suite
+5. compare: Compare results with a stored baseline, flag regressions
+6. Command line
+
+Run from the command line, e.g.
+    python Benchmarks.py --suite quick --out bench.json
+    python Benchmarks.py --suite full --out bench.json --baseline baseline.json
+Results are written as JSON (one entry per case, times in seconds), so a run can be kept as a baseline
+and later runs compared against it. With --baseline, exits with status 1 if any case got slower than
+the tolerance allows.
+'''
+#############################################################
+# 0 Required Packages
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+import numpy as np
+from Models import load_model_class
+
+##### 1. Suites: Benchmark cases, varying one parameter at a time around a base case
+BASE = {'residents': 1000, 'size': 30, 'prefs': 4, 'radius': 1}  # grid is size x size, one city per cell
+SUITES = {
+    'quick': {'residents': [100, 1000], 'size': [10, 30], 'prefs': [4], 'radius': [1, 2]},
+    'full': {'residents': [10**2, 10**3, 10**4, 10**5, 10**6], 'size': [10, 30, 100, 300], 'prefs': [1, 4, 10, 20],
+             'radius': [0, 1, 2, 5, 10]},
+}
+DENSITY = 3  # residents per cell at most in the residents sweep (the grid grows with the number of residents)
+MAX_DENSITY = 0.9  # Schelling agents need empty cells
+ENGINES = {'multigrid': ['agents', 'array'], 'mini': ['agents'], 'schelling': ['agents', 'array']}
+
+
+def suite_cases(suite, models):
+    cases = {}  # by name: the base case comes up in every sweep, keep it once
+    for parameter, values in SUITES[suite].items():
+        for value in values:
+            case = dict(BASE, **{parameter: value})
+            if parameter == 'residents':
+                case['size'] = max(BASE['size'], int(np.ceil(np.sqrt(value / DENSITY))))
+            for model in models:
+                if model != 'multigrid' and parameter in ('prefs', 'radius'):  # single preference, radius 1 models
+                    continue
+                for engine in ENGINES[model]:
+                    entry = dict(case, model=model, engine=engine)
+                    cases.setdefault(case_name(entry), entry)
+    return list(cases.values())
+
+
+def case_name(case):
+    if case['model'] == 'multigrid':
+        return '%(model)s/%(engine)s/n=%(residents)d/size=%(size)d/P=%(prefs)d/r=%(radius)d' % case
+    if case['engine'] != 'agents':  # (agent cases keep their old names, so older baselines still match)
+        return '%(model)s/%(engine)s/n=%(residents)d/size=%(size)d' % case
+    return '%(model)s/n=%(residents)d/size=%(size)d' % case
+
+
+##### 2. make_model: Build a model for a case from seeded random inputs
+def make_model(case, seed=0):
+    rng = np.random.default_rng(seed)
+    random.seed(seed)
+    n, size = case['residents'], case['size']
+    cities = size * size
+    if case['model'] == 'multigrid':
+        preferences = rng.integers(1, 21, size=(n, case['prefs']))
+        resources = np.full(n, case['radius'])  # every resident searches the same radius
+        spending = rng.integers(1, 21, size=(cities, case['prefs']))
+        return load_model_class('multigrid')(n, size, size, cities, spending, preferences, resources, -1,
+                                             engine=case['engine'], seed=seed)
+    if case['model'] == 'mini':
+        return load_model_class('mini')(n, size, size, cities, rng.integers(1, 21, cities), rng.integers(1, 21, n), -1,
+                                        seed=seed)
+    # Schelling has one agent per occupied cell, residents set the density (some cells stay empty to move to)
+    return load_model_class('schelling')(size, size, min(MAX_DENSITY, n / cities), 0.3, 3, engine=case['engine'], seed=seed)
+
+
+##### 3. time_case: Time construction and steps for one case
+def time_case(case, steps=3, seed=0):
+    load_model_class(case['model'])  # import first, so construction time doesn't include it
+    start = time.perf_counter()
+    model = make_model(case, seed)
+    construct = time.perf_counter() - start
+    step_times = []
+    for _ in range(steps):  # later steps are usually cheaper (fewer movers), so keep every step's time
+        start = time.perf_counter()
+        model.step()
+        step_times.append(time.perf_counter() - start)
+    if hasattr(model, 'close'):  # stop tiled engine workers
+        model.close()
+    return dict(case, name=case_name(case), construct_s=construct, step_s=step_times,
+                step_median_s=float(np.median(step_times)))
+
+
+##### 4. run_suite: Time every case in a suite
+# max_agents: skip cases that would create more agent objects than this (agent engines get very slow)
+def run_suite(suite='quick', models=('multigrid', 'mini', 'schelling'), steps=3, max_agents=10**5, seed=0, log=print):
+    results = []
+    for case in suite_cases(suite, models):
+        if case['engine'] == 'agents' and case['residents'] + case['size'] ** 2 > max_agents:
+            log('skip %s (more than %d agents)' % (case_name(case), max_agents))
+            continue
+        result = time_case(case, steps, seed)
+        log('%-50s construct %8.4fs  step %8.4fs' % (result['name'], result['construct_s'], result['step_median_s']))
+        results.append(result)
+    return {'meta': {'suite': suite, 'steps': steps, 'seed': seed, 'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                     'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform()},
+            'results': results}
+
+
+##### 5. compare: Compare results with a stored baseline, flag regressions
+# tolerance: allowed slowdown, as a fraction of the baseline time
+def compare(results, baseline, tolerance=0.2):
+    base = {result['name']: result for result in baseline['results']}
+    rows = []
+    for result in results['results']:
+        if result['name'] not in base:
+            continue
+        for key in ('construct_s', 'step_median_s'):
+            ratio = result[key] / base[result['name']][key] if base[result['name']][key] > 0 else np.inf
+            rows.append({'name': result['name'], 'measure': key, 'baseline_s': base[result['name']][key],
+                         'current_s': result[key], 'ratio': ratio, 'regression': ratio > 1 + tolerance})
+    return rows
+
+
+##### 6. Command line
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Time model construction and steps')
+    parser.add_argument('--suite', choices=sorted(SUITES), default='quick')
+    parser.add_argument('--models', default='multigrid,mini,schelling', help='comma separated')
+    parser.add_argument('--steps', type=int, default=3, help='steps timed per case')
+    parser.add_argument('--max-agents', type=int, default=10**5, help='skip agent cases with more agents than this')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', help='write results to this JSON file')
+    parser.add_argument('--baseline', help='compare with results in this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown vs the baseline (0.2 = 20%%)')
+    args = parser.parse_args(argv)
+    results = run_suite(args.suite, args.models.split(','), args.steps, args.max_agents, args.seed)
+    if args.out:
+        with open(args.out, 'w') as file:
+            json.dump(results, file, indent=1)
+    if args.baseline:
+        with open(args.baseline) as file:
+            rows = compare(results, json.load(file), args.tolerance)
+        for row in rows:
+            print('%-50s %-14s %8.4fs -> %8.4fs  x%.2f%s' % (row['name'], row['measure'], row['baseline_s'],
+                                                            row['current_s'], row['ratio'],
+                                                            '  REGRESSION' if row['regression'] else ''))
+        if any(row['regression'] for row in rows):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,372 @@
+'''
+Checkpoints: save a running model to a file, restore it bit for bit, or fork variants from it
+'''
+################### Table of Contents ######################
+'''
+0. Required packages
+1. model_name: Which of the registered models (Models.MODELS) a model is
+2. Grid: Agents in the order they sit on the grid, and putting them back in that order
+3. Per-model state, one (args, state, restore) triple per model in STATES
+    3.1 multigridmodel (agents or array engine)
+    3.2 MiniModel
+    3.3 SchellingModel (agents or array engine)
+4. Collected data: recorder, summary, data collector and profiler rows
+5. snapshot: Everything needed to rebuild a model, as settings plus arrays
+6. restore: Rebuild a model from a snapshot
+7. save_checkpoint, load_snapshot, load_checkpoint: Snapshots in compact binary files
+8. fork: Many models from one snapshot, each with its own settings and seed
+
+A snapshot holds the constructor arguments of a model (settings and input arrays), its state between
+steps (where every agent is on the grid, agent attributes, city spending, per-cell sums, step count,
+stop flags, state fingerprints), everything it collected so far (columns streaming to disk only as their
+file and row count, so a checkpoint stays small however long the run), and the state of both random number
+generators a step draws from: model.random and the global random (residents pick among tied cities with it).
+restore builds a fresh model from the arguments and writes the state over it, so the restored model
+steps exactly as the original would have, draw for draw.
+Files are a compressed .npz: one entry per array, plus the settings, scalars and random states pickled
+into a byte array (only load checkpoints you made yourself, as with any pickle).
+The tiled engine's residents and random number generators live in its worker processes, so only the
+agents and array engines can be checkpointed.
+'''
+#############################################################
+# 0 Required Packages
+import os
+import pickle
+import random
+import numpy as np
+from Models import MODELS, load_model_class, load_model_module
+
+FORMAT = 1  # checkpoint format version, bumped when the layout changes
+
+
+##### 1. model_name: Which of the registered models a model is
+def model_name(model):
+    for name, (_, _, class_name, _) in MODELS.items():
+        if type(model).__name__ == class_name:
+            return name
+    raise ValueError('no checkpoints for %s models' % type(model).__name__)
+
+
+##### 2. Grid: Agents in the order they sit on the grid
+def grid_order(model):  # ids and cells of every agent on the grid, cell by cell in coord_iter order, in order within cells
+    ids, cells = [], []
+    for contents, x, y in model.grid.coord_iter():
+        for agent in contents if isinstance(contents, list) else [contents] if contents is not None else []:
+            ids.append(agent.unique_id)
+            cells.append((x, y))
+    return np.array(ids), np.array(cells, dtype=np.intp).reshape(-1, 2)
+
+def place_in_order(model, agents, ids, cells):  # take agents off the grid and put them back as grid_order found them
+    for agent in agents.values():
+        if agent.pos is not None:
+            model.grid.remove_agent(agent)
+    for id, (x, y) in zip(ids, cells):  # same order within cells, so neighbors are visited in the same order
+        model.grid.place_agent(agents[id], (int(x), int(y)))
+
+
+##### 3. Per-model state
+# each model has args(model): constructor arguments (arrays separately), state(model): scalars and arrays,
+# restore(model, scalars, arrays): write the state over a freshly built model
+
+# 3.1 multigridmodel (agents or array engine)
+def multigrid_args(model):
+    from Tiled_Engine import TiledEngine
+    if isinstance(model.engine, TiledEngine):
+        raise ValueError("checkpoints need engine='agents' or 'array' (tiled workers keep their own state)")
+    settings = {'residents': model.num_residents, 'height': model.height, 'width': model.width,
+                'num_cities': model.num_cities, 'min_gap': model.min_gap,
+                'engine': 'agents' if model.engine is None else 'array', 'aggregation': model.aggregation,
+                'activation': model.activation, 'active_set': model.occupancy_changed is not None, 'search': model.search,
+                'max_period': None if model.history is None else model.history.recent.maxlen,
+                'collect': collect_modes(model), 'record_path': model.record_path, 'profile': model.profiler is not None,
+                'seed': model._seed}
+    arrays = {'init_spending_lvls': np.asarray(model.init_spending_lvls), 'resident_preferences': model.resident_preferences,
+              'resident_resources': np.asarray(model.resident_resources)}
+    return settings, arrays
+
+def multigrid_state(model):
+    scalars = {'gap': model.gap, 'movers': model.movers, 'position_hash': model.position_hash,
+               'occupancy_version': model.occupancy_version}
+    arrays = {'cell_counts': model.cell_counts, 'cell_resources': model.cell_resources, 'cell_prefs': model.cell_prefs,
+              'cell_weighted_prefs': model.cell_weighted_prefs, 'resident_preferences': model.resident_preferences}
+    if model.occupancy_changed is not None:  # active-set flags and running gap totals
+        arrays['occupancy_changed'] = model.occupancy_changed
+        arrays['spending_changed'] = model.spending_changed
+        scalars['gap_total'] = model.gap_total
+        if model.gap_counts is not None:
+            arrays['gap_counts'] = model.gap_counts
+    if model.engine is None:
+        arrays['city_spending'] = model.city_spending
+        arrays['grid_ids'], arrays['grid_cells'] = grid_order(model)
+        # current gaps (nan before a resident's first step) and current cities (-1 for none yet)
+        arrays['current_gap'] = np.array([np.nan if resident.current_gap is None else resident.current_gap
+                                          for resident in model.residents], dtype=float)
+        arrays['current_city'] = np.array([-1 if resident.current_city is None else resident.current_city.unique_id
+                                           for resident in model.residents], dtype=np.int64)
+    else:
+        arrays['spending'] = model.engine.spending
+        arrays['x'], arrays['y'] = model.engine.x, model.engine.y
+        scalars['occupied'] = model.engine.occupied
+    return scalars, arrays
+
+def restore_multigrid(model, scalars, arrays):
+    for name in ('gap', 'movers', 'position_hash', 'occupancy_version'):
+        setattr(model, name, scalars[name])
+    for name in ('cell_counts', 'cell_resources', 'cell_prefs', 'cell_weighted_prefs', 'resident_preferences'):
+        getattr(model, name)[...] = arrays[name]
+    model.neighborhood_aggregates = {}  # made again from the restored positions when needed
+    if model.occupancy_changed is not None:  # active-set flags, all set if the saved model didn't keep them (everyone steps)
+        model.occupancy_changed[...] = arrays.get('occupancy_changed', True)
+        model.spending_changed[...] = arrays.get('spending_changed', True)
+    if model.engine is None:
+        model.city_spending[...] = arrays['city_spending']
+        model.spending_version += 1  # the city index (if any) is stale
+        agents = {agent.unique_id: agent for agent in model.schedule.agents}
+        place_in_order(model, agents, arrays['grid_ids'], arrays['grid_cells'])
+        model.resident_x[...], model.resident_y[...] = np.array([resident.pos for resident in model.residents],
+                                                                dtype=np.intp).reshape(-1, 2).T
+        for resident, gap, city in zip(model.residents, arrays['current_gap'], arrays['current_city']):
+            resident.current_gap = None if np.isnan(gap) else gap
+            resident.current_city = None if city < 0 else agents[city]
+        if model.occupancy_changed is not None:  # running gap totals, made from the residents' gaps if they weren't saved
+            model.reset_gap_totals()
+            model.gap_total = scalars.get('gap_total', model.gap_total)
+            if model.gap_counts is not None and 'gap_counts' in arrays:
+                model.gap_counts[...] = arrays['gap_counts']
+    else:
+        model.engine.spending = np.array(arrays['spending'])
+        model.engine.x[...] = arrays['x']
+        model.engine.y[...] = arrays['y']
+        model.engine.occupied = scalars['occupied']
+
+# 3.2 MiniModel
+def mini_args(model):
+    settings = {'num_residents': model.num_residents, 'height': model.height, 'width': model.width,
+                'num_cities': model.num_cities, 'min_gap': model.min_gap,
+                'max_period': None if model.history is None else model.history.recent.maxlen,
+                'collect': collect_modes(model), 'record_path': model.record_path, 'profile': model.profiler is not None,
+                'seed': model._seed}
+    arrays = {'init_spending_levels': np.asarray(model.init_spending_levels), 'preferences': np.asarray(model.preferences)}
+    return settings, arrays
+
+def mini_state(model):
+    scalars = {'gap': model.gap, 'movers': model.movers, 'position_hash': model.position_hash}
+    arrays = {'spending': np.array([city.spending_level for city in model.cities])}
+    arrays['grid_ids'], arrays['grid_cells'] = grid_order(model)
+    arrays['current_city'] = np.array([-1 if resident.current_city is None else resident.current_city.unique_id
+                                       for resident in model.residents], dtype=np.int64)
+    return scalars, arrays
+
+def restore_mini(model, scalars, arrays):
+    for name in ('gap', 'movers', 'position_hash'):
+        setattr(model, name, scalars[name])
+    for city, spending in zip(model.cities, arrays['spending']):
+        city.spending_level = spending
+    agents = {agent.unique_id: agent for agent in model.schedule.agents}
+    place_in_order(model, agents, arrays['grid_ids'], arrays['grid_cells'])
+    for resident, city in zip(model.residents, arrays['current_city']):
+        resident.current_city = None if city < 0 else agents[city]
+
+# 3.3 SchellingModel (agents or array engine)
+def schelling_args(model):
+    return {'height': model.height, 'width': model.width, 'density': model.density, 'minority_pc': model.minority_pc,
+            'homophily': model.homophily, 'engine': 'agents' if model.engine is None else 'array', 'seed': model._seed}, {}
+
+def schelling_state(model):  # agents in schedule order (RandomActivation shuffles that order), ids are starting cells
+    if model.engine is not None:  # the grid of types, and empty cells in slot order (draws pick slots)
+        return {'happy': model.happy}, {'types': model.engine.types, 'empties': model.engine.empties.cells}
+    agents = model.schedule.agents
+    return {'happy': model.happy}, {'ids': np.array([agent.unique_id for agent in agents], dtype=np.intp).reshape(-1, 2),
+                                    'cells': np.array([agent.pos for agent in agents], dtype=np.intp).reshape(-1, 2),
+                                    'types': np.array([agent.type for agent in agents], dtype=np.int64)}
+
+def restore_schelling(model, scalars, arrays):
+    model.happy = scalars['happy']
+    if model.engine is not None:
+        from Schelling_Engine import EmptyCells, EMPTY
+        model.engine.types[...] = arrays['types']
+        model.engine.num_agents = int(np.count_nonzero(arrays['types'] != EMPTY))
+        model.engine.empties = EmptyCells(arrays['empties'], model.width * model.height)
+        return
+    # the constructor placed its own random agents, swap them for the saved ones
+    agent_class = load_model_module('schelling').SchellingAgent
+    for agent in model.schedule.agents:
+        model.grid.remove_agent(agent)
+        model.schedule.remove(agent)
+    for id, cell, agent_type in zip(arrays['ids'], arrays['cells'], arrays['types']):
+        agent = agent_class(tuple(int(i) for i in id), model, int(agent_type))
+        model.grid.place_agent(agent, tuple(int(i) for i in cell))
+        model.schedule.add(agent)
+
+STATES = {
+    'multigrid': (multigrid_args, multigrid_state, restore_multigrid),
+    'mini': (mini_args, mini_state, restore_mini),
+    'schelling': (schelling_args, schelling_state, restore_schelling),
+}
+
+
+##### 4. Collected data: recorder, summary, data collector and profiler rows
+def collect_modes(model):  # collect argument that makes the same collectors
+    modes = tuple(mode for mode, collector in (('full', model.recorder), ('summary', model.summary)) if collector is not None)
+    return modes + ('positions',) if model.recorder is not None and model.recorder.records_positions else modes
+
+def collected_columns(model):  # the model's recording columns (Recorder.RecordColumn), by name
+    columns = {}
+    recorder = getattr(model, 'recorder', None)
+    if recorder is not None:
+        columns['recorder/spending'] = recorder.spending_column
+        columns['recorder/gap'] = recorder.gap_column
+        if recorder.records_positions:
+            columns['recorder/positions'] = recorder.positions_column
+    if getattr(model, 'summary', None) is not None:
+        columns.update({'summary/' + name: column for name, column in model.summary.columns.items()})
+    if getattr(model, 'profiler', None) is not None:
+        columns['profiler'] = model.profiler.column
+    return columns
+
+# returns rows kept in memory by name, and (file, row count) of columns streaming to disk (their rows stay in the file)
+def collected(model):
+    arrays = {'collector/' + name: np.asarray(values) for name, values in model.datacollector.model_vars.items()}
+    on_disk = {}
+    for key, column in collected_columns(model).items():
+        if column.path is None:
+            arrays[key] = column.values()
+        else:
+            column.flush()
+            on_disk[key] = (os.path.abspath(column.path), len(column))
+    return arrays, on_disk
+
+# restore_collected: Put saved rows into a rebuilt model's collectors, where it has them
+# on_disk: (file, row count) of columns saved on disk, aside: their files set aside because the rebuilt model writes
+#   to the same place (moved back in, cut to the saved rows), the others are copied or, into memory columns, read
+def restore_collected(model, arrays, on_disk=None, aside=None):
+    arrays, aside = dict(arrays), aside or {}
+    columns = collected_columns(model)
+    for key, (source, rows) in (on_disk or {}).items():
+        column = columns.get(key)
+        if column is None:  # not recorded any more, leave the file as it was
+            if key in aside:
+                os.replace(aside[key], source)
+        elif column.path is not None:
+            column.resume(aside.get(key, source), rows, move=key in aside)
+        else:
+            arrays[key] = np.load(source, mmap_mode='r')[:rows]
+    for key, values in arrays.items():
+        kind, _, name = key.partition('/')
+        if kind == 'collector':
+            model.datacollector.model_vars[name] = list(values)
+        elif key in columns:  # (e.g. positions only if the restored model records them)
+            column = columns[key]
+            column.extend(values[len(column):] if kind == 'summary' else values)  # (a rebuilt summary has its starting row)
+
+
+##### 5. snapshot: Everything needed to rebuild a model
+# returns (meta, arrays): meta holds the model name, settings, scalars and random states, arrays the rest by name
+# ('args/...' constructor arrays, 'state/...' state arrays, and collected rows)
+def snapshot(model):
+    name = model_name(model)
+    args, state, _ = STATES[name]
+    settings, arg_arrays = args(model)
+    scalars, state_arrays = state(model)
+    scalars.update({'running': model.running, 'steps': model.schedule.steps, 'time': model.schedule.time,
+                    'stop_reason': getattr(model, 'stop_reason', None), 'cycle_period': getattr(model, 'cycle_period', None)})
+    history = getattr(model, 'history', None)
+    collected_arrays, recordings = collected(model)
+    meta = {'format': FORMAT, 'model': name, 'settings': settings, 'scalars': scalars,
+            'history': None if history is None else list(history.recent),
+            'random': (model.random.getstate(), random.getstate()), 'recordings': recordings}
+    arrays = {'args/' + key: np.array(value) for key, value in arg_arrays.items()}  # copies, the model goes on stepping
+    arrays.update({'state/' + key: np.array(value) for key, value in state_arrays.items()})
+    arrays.update({key: np.array(value) for key, value in collected_arrays.items()})
+    return meta, arrays
+
+
+##### 6. restore: Rebuild a model from a snapshot
+# overrides: constructor arguments to change (settings such as min_gap, collect or record_path; the state is
+#   restored over whatever the constructor builds, so change spending or positions on the restored model instead)
+# recordings go where the saved model's went (its record_path: the files are cut back to the rows they had when saved,
+#   then appended to), unless overrides give another record_path (the saved rows are copied there on disk; None reads
+#   them into memory and records there)
+def restore(snapshot, **overrides):
+    meta, arrays = snapshot
+    if meta['format'] != FORMAT:
+        raise ValueError('checkpoint format %s, expected %s' % (meta['format'], FORMAT))
+    name = meta['model']
+    kwargs = dict(meta['settings'])
+    kwargs.update({key[len('args/'):]: value for key, value in arrays.items() if key.startswith('args/')})
+    kwargs.update(overrides)
+    recordings = meta.get('recordings', {})  # recording files and row counts (none in checkpoints of in-memory models)
+    # the rebuilt model starts its recording files over, so set aside the saved ones it would write over
+    aside = {}
+    if kwargs.get('record_path') is not None:
+        for key, (source, _) in recordings.items():
+            if os.path.dirname(source) == os.path.abspath(kwargs['record_path']):
+                aside[key] = source + '.restoring'
+                os.replace(source, aside[key])
+    try:
+        model = load_model_class(name)(**kwargs)  # builds (and randomly places) a fresh model, overwritten below
+    except BaseException:
+        for key, path in aside.items():
+            os.replace(path, recordings[key][0])
+        raise
+    scalars = meta['scalars']
+    STATES[name][2](model, scalars, {key[len('state/'):]: value for key, value in arrays.items() if key.startswith('state/')})
+    model.running = scalars['running']
+    model.schedule.steps = scalars['steps']
+    model.schedule.time = scalars['time']
+    if hasattr(model, 'stop_reason'):
+        model.stop_reason = scalars['stop_reason']
+        model.cycle_period = scalars['cycle_period']
+    if getattr(model, 'history', None) is not None and meta['history'] is not None:
+        model.history.recent.clear()
+        model.history.recent.extend(meta['history'][-model.history.recent.maxlen:])
+    restore_collected(model, {key: value for key, value in arrays.items() if not key.startswith(('args/', 'state/'))},
+                      recordings, aside)
+    model_state, global_state = meta['random']
+    model.random.setstate(model_state)  # last, the constructor drew from both
+    random.setstate(global_state)
+    return model
+
+
+##### 7. save_checkpoint, load_snapshot, load_checkpoint: Snapshots in compact binary files
+def save_checkpoint(model, path):  # written to a temporary file first, so an interrupted save leaves the old checkpoint
+    meta, arrays = snapshot(model)
+    arrays['meta'] = np.frombuffer(pickle.dumps(meta), dtype=np.uint8)
+    with open(path + '.tmp', 'wb') as file:
+        np.savez_compressed(file, **arrays)
+    os.replace(path + '.tmp', path)
+
+def load_snapshot(path):  # (meta, arrays) as snapshot() made them
+    with np.load(path) as file:
+        arrays = {key: file[key] for key in file.files}
+    return pickle.loads(arrays.pop('meta').tobytes()), arrays
+
+def load_checkpoint(path, **overrides):  # resume a saved model
+    return restore(load_snapshot(path), **overrides)
+
+
+##### 8. fork: Many models from one snapshot (or checkpoint file)
+# variants: overrides for each model (see restore), seeds: a seed for each model (reseeds model.random and the
+#   global random, so variants don't all make the same random choices), None to keep the saved random states
+#   (the global random is shared by every model in a process: to step forks side by side, run each in its own
+#   process, e.g. with Batch_Runner's checkpoint argument)
+# forked models start running again, even if the saved one had stopped (close each with model.close() when done)
+# a saved model that streamed its recordings to disk gives fork i the directory <record_path>/fork_<i> (so forks don't
+#   write over each other or the original), unless its variant sets record_path itself
+def fork(snapshot, variants, seeds=None):
+    if isinstance(snapshot, (str, os.PathLike)):
+        snapshot = load_snapshot(snapshot)
+    record_path = snapshot[0]['settings'].get('record_path')
+    models = []
+    for i, overrides in enumerate(variants):
+        if record_path is not None and 'record_path' not in overrides:
+            overrides = dict(overrides, record_path=os.path.join(record_path, 'fork_%d' % i))
+        model = restore(snapshot, **overrides)
+        if seeds is not None:
+            model.random.seed(seeds[i])
+            random.seed(seeds[i])
+        model.running = True
+        if hasattr(model, 'stop_reason'):
+            model.stop_reason = model.cycle_period = None
+        models.append(model)
+    return models
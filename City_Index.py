@@ -0,0 +1,86 @@
+'''
+Tiled index over city spending, for finding the smallest gap in a wide resident window without scanning every city
+'''
+################### Table of Contents ######################
+'''
+0. Required packages
+1. TILE, SEARCH_RADIUS: Tile size, and the smallest search radius the index is used for
+2. window_tiles: A torus window along one grid axis, and which of its tiles each cell falls in
+3. CityIndex Class
+    3.1 refresh: Per-tile smallest and largest spending on each preference
+    3.2 window_min: Smallest gap to a preference vector within a torus window
+
+The grid is cut into TILE x TILE blocks of cities, and for every block the index keeps the smallest and
+largest spending on each preference. No city in a block can be closer to a resident's preferences than
+the mean, over preferences, of how far the preference lies outside the block's [smallest, largest] range,
+so window_min starts from a gap it already knows (the best in the resident's Moore neighborhood), skips
+every block whose bound can't beat it, and computes real gaps (same arithmetic as calc_mean_gap) for the
+cities of the other blocks only, in one go. A window of (2r+1)^2 cities costs one bound per block plus
+the cities in the blocks it has to open: few once cities' spending has settled into smooth regions, most
+of them while spending is still the random initial spending (then it is a little slower than a scan).
+The result is the exact smallest gap, so residents still collect every neighboring city with that gap
+and pick one at random, as find_cands_min_mean does (see Resident.decide).
+Refreshing the index is one pass over the spending array, done when spending has changed
+(multigridmodel.get_city_index), i.e. once per step: residents all step before cities do.
+'''
+#############################################################
+# 0 Required Packages
+import numpy as np
+from Array_Engine import axis_bounds
+
+##### 1. TILE, SEARCH_RADIUS
+TILE = 8  # cities per tile side
+SEARCH_RADIUS = 24  # smallest search radius (resources) residents use the index for; scanning is faster for narrower windows
+SLACK = 1e-9  # relative margin on bounds, so float rounding in a bound can never skip a block with a smaller gap
+
+
+##### 2. window_tiles: A torus window along one grid axis, and which of its tiles each cell falls in
+def window_tiles(center, radius, size, tile):  # returns the window's cells (wrapped), its tiles, and each cell's place among them
+    low, high = axis_bounds(radius, size)
+    cells = (center + np.arange(low, high + 1)) % size
+    tiles, place = np.unique(cells // tile, return_inverse=True)  # (a window that wraps can hold both ends of one tile)
+    return cells, tiles, place
+
+
+##### 3. CityIndex Class
+class CityIndex:
+    # spending: (width * height, P) spending of every city, by flat cell index (x * height + y); the index keeps a
+    #   reshaped view, so refresh picks up changes made to the array in place
+    def __init__(self, spending, width, height, tile=TILE):
+        self.spending = spending.reshape(width, height, -1)
+        self.width = width
+        self.height = height
+        self.tile = tile
+        self.x_starts = np.arange(0, width, tile)  # first row and column of every tile (the last ones may be smaller)
+        self.y_starts = np.arange(0, height, tile)
+        self.windows = {}  # (axis, center, radius): window_tiles along that axis, worked out the first time they're needed
+        self.refresh()
+
+    # 3.1 refresh: Per-tile smallest and largest spending on each preference, (x tiles, y tiles, P)
+    def refresh(self):
+        self.low = np.minimum.reduceat(np.minimum.reduceat(self.spending, self.x_starts, axis=0), self.y_starts, axis=1)
+        self.high = np.maximum.reduceat(np.maximum.reduceat(self.spending, self.x_starts, axis=0), self.y_starts, axis=1)
+
+    def axis_window(self, axis, center, radius):  # window_tiles along one axis (0 for x, 1 for y), cached
+        key = (axis, center, radius)
+        if key not in self.windows:
+            self.windows[key] = window_tiles(center, radius, self.width if axis == 0 else self.height, self.tile)
+        return self.windows[key]
+
+    # 3.2 window_min: Smallest gap to a preference vector within the torus window of a radius around (x, y)
+    # best: a gap already known to be in the window (e.g. the smallest in the Moore neighborhood), cities in blocks
+    #   that can't beat it are skipped; returns the smallest gap and the number of gaps computed
+    def window_min(self, x, y, radius, preferences, best=np.inf):
+        xs, x_tiles, x_place = self.axis_window(0, x, radius)
+        ys, y_tiles, y_place = self.axis_window(1, y, radius)
+        # lower bound on the gap of every city in every block of the window (times P, compared with best times P)
+        low = self.low[x_tiles[:, None], y_tiles]
+        high = self.high[x_tiles[:, None], y_tiles]
+        bounds = (np.maximum(low - preferences, 0) + np.maximum(preferences - high, 0)).sum(axis=-1)
+        promising = bounds * (1 - SLACK) < best * len(preferences)  # blocks that might beat the best gap
+        if not promising.any():
+            return best, 0
+        # real gaps of the cities in the promising blocks only, in one go
+        i, j = np.nonzero(promising[x_place][:, y_place])
+        gaps = np.mean(abs(self.spending[xs[i], ys[j]] - preferences), axis=-1)
+        return min(best, gaps.min()), len(gaps)
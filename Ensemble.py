@@ -0,0 +1,98 @@
+'''
+Replicate ensembles of the multigrid ABM, stepped together as one batched computation
+'''
+################### Table of Contents ######################
+'''
+0. Required packages
+1. batch_input: Give an input a leading replicate axis (inputs shared by all replicates are broadcast, not copied)
+2. TieboutEnsemble Class
+    2.1 step: Advance every replicate that is still running by one step
+    2.2 run: Step until every replicate has stopped, or max_steps
+    2.3 gap_history: Gap of every replicate at every step
+
+R independent replicates of multigridmodel's array engine: spending is one (R, width, height, P) array
+and residents (R, residents) arrays, all advanced by the same kernels (Array_Engine.py) in one step call.
+Each replicate has its own min_gap and stops on its own; stopped replicates are masked out of later steps.
+Ties between candidate cities are broken with the ensemble's own NumPy generator rather than the global
+random, so a replicate follows the same rules as multigridmodel but not the same random draws.
+'''
+#############################################################
+# 0 Required Packages
+import numpy as np
+from Array_Engine import scan_windows, move_residents, neighborhood_spending
+
+
+##### 1. batch_input: Give an input a leading replicate axis
+def batch_input(values, replicates, ndim):  # ndim: dimensions of one replicate's input
+    values = np.asarray(values)
+    if values.ndim == ndim:  # same input for every replicate
+        return np.broadcast_to(values, (replicates,) + values.shape)
+    if values.ndim != ndim + 1 or len(values) != replicates:
+        raise ValueError('expected one input per replicate, shape (%d, ...)' % replicates)
+    return values
+
+
+##### 2. TieboutEnsemble Class
+# init_spending_lvls, resident_preferences, resident_resources and min_gap can be the same for every replicate,
+# or one per replicate along a leading axis
+class TieboutEnsemble:
+    def __init__(self, replicates, residents, height, width, init_spending_lvls, resident_preferences, resident_resources,
+                 min_gap, seed=None):
+        self.replicates = replicates
+        self.num_residents = residents
+        self.height = height
+        self.width = width
+        self.rng = np.random.default_rng(seed)  # placement and tie-breaking for every replicate
+        self.preferences = batch_input(resident_preferences, replicates, 2)  # (R, residents, P)
+        self.resources = batch_input(resident_resources, replicates, 1)  # (R, residents)
+        spending = batch_input(init_spending_lvls, replicates, 2)  # (R, cities, P), cities in coord_iter order
+        self.num_prefs = spending.shape[-1]
+        self.spending = np.array(spending, dtype=float).reshape(replicates, width, height, self.num_prefs)
+        self.x = self.rng.integers(width, size=(replicates, residents))  # random places on each grid
+        self.y = self.rng.integers(height, size=(replicates, residents))
+        self.min_gap = np.broadcast_to(np.asarray(min_gap, dtype=float), (replicates,))  # each replicate's stop rule
+        self.running = np.ones(replicates, dtype=bool)  # which replicates are still running
+        self.steps = np.zeros(replicates, dtype=int)  # steps each replicate has taken
+        self.gap = np.zeros(replicates)  # each replicate's gap at its last step
+        self.gaps = []  # gap of every replicate at every step (nan once it has stopped)
+        self.time = 0  # number of step calls
+
+    # 2.1 step: Advance every replicate that is still running by one step
+    def step(self):
+        active = np.flatnonzero(self.running)
+        if active.size == 0:
+            return
+        # index the running replicates (a slice when all are running, so nothing is copied)
+        sel = slice(None) if active.size == self.replicates else active
+        spending, x, y = self.spending[sel], self.x[sel], self.y[sel]
+        preferences, resources = self.preferences[sel], self.resources[sel]
+        gap = np.zeros(active.size)
+        if self.num_residents > 0:
+            # residents compare cities and (maybe) move
+            min_gap, current_gap, near, near_gaps = scan_windows(spending, x, y, preferences, resources)
+            gap = current_gap.sum(axis=1)
+            is_candidate = near_gaps == min_gap
+            num_candidates = is_candidate.sum(axis=0)
+            movers = np.nonzero((min_gap < current_gap) & (num_candidates > 0))
+            picks = (self.rng.random(len(movers[0])) * num_candidates[movers]).astype(np.intp)  # one of the candidates at random
+            move_residents(x, y, near, is_candidate, movers, picks, self.width, self.height)
+        # cities update spending
+        spending, _ = neighborhood_spending(spending, x, y, preferences, resources)
+        self.spending[sel], self.x[sel], self.y[sel] = spending, x, y
+        self.gap[active] = gap
+        self.steps[active] += 1
+        gaps = np.full(self.replicates, np.nan)
+        gaps[active] = gap
+        self.gaps.append(gaps)
+        self.running[active] = gap >= self.min_gap[active]  # a replicate stops once its gap is small enough
+        self.time += 1
+
+    # 2.2 run: Step until every replicate has stopped, or max_steps
+    def run(self, max_steps):
+        while self.running.any() and self.time < max_steps:
+            self.step()
+
+    # 2.3 gap_history: Gap of every replicate at every step, (steps, R)
+    @property
+    def gap_history(self):
+        return np.array(self.gaps).reshape(-1, self.replicates)
@@ -0,0 +1,181 @@
+'''
+Command line for running experiments from a config file, headless (batch runs to CSV) or visual (live server)
+'''
+################### Table of Contents ######################
+'''
+0. Required packages
+1. load_experiments: Experiments in a JSON config file
+2. model_inputs: Constructor arguments of an experiment, with its scenario's arrays
+3. run_headless: Run every combination of an experiment's parameters over a process pool, rows to a CSV file
+    3.1 write_rows: Rows to a CSV file
+    3.2 plot_rows: Scatter plot of two columns
+4. run_visual: Serve one model of an experiment live
+    4.1 check_visual: Experiments to serve are of models with a server
+5. Command line
+
+Run from the command line, e.g.
+    python Experiments.py experiments.json
+    python Experiments.py experiments.json --only density,minority --processes 4
+    python Experiments.py experiments.json --only tiebout_live --port 8600
+A config file holds one experiment, or {"experiments": [...]} with other top-level keys as defaults for
+every experiment. An experiment has
+    name: names its output files (and --only)
+    model: 'multigrid', 'mini' or 'schelling'
+    mode: 'headless' (default) or 'visual'
+    parameters: constructor arguments, each a value or a list of values to sweep over (as Batch_Runner's)
+    scenario: arguments of Scenarios.make_scenario (multigrid) or mini_scenario (mini), for the input
+        arrays and grid size
+    replicates, seed, max_steps, data_collection_period, processes, cache: as Batch_Runner.run_batch's
+    output: CSV file of the rows (default name.csv), plot: {"x": column, "y": column, "file": image}
+The modules this one imports are loaded when an experiment needs them, not at startup: the model (mesa,
+pandas) is imported once per headless experiment, just before Batch_Runner forks its workers from this
+process (so they start with it), rows are written with the csv module rather than pandas, matplotlib is
+imported only for plots, and mesa's visualization server only in visual mode.
+'''
+#############################################################
+# 0 Required Packages
+import argparse
+import csv
+import json
+import os
+import sys
+
+MODES = ('headless', 'visual')
+DEFAULTS = {'mode': 'headless', 'parameters': {}, 'scenario': None, 'replicates': 1, 'seed': None, 'max_steps': 100,
+            'data_collection_period': -1, 'processes': None, 'cache': None, 'output': None, 'plot': None}
+
+
+##### 1. load_experiments: Experiments in a JSON config file, each with every setting filled in
+def load_experiments(path):
+    with open(path) as file:
+        config = json.load(file)
+    experiments = config.pop('experiments', None)
+    if experiments is None:  # the file is one experiment
+        experiments, config = [config], {}
+    filled = []
+    for i, experiment in enumerate(experiments):
+        experiment = dict(DEFAULTS, **config, **experiment)
+        experiment.setdefault('name', 'experiment_%d' % i)
+        if 'model' not in experiment:
+            raise ValueError('experiment %s has no model' % experiment['name'])
+        if experiment['mode'] not in MODES:
+            raise ValueError('experiment %s: mode must be one of %s' % (experiment['name'], ', '.join(MODES)))
+        filled.append(experiment)
+    return filled
+
+
+##### 2. model_inputs: Constructor arguments (parameters) and input arrays (arrays) of an experiment
+def model_inputs(experiment):
+    parameters, arrays = dict(experiment['parameters']), {}
+    if experiment['scenario'] is not None:
+        import numpy as np
+        import Scenarios  # NumPy only
+        makers = {'multigrid': Scenarios.make_scenario, 'mini': Scenarios.mini_scenario}
+        if experiment['model'] not in makers:
+            raise ValueError('no scenarios for %s models' % experiment['model'])
+        for name, value in makers[experiment['model']](**experiment['scenario']).items():
+            if isinstance(value, np.ndarray):
+                arrays[name] = value
+            else:  # grid size and population, unless the parameters set them
+                parameters.setdefault(name, value)
+    return parameters, arrays
+
+
+##### 3. run_headless: Run an experiment's batch over a process pool, rows to a CSV file (and a plot)
+def run_headless(experiment, processes=None, log=print):
+    from Batch_Runner import iter_batch, make_runs  # NumPy, the model is imported by iter_batch
+    parameters, arrays = model_inputs(experiment)
+    total = len(make_runs(parameters, experiment['replicates']))
+    rows = []
+    for finished, run_rows in enumerate(iter_batch(experiment['model'], parameters, experiment['replicates'],
+                                                   experiment['seed'], arrays, max_steps=experiment['max_steps'],
+                                                   data_collection_period=experiment['data_collection_period'],
+                                                   processes=processes or experiment['processes'],
+                                                   cache=experiment['cache']), start=1):
+        rows.extend(run_rows)
+        if finished == total or finished % max(1, total // 20) == 0:  # about every 5%
+            log('%s: %d/%d runs' % (experiment['name'], finished, total))
+    rows.sort(key=lambda row: (row['run_id'], row.get('step', 0)))
+    output = experiment['output'] or experiment['name'] + '.csv'
+    write_rows(rows, output)
+    if experiment['plot'] is not None:
+        plot_rows(rows, **experiment['plot'])
+    return output
+
+# 3.1 write_rows: Rows (dicts) to a CSV file, columns in the order they first appear
+def write_rows(rows, path):
+    columns = list(dict.fromkeys(column for row in rows for column in row))
+    with open(path, 'w', newline='') as file:
+        writer = csv.DictWriter(file, columns)
+        writer.writeheader()
+        writer.writerows(rows)
+
+# 3.2 plot_rows: Scatter plot of column y against column x, saved to file
+def plot_rows(rows, x, y, file=None):
+    import matplotlib
+    matplotlib.use('Agg')  # no display needed
+    import matplotlib.pyplot as plt
+    figure, axes = plt.subplots()
+    axes.scatter([row[x] for row in rows], [row[y] for row in rows])
+    axes.set_xlabel(x)
+    axes.set_ylabel(y)
+    axes.grid(True)
+    figure.savefig(file or '%s_%s.png' % (y, x))
+    plt.close(figure)
+
+
+##### 4. run_visual: Serve one model of an experiment live (until interrupted)
+def run_visual(experiment, port=8521):
+    check_visual([experiment])
+    parameters, arrays = model_inputs(experiment)
+    swept = [name for name, value in parameters.items() if isinstance(value, list)]
+    if swept:
+        raise ValueError('experiment %s: visual mode shows one model, %s should be single values'
+                         % (experiment['name'], ', '.join(swept)))
+    from Visualization import launch  # mesa's server
+    launch(experiment['model'], dict(parameters, **arrays), port)
+
+
+# 4.1 check_visual: Raise ValueError for an experiment to serve whose model has no server (Visualization.SERVERS), before
+# anything runs (mesa is only imported if some experiment is visual)
+def check_visual(experiments):
+    if not experiments:
+        return
+    from Visualization import SERVERS
+    for experiment in experiments:
+        if experiment['model'] not in SERVERS:
+            raise ValueError('experiment %s: no visual server for %s models (there are servers for %s)'
+                             % (experiment['name'], experiment['model'], ', '.join(SERVERS)))
+
+
+##### 5. Command line
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run experiments from a config file')
+    parser.add_argument('config', help='JSON file of experiments')
+    parser.add_argument('--only', help='comma separated names of the experiments to run (default: all, in order)')
+    parser.add_argument('--mode', choices=MODES, help="run every experiment in this mode instead of its own")
+    parser.add_argument('--processes', type=int, help='worker processes for headless runs (default: one per core)')
+    parser.add_argument('--port', type=int, default=8521, help='port for visual runs')
+    args = parser.parse_args(argv)
+    experiments = load_experiments(args.config)
+    if args.only:
+        names = args.only.split(',')
+        missing = set(names) - {experiment['name'] for experiment in experiments}
+        if missing:
+            parser.error('no experiments named %s in %s' % (', '.join(sorted(missing)), args.config))
+        experiments = [experiment for experiment in experiments if experiment['name'] in names]
+    try:
+        check_visual([experiment for experiment in experiments if (args.mode or experiment['mode']) == 'visual'])
+    except ValueError as error:
+        parser.error(str(error))
+    log = lambda message: print(message, file=sys.stderr)
+    for experiment in experiments:
+        if (args.mode or experiment['mode']) == 'visual':
+            run_visual(experiment, args.port)
+        else:
+            print(os.path.abspath(run_headless(experiment, args.processes, log)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -6,7 +6,10 @@ from mesa.space import MultiGrid  # type of grid agents will be placed on
 from mesa.datacollection import DataCollector  # data collector to pull information once model is done running
 import random  # for placing agents randomly
 import numpy as np  # math
-import pandas as pd  # data frames for data collector output
+from Recorder import make_collectors, gap_span  # record spending levels and gap, or summary statistics, at each step
+from Profiler import StepProfiler  # optional per-step phase times and counters
+from Steady_State import StateHistory, position_key, position_hash, spending_digest  # fixed point and cycle detection
+from Scenarios import place_agents  # put many agents on the grid at once
 
 
 ############## Create Resident agent class
@@ -23,17 +26,24 @@ class Resident(Agent):
                 self.current_city = neighbor  # current city = neighbor city with same position as resident
                 current_gap = abs(self.current_city.spending_level - self.preference)  # calculate gap between spending and preference
                 self.model.gap += current_gap  # update model, add current spending gap to model tally
+                if self.model.summary is not None:
+                    self.model.summary.add_gap(current_gap)  # add current gap to the step's gap distribution
                 # this is the gap between the agent's preference and the city's most recent spending level
                 # the spending level may be different from when the agent first moved here since cities activate second
             if isinstance(neighbor, City):
                 neighbor_spending.append(neighbor.spending_level)  # fill in list of cities' spending
         smallest_gap = min(neighbor_spending, key=lambda x: abs(x-self.preference))  # find smallest spending-preference gap
+        if self.model.profiler is not None:  # cities looked at and gaps computed
+            self.model.profiler.count('neighbor_visits', len(neighbor_spending))
+            self.model.profiler.count('gap_evaluations', len(neighbor_spending))
         if smallest_gap < current_gap:  # if there's a city with a smaller gap than the current one add it to a list
             candidates = [neighbor for neighbor in self.model.grid.iter_neighbors(self.pos, moore=True, include_center=True)
                           if isinstance(neighbor, City) and neighbor.spending_level == smallest_gap]
+            if self.model.profiler is not None:
+                self.model.profiler.count('candidates', len(candidates))
             if candidates:  # if there are any cities in the list...
                 new_city = random.choice(candidates)  # one of the cities is chosen randomly
-                self.model.grid.move_agent(self, new_city.pos)  # Resident moves to the new city
+                self.model.move_resident(self, new_city.pos)  # Resident moves to the new city (and the move is counted)
                 self.current_city = new_city  # set current city to the new city
 
 
@@ -48,14 +58,32 @@ class City(Agent):
         for neighbor in self.model.grid.iter_neighbors(self.pos, moore = True, include_center=True):  # find preferences of all neighboring residents
             if isinstance(neighbor, Resident):  # If a neighbor is a resident...
                 resident_preferences.append(neighbor.preference)  # append their preference to a list
+        if self.model.profiler is not None:
+            self.model.profiler.count('neighbor_visits', len(resident_preferences))  # residents looked at
         if resident_preferences:  # if resident preferences list isn't empty (i.e. there's at least 1 neighboring resident)...
             self.spending_level = np.mean(resident_preferences)  # calculate mean preference and set spending equal to it
-        self.model.spending_levels.append(self.spending_level)  # add spending to model level list of spending levels
+        if self.model.summary is not None:
+            self.model.summary.add_spending(self.spending_level)  # add spending to the step's running mean and variance
 
 
 ############  Create Model class
 class MiniModel(Model):
-    def __init__(self, num_residents, height, width, num_cities, init_spending_levels, preferences, min_gap):
+    # collect: 'full' records every city's spending at every step, 'summary' only per-step summary statistics
+    #   in constant memory (for very long runs), or both, e.g. ('full', 'summary'); add 'positions' to record every
+    #   resident's cell at every step too, for rendering runs offline (Offline_Renderer.py)
+    # record_path: directory to stream recordings to, None to keep them in memory
+    # max_period: also stop at a fixed point (state same as a step before) or a cycle of up to max_period steps,
+    #   from fingerprints of resident positions and city spending (Steady_State.py); None to only stop on min_gap
+    #   (why a run stopped is in model.stop_reason: 'min_gap', 'fixed_point' or 'cycle', with model.cycle_period)
+    # profile: time the resident, city and collection phases of every step and count hot-path work (Profiler.py),
+    #   as a per-step table from model.profiler.to_frame()
+    # resident_positions: (num_residents, 2) starting x and y of every resident (e.g. from Scenarios.py), None to place
+    #   them at random cells
+    # seed: seed for the model's random number generator (picked up by mesa's Model.__new__), residents are placed
+    #   with the global random, seed that too for reproducible runs
+    # call model.close() when done with a model that records to disk or profiles
+    def __init__(self, num_residents, height, width, num_cities, init_spending_levels, preferences, min_gap,
+                 max_period=None, collect='full', record_path=None, profile=False, resident_positions=None, seed=None):
         self.num_residents = num_residents  # desired number of residents
         self.height = height  # height of grid
         self.width = width   # width of grid
@@ -66,104 +94,177 @@ class MiniModel(Model):
         self.schedule = BaseScheduler(self)  # schedule for which Resident and city moves when, they activate in order
         self.grid = MultiGrid(width, height, torus=True)  # create grid, set torus so no edge
         self.gap = 0  # start at 0 spending-preference gap, will update when stepping
-        self.spending_levels = []  # create empty spending levels list, will fill when stepping
+        self.movers = 0  # number of residents that moved this step
+        self.residents = []  # residents, for counting occupied cities
+        self.cities = []  # cities in coord_iter order
+        self.record_path = record_path  # where recordings stream to (None: in memory), kept for checkpoints
+        # recorder keeps every city's spending level and the gap at each step (in memory, or streamed to record_path)
+        # summary keeps per-step statistics only (either can be None, depending on collect)
+        self.recorder, self.summary = make_collectors(collect, (num_cities,), gap_span(preferences, init_spending_levels),
+                                                      path=record_path, num_residents=num_residents)
         # data collector to pull information out of the model when it's done running
-        self.datacollector = DataCollector({"gap": lambda m: m.gap, "spending_levels": lambda m: m.spending_levels})
+        self.datacollector = DataCollector({"gap": lambda m: m.gap})
+        self.profiler = StepProfiler(path=record_path) if profile else None  # per-step phase times and counters, if profiling
         self.running = True  # whether model is still running
+        self.stop_reason = None  # why the model stopped running
+        self.cycle_period = None  # steps between repeats of the state, if it stopped at a fixed point or cycle
+        self.history = StateHistory(max_period) if max_period else None  # recent state fingerprints, if watching for repeats
+        self.position_hash = 0  # hash of resident positions, kept up to date as residents move
 
         ##  Create Resident agents
         #  Because residents are added to the schedule first, they will move first, since agents activate in order
-        for i in range(self.num_residents):
-            #  choose random grid coordinates
-            x = random.randrange(self.grid.width)
-            y = random.randrange(self.grid.height)
-            resident = Resident(i, self, self.preferences[i])  # create resident and assign id and preference
-            self.grid.place_agent(resident, (x, y))  # place agent on grid at random location
+        if resident_positions is not None:  # given grid coordinates
+            positions = np.asarray(resident_positions).reshape(-1, 2)
+            x, y = positions[:, 0].astype(int), positions[:, 1].astype(int)
+        else:  # random grid coordinates, x then y for each resident in turn
+            x = np.empty(num_residents, dtype=int)
+            y = np.empty(num_residents, dtype=int)
+            for i in range(num_residents):
+                x[i] = random.randrange(self.grid.width)
+                y[i] = random.randrange(self.grid.height)
+        # create residents and assign ids and preferences, keep them in a list for counting occupied cities (and profiled steps)
+        self.residents = [Resident(i, self, self.preferences[i]) for i in range(num_residents)]
+        place_agents(self.grid, self.residents, x, y)  # place them all on the grid at once
+        if self.history is not None:  # (update_position_hash for every resident)
+            self.position_hash ^= position_hash(np.arange(num_residents), x * height + y)
+        for resident in self.residents:
             self.schedule.add(resident)  # add agent to schedule
 
-        ##  Create City agents
-        k = 0  # create new variable to increment
-        id = i + 1  # create unique City ids starting where Residents leave off
-        for cell in self.grid.coord_iter():
-            # set place on grid, iterating through grid coordinates
-            x = cell[1]  # cell's x coordinate
-            y = cell[2]  # cell's y coordinate
-            city = City(id, self, self.init_spending_levels[k])  # create city and assign id and spending
-            self.grid.place_agent(city, (x, y))  # place agent on grid at next location
+        ##  Create City agents, one per cell in coord_iter order, with unique ids starting where Residents leave off
+        self.cities = [City(num_residents + k, self, self.init_spending_levels[k]) for k in range(num_cities)]
+        cells = np.arange(num_cities)
+        place_agents(self.grid, self.cities, cells // height, cells % height)  # keep cities in order for recording spending
+        for city in self.cities:
             self.schedule.add(city)  # add agent to schedule
-            k += 1  # increment spending index
-            id += 1  # increment city id
+        if self.summary is not None:  # starting spending as the summary's first row
+            self.summary.initial_row(self.init_spending_levels, len({resident.pos for resident in self.residents}))
+        if self.history is not None:
+            self.history.add(self.fingerprint())  # starting state, so a first step that changes nothing is a fixed point
+
+    def update_position_hash(self, resident):  # XOR a resident's key for its cell in (placed, arrived) or out (left)
+        if self.history is not None:
+            self.position_hash ^= position_key(resident.unique_id, resident.pos[0] * self.height + resident.pos[1])
+
+    def move_resident(self, resident, pos):  # move a resident on the grid, counting the move
+        self.update_position_hash(resident)
+        self.grid.move_agent(resident, pos)
+        self.update_position_hash(resident)
+        self.movers += 1
+
+    def resident_cells(self):  # every resident's flat cell index (x * height + y), in resident order
+        return np.array([resident.pos[0] * self.height + resident.pos[1] for resident in self.residents], dtype=int)
+
+    def close(self):  # close the recording files (recordings stay readable)
+        for collector in (self.recorder, self.summary, self.profiler):
+            if collector is not None:
+                collector.close()
+
+    def fingerprint(self):  # hashes of resident positions and city spending
+        return self.position_hash, spending_digest([city.spending_level for city in self.cities])
 
     ## model's step function
     def step(self):  # run model: has agent move, updates gap, checks if gap is small enough to stop
         self.gap = 0  # reset spending-preference gap
-        self.schedule.step()   # agents all take a step
-        self.datacollector.collect(self)  # collect data at each step, from instance of class
+        self.movers = 0  # reset movers
+        profiler = self.profiler
+        if self.summary is not None:
+            self.summary.start_step()  # agents add their gaps and spending to the summary as they step
+        if profiler is None:
+            self.schedule.step()   # agents all take a step
+        else:  # same order as the schedule (residents, then cities), one phase at a time so each can be timed
+            profiler.start_step()
+            profiler.start('residents')
+            for resident in self.residents:
+                resident.step()
+            profiler.stop('residents')
+            profiler.start('cities')
+            for city in self.cities:
+                city.step()
+            profiler.stop('cities')
+            self.schedule.steps += 1  # what schedule.step() does after stepping the agents
+            self.schedule.time += 1
+            profiler.start('collect')
+        if self.recorder is not None:
+            positions = self.resident_cells() if self.recorder.records_positions else None
+            self.recorder.record([city.spending_level for city in self.cities], self.gap, positions)  # record spending levels and gap (and positions)
+        self.datacollector.collect(self)  # collect the gap at each step, whatever else is collected
+        if self.summary is not None:
+            occupied = len({resident.pos for resident in self.residents})  # cities with at least one resident
+            self.summary.end_step(self.gap, self.movers, occupied)  # add the step's summary statistics
+        if profiler is not None:
+            profiler.stop('collect')
+            profiler.count('moves', self.movers)
+            profiler.end_step()
         if self.gap < self.min_gap:  # check if gap is greater than some set value
             self.running = False  # If the gap between spending and preferences is small enough, stop
+            self.stop_reason = 'min_gap'
+        elif self.history is not None:  # stop if the state repeats one of the last few
+            period = self.history.add(self.fingerprint())
+            if period is not None:
+                self.running = False
+                self.stop_reason = 'fixed_point' if period == 1 else 'cycle'
+                self.cycle_period = period
+
+
+if __name__ == '__main__':  # run the example experiment when run as a script (not when imported)
+    import pandas as pd  # data frames for the plots (imported here, models don't need it)
+    ############ Set Model Parameters
+    random.seed(123)  # set seed for reproducible randomness
+    np.random.seed(123)  # set seed for reproducible randomness
+    num_residents = 300  # desired number of residents
+    height = 10  # height of grid
+    width = 10  # width of grid
+    num_cities = height*width  # desired number of cities (currently one city per cell)
+    init_spending_levels = np.random.randint(1, 21, num_cities)  # city spending levels
+    preferences = np.random.randint(1,21, num_residents)  # resident preferences
+    min_gap = 5*num_residents  # minimum total gap between spending and preferences that will make the model stop
+    # create model, recording spending levels (for plotting every city) and summary statistics (mean and variance)
+    model = MiniModel(num_residents, height, width, num_cities, init_spending_levels, preferences, min_gap,
+                      collect=('full', 'summary'))
+
+
+    ######## Run model and examine result
+    steps = 10  # max number of steps the model will take
+
+    ## Run model for 20 steps
+    for step in range(steps):  # take 20 steps
+        model.step()  # model/agents take a step
+        model_out = model.datacollector.get_model_vars_dataframe()  # collect info from model
+        print(model_out.gap)  # print the total gap at that step
+
+    model_out.gap.plot()  # plot the total gap over time
+
+    # recorded spending levels are a num of steps by num of cities array
+    spending_matrix = np.vstack([init_spending_levels, model.recorder.spending])  # add original spending preferences as first row of matrix
+    spending_df = pd.DataFrame(spending_matrix)  # convert back to data frame
+    spending_df.plot(legend=False, alpha=0.1, color='blue')  # use plotting to show spending levels over time
+    # mean spending and variance in spending at each step, computed by the model as cities stepped
+    spending_summary = model.summary.to_frame()[['spending_mean', 'spending_var']]
+    spending_summary.columns = ['mean', 'variance']  # name columns
+
+    spending_summary['mean'].plot(color='black')  # plot mean spending
+    spending_summary['variance'].plot()  # plot variance in spending
+    spending_summary['mean'].iloc[-1]  # mean spending at the last step
+    np.mean(preferences)  # compare to mean resident preference
+
+    ## Run model until the gap falls low enough or it reaches 20 steps
+    while model.running and model.schedule.steps < steps:  # run until gap falls below a threshold, or for N steps
+        model.step()  # model/agents take a step
+        model_out = model.datacollector.get_model_vars_dataframe()  # collect info from model
+        print(model_out.gap)  # print the total gap at that step
+
+    print(model.schedule.steps)  # how many steps did the model take
+    model_out.gap.plot()  # plot gap over time
 
+    spending_matrix = np.vstack([init_spending_levels, model.recorder.spending])  # add original spending preferences as first row of matrix
+    spending_df = pd.DataFrame(spending_matrix)  # convert back to data frame
+    spending_df.plot(legend=False, alpha=0.1, color='blue')  # use plotting to show spending levels over time
+    # mean spending and variance in spending at each step, computed by the model as cities stepped
+    spending_summary = model.summary.to_frame()[['spending_mean', 'spending_var']]
+    spending_summary.columns = ['mean', 'variance']  # name columns
 
-############ Set Model Parameters
-random.seed(123)  # set seed for reproducible randomness
-np.random.seed(123)  # set seed for reproducible randomness
-num_residents = 300  # desired number of residents
-height = 10  # height of grid
-width = 10  # width of grid
-num_cities = height*width  # desired number of cities (currently one city per cell)
-init_spending_levels = np.random.randint(1, 21, num_cities)  # city spending levels
-preferences = np.random.randint(1,21, num_residents)  # resident preferences
-min_gap = 5*num_residents  # minimum total gap between spending and preferences that will make the model stop
-# create model
-model = MiniModel(num_residents, height, width, num_cities, init_spending_levels, preferences, min_gap)
-
-
-######## Run model and examine result
-steps = 10  # max number of steps the model will take
-
-## Run model for 20 steps
-for step in range(steps):  # take 20 steps
-    model.step()  # model/agents take a step
-    model_out = model.datacollector.get_model_vars_dataframe()  # collect info from model
-    print(model_out.gap)  # print the total gap at that step
-
-model_out.gap.plot()  # plot the total gap over time
-
-# spending levels is a series of identical lists, one for each step with every spending level that occurred
-df = pd.DataFrame(model_out.spending_levels)  # extract spending levels from model output as a data frame
-row1 = pd.DataFrame(df['spending_levels'].iloc[0])  # get just the first row, since all rows are identical
-spending_matrix = np.reshape(row1.values, (model.schedule.steps, num_cities))  # reshape that row into a num of steps by num of cities array
-spending_matrix = np.vstack([init_spending_levels, spending_matrix])  # add original spending preferences as first row of matrix
-spending_df = pd.DataFrame(spending_matrix)  # convert back to data frame
-spending_df.plot(legend=False, alpha=0.1, color='blue')  # use plotting to show spending levels over time
-# calculate mean spending and variance in spending at each step
-spending_summary = pd.DataFrame(zip(spending_df.mean(axis=1), spending_df.var(axis=1)))
-spending_summary.columns = ['mean', 'variance']  # name columns
-
-spending_summary['mean'].plot(color='black')  # plot mean spending
-spending_summary['variance'].plot()  # plot variance in spending
-spending_summary['mean'][20]
-np.mean(preferences)  # compare to mean resident preference
-
-## Run model until the gap falls low enough or it reaches 20 steps
-while model.running and model.schedule.steps < steps:  # run until gap falls below a threshold, or for N steps
-    model.step()  # model/agents take a step
-    model_out = model.datacollector.get_model_vars_dataframe()  # collect info from model
-    print(model_out.gap)  # print the total gap at that step
-
-print(model.schedule.steps)  # how many steps did the model take
-model_out.gap.plot()  # plot gap over time
-
-df = pd.DataFrame(model_out.spending_levels)  # extract spending levels from model output as a data frame
-row1 = pd.DataFrame(df['spending_levels'].iloc[0])  # get just the first row, since all rows are identical
-spending_matrix = np.reshape(row1.values, (model.schedule.steps, num_cities))  # reshape that row into a num of steps by num of cities array
-spending_matrix = np.vstack([init_spending_levels, spending_matrix])  # add original spending preferences as first row of matrix
-spending_df = pd.DataFrame(spending_matrix)  # convert back to data frame
-spending_df.plot(legend=False, alpha=0.1, color='blue')  # use plotting to show spending levels over time
-# calculate mean spending and variance in spending at each step
-spending_summary = pd.DataFrame(zip(spending_df.mean(axis=1), spending_df.var(axis=1)))
-spending_summary.columns = ['mean', 'variance']  # name columns
-
-spending_summary['mean'].plot(color='black')  # plot mean spending
-spending_summary['variance'].plot()  # plot variance in spending
-spending_summary['mean'][20]
-np.mean(preferences)  # compare to mean resident preference
\ No newline at end of file
+    spending_summary['mean'].plot(color='black')  # plot mean spending
+    spending_summary['variance'].plot()  # plot variance in spending
+    spending_summary['mean'].iloc[-1]  # mean spending at the last step
+    np.mean(preferences)  # compare to mean resident preference
+    model.close()
@@ -0,0 +1,45 @@
+'''
+Model registry: the models the runner, checkpoints, benchmarks and servers know, and loading them by name
+'''
+################### Table of Contents ######################
+'''
+0. Required packages
+1. MODELS: Models by name
+2. load_model_module, load_model_class: Import a model's module or class (the Mini and Schelling scripts are loaded
+   from their files)
+
+Kept apart from Batch_Runner.py and Checkpoint.py so each can find models without importing the other.
+Nothing here imports a model until it is asked for, so importing this module costs nothing.
+'''
+#############################################################
+# 0 Required Packages
+import importlib
+import importlib.util
+import os
+import sys
+
+##### 1. MODELS: Models by name
+# name: (module, file the module is loaded from if it can't be imported by name, model class, per-step reporter)
+MODELS = {
+    'multigrid': ('Multigrid_Tiebout_ABM', None, 'multigridmodel', 'gap'),
+    'mini': ('Mini_Tiebout_ABM', 'Mini Tiebout ABM.py', 'MiniModel', 'gap'),
+    'schelling': ('Schelling_ABM_replication', 'Schelling ABM replication.py', 'SchellingModel', 'happy'),
+}
+
+
+##### 2. load_model_module, load_model_class: Import a model's module or class
+def load_model_module(name):
+    module_name, filename, _, _ = MODELS[name]
+    if module_name in sys.modules:
+        return sys.modules[module_name]
+    if filename is None:
+        return importlib.import_module(module_name)
+    # script file names have spaces, so load them from their path (their experiments only run as __main__)
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(os.path.dirname(os.path.abspath(__file__)), filename))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    return module
+
+def load_model_class(name):
+    return getattr(load_model_module(name), MODELS[name][2])
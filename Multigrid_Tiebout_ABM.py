@@ -1,5 +1,4 @@
 '''Nathaniel Flemming 28/2/23'''
-import numpy
 #  Agent Based Modeling package imports
 from mesa import Model, Agent
 from mesa.time import BaseScheduler, RandomActivation, SimultaneousActivation
@@ -7,56 +6,353 @@ from mesa.space import MultiGrid
 from mesa.datacollection import DataCollector
 import random
 import numpy as np
-import pandas as pd
 import Agents as ag
+from Array_Engine import ArrayEngine, window_tables, window_any, neighborhood_aggregate
+from Aggregation import get_aggregator
+from Tiled_Engine import TiledEngine
+from City_Index import CityIndex, SEARCH_RADIUS
+from Recorder import make_collectors, gap_span
+from Profiler import StepProfiler
+from Steady_State import StateHistory, position_key, position_hash, spending_digest
+from Scenarios import place_agents, make_scenario
 
 
 #  initialize model
 class multigridmodel(Model):
-    def __init__(self, residents, height, width, num_cities, init_spending_lvls, resident_preferences, resident_resources, min_gap):
+    # engine: 'agents' steps Resident/City agents through the schedule, 'array' steps them as whole arrays (Array_Engine.py),
+    #   'tiled' splits the grid into strips stepped by worker processes (Tiled_Engine.py)
+    # tiles: number of strips (and worker processes) for the tiled engine, None for a fixed default (Tiled_Engine.py)
+    # collect: 'full' records every city's spending at every step, 'summary' only per-step summary statistics
+    #   in constant memory (for very long runs), or both, e.g. ('full', 'summary') (Recorder.py); add 'positions' to
+    #   record every resident's cell at every step too, for rendering runs offline (Offline_Renderer.py)
+    # record_path: directory to stream recorded spending levels and gap to (Recorder.py), None to keep them in memory
+    # aggregation: how cities turn neighbors' preferences into spending, 'weighted_mean' (by resources), 'mean',
+    #   'median', 'mode', 'trimmed_mean' or a kernel (Aggregation.py); the tiled engine only does 'weighted_mean'
+    # activation: 'sequential' steps each agent in turn (decide and act), 'simultaneous' has all residents decide from
+    #   one snapshot of spending, then applies their moves, then has all cities decide from one snapshot of the new
+    #   occupancy, then update (the array and tiled engines always work this way)
+    # active_set: (agents engine) only step residents whose window saw a spending change or whose cell saw a move
+    #   last step, and cities whose neighborhood saw a move; the rest aren't visited, they keep their last gap or
+    #   spending (same moves and spending; the gap is a running total over residents' last gaps, so it can differ
+    #   from a full step's sum in the last bits)
+    # search: (agents engine) how residents find the smallest gap in their window, 'scan' computes the gap to every
+    #   city in it, 'index' asks a tiled index over city spending (City_Index.py) when the search radius is
+    #   SEARCH_RADIUS or more, much faster for wide windows (same results)
+    # max_period: also stop at a fixed point (state same as a step before) or a cycle of up to max_period steps,
+    #   from fingerprints of resident positions and city spending (Steady_State.py); None to only stop on min_gap
+    #   (why a run stopped is in model.stop_reason: 'min_gap', 'fixed_point' or 'cycle', with model.cycle_period)
+    # profile: time the resident, city and collection phases of every step and count hot-path work (Profiler.py),
+    #   as a per-step table from model.profiler.to_frame()
+    # resident_positions: (residents, 2) starting x and y of every resident (e.g. from Scenarios.py), None to place them
+    #   at random cells drawn from the model's random number generator
+    # seed: seed for the model's random number generator (picked up by mesa's Model.__new__)
+    # call model.close() when done with a model that records to disk, profiles or uses the tiled engine
+    def __init__(self, residents, height, width, num_cities, init_spending_lvls, resident_preferences, resident_resources, min_gap,
+                 engine='agents', tiles=None, aggregation='weighted_mean', activation='sequential', active_set=False, search='scan', max_period=None, collect='full',
+                 record_path=None, profile=False, resident_positions=None, seed=None):
         self.num_residents = residents
         self.height = height
         self.width = width
         self.num_cities = num_cities
         self.init_spending_lvls = init_spending_lvls
-        self.resident_preferences = resident_preferences
+        # every resident's preferences in one contiguous array (compact integers), Resident.preferences are views of its rows
+        self.resident_preferences = ag.compact_prefs(resident_preferences)
         self.resident_resources = resident_resources
+        self.resident_positions = resident_positions
         self.min_gap = min_gap
         self.schedule = BaseScheduler(self)  # schedule for which Resident and city moves when, they activate in order
         self.grid = MultiGrid(width, height, torus=True)  # set torus so no edge
         self.gap = 0  # start at 0 spending-preference gap, will check agent city gap
-        self.spending_levels = []  # create empty spending levels list to track updated spending levels\
-        self.datacollector = DataCollector({"gap": lambda m: m.gap, "spending_levels": lambda m: m.spending_levels})
+        self.movers = 0  # number of residents that moved this step
+        self.record_path = record_path  # where recordings stream to (None: in memory), kept for checkpoints
+        # recorder keeps every city's spending levels and the gap at each step, in arrays instead of a growing list
+        # summary keeps per-step statistics only (either can be None, depending on collect)
+        self.recorder, self.summary = make_collectors(collect, np.shape(init_spending_lvls),
+                                                      gap_span(resident_preferences, init_spending_lvls), path=record_path,
+                                                      num_residents=residents)
+        self.datacollector = DataCollector({"gap": lambda m: m.gap})
+        self.profiler = StepProfiler(path=record_path) if profile else None  # per-step phase times and counters, if profiling
         self.running = True  # whether ABM is still running
+        self.stop_reason = None  # why the model stopped running
+        self.cycle_period = None  # steps between repeats of the state, if it stopped at a fixed point or cycle
+        self.history = StateHistory(max_period) if max_period else None  # recent state fingerprints, if watching for repeats
+        self.position_hash = 0  # hash of resident positions, kept up to date as residents move (agents engine)
+        if activation not in ('sequential', 'simultaneous'):
+            raise ValueError("activation must be 'sequential' or 'simultaneous'")
+        self.activation = activation
+        get_aggregator(aggregation)  # check it's a known kernel
+        if engine == 'tiled' and aggregation != 'weighted_mean':
+            raise ValueError("the tiled engine only does aggregation='weighted_mean'")
+        self.aggregation = aggregation
+        self.neighborhood_aggregates = {}  # aggregation: (aggregated preferences around every cell, counts), see get_neighborhood_aggregates
+        self.occupancy_version = 0  # counts changes to resident positions, so cached aggregates know when they're stale
+        self.aggregates_version = 0  # occupancy_version the cached aggregates were made at
+        if active_set and engine != 'agents':
+            raise ValueError("active_set needs engine='agents'")
+        # cells whose occupancy changed in the resident phase and whose spending changed in the city phase, for
+        # active-set scheduling (None otherwise)
+        self.occupancy_changed = np.zeros((width, height), dtype=bool) if active_set else None
+        self.spending_changed = np.zeros((width, height), dtype=bool) if active_set else None
+        # running total of every resident's last gap, and their histogram for the summary (active-set scheduling)
+        self.gap_total = 0.0
+        self.gap_counts = np.zeros_like(self.summary.gap_counts) if active_set and self.summary is not None else None
+        if search not in ('scan', 'index'):
+            raise ValueError("search must be 'scan' or 'index'")
+        if search == 'index' and engine != 'agents':
+            raise ValueError("search='index' needs engine='agents'")
+        self.search = search
+        self.city_index = None  # index over city spending, made the first time a resident needs it
+        self.spending_version = 0  # counts changes to city spending, so the index knows when it's stale
+        self.index_version = 0  # spending_version the index was refreshed at
+        self.engine = None  # array engine, if used
+        self.residents = []  # residents in schedule order
+        # every resident's x and y, in resident order, kept up to date as residents move (agents engine)
+        self.resident_x = self.resident_y = None
+        self.cities = []  # cities by flat cell index (x * height + y, coord_iter order)
+        # every city's spending in one array, by flat cell index, City.spending_levels are views of its rows (agents engine)
+        self.city_spending = np.array(init_spending_lvls, dtype=float).reshape(num_cities, -1)
+        self.window_tables = {}  # torus window index tables, one per resident resources (search radius), shared by all residents
+        # running per-cell sums over the residents in each cell, kept up to date as residents move, so cities don't
+        # have to visit their neighbors every step
+        # (at least int64, so compact preferences don't overflow when summed)
+        prefs_dtype = np.result_type(self.resident_preferences, np.asarray(resident_resources), np.int64)
+        num_prefs = np.shape(resident_preferences)[1]
+        self.cell_counts = np.zeros((width, height), dtype=int)  # residents per cell
+        self.cell_resources = np.zeros((width, height), dtype=np.asarray(resident_resources).dtype)  # total resources
+        self.cell_prefs = np.zeros((width, height, num_prefs), dtype=prefs_dtype)  # summed preferences
+        self.cell_weighted_prefs = np.zeros((width, height, num_prefs), dtype=prefs_dtype)  # summed resource-weighted preferences
 
-        #  Create Resident agents
+        if engine == 'array':  # residents and cities live in arrays instead of agents, schedule stays empty
+            self.engine = ArrayEngine(self)
+        elif engine == 'tiled':  # the same, in parallel over strips of the grid
+            self.engine = TiledEngine(self, tiles)
+        elif engine == 'agents':
+            self.create_agents()
+        else:
+            raise ValueError("engine must be 'agents', 'array' or 'tiled'")
+        if self.summary is not None:  # starting spending as the summary's first row
+            self.summary.initial_row(init_spending_lvls, np.unique(self.resident_cells()).size)
+        if self.history is not None:
+            self.history.add(self.fingerprint())  # starting state, so a first step that changes nothing is a fixed point
+
+    def starting_cells(self):  # every resident's starting x and y, as arrays
+        if self.resident_positions is not None:
+            positions = np.asarray(self.resident_positions).reshape(-1, 2)
+            return positions[:, 0].astype(np.intp), positions[:, 1].astype(np.intp)
+        x = np.empty(self.num_residents, dtype=np.intp)
+        y = np.empty(self.num_residents, dtype=np.intp)
+        for i in range(self.num_residents):  # random cells, x then y for each resident in turn
+            x[i] = self.random.randrange(self.width)
+            y[i] = self.random.randrange(self.height)
+        return x, y
+
+    def create_agents(self):
+        #  Create Resident agents (their preferences are already in their rows of resident_preferences)
         #  Because residents are added to the schedule first, they will move first, since agents activate in order
-        for i in range(self.num_residents):
-            #  set place on grid (random)
-            x = self.random.randrange(self.grid.width)
-            y = self.random.randrange(self.grid.height)
-            resident = ag.Resident(i, self, self.resident_preferences[i], self.resident_resources[i])  # agent w/ given params
-            self.grid.place_agent(resident, (x, y))  # place agent on grid
+        x, y = self.starting_cells()
+        self.residents = [ag.Resident(i, self, None, self.resident_resources[i]) for i in range(self.num_residents)]
+        place_agents(self.grid, self.residents, x, y)  # place all of them on the grid at once
+        self.resident_x, self.resident_y = x.copy(), y.copy()
+        self.add_cell_sums(x, y)  # count residents in their cells
+        for resident in self.residents:
             self.schedule.add(resident)  # add agent to schedule
 
-        #  create City agents
-        k = 0
-        id = i + 1  # create unique resident ids starting where cities leave off
-        for cell in self.grid.coord_iter():  # iterate through grid coordinates
-            x = cell[1]  # cell's x coordinate
-            y = cell[2]  # cell's y coordinate
-            city = ag.City(id, self, self.init_spending_lvls[k])  # create cities and assign spending
-            self.grid.place_agent(city, (x, y))  # place agent on grid at random location
+        #  create City agents, one per cell in coord_iter order (their spending is already in city_spending)
+        #  with unique ids starting where residents leave off
+        self.cities = [ag.City(self.num_residents + k, self, None, row=k) for k in range(self.num_cities)]
+        cells = np.arange(self.num_cities)
+        place_agents(self.grid, self.cities, cells // self.height, cells % self.height)
+        for city in self.cities:
             self.schedule.add(city)  # add agent to schedule
-            k += 1  # increment spending index
-            id += 1  # increment city id index
+
+    def add_cell_sums(self, x, y):  # count every resident in its cell at once (update_cell_sums for all residents)
+        self.occupancy_version += 1
+        if self.history is not None:
+            self.position_hash ^= position_hash(np.arange(len(x)), x * self.height + y)
+        if self.occupancy_changed is not None:
+            self.occupancy_changed[x, y] = True
+        resources = np.asarray(self.resident_resources)
+        np.add.at(self.cell_counts, (x, y), 1)
+        np.add.at(self.cell_resources, (x, y), resources)
+        np.add.at(self.cell_prefs, (x, y), self.resident_preferences)
+        np.add.at(self.cell_weighted_prefs, (x, y),
+                  np.multiply(resources[:, None], self.resident_preferences, dtype=self.cell_weighted_prefs.dtype))
+
+    def get_window_tables(self, radius):  # window index tables for a search radius, built the first time they're needed
+        if radius not in self.window_tables:
+            self.window_tables[radius] = window_tables(radius, self.width, self.height)
+        return self.window_tables[radius]
+
+    def get_city_index(self, radius):  # index over city spending for a search radius (None if residents scan instead)
+        if self.search != 'index' or radius < SEARCH_RADIUS:
+            return None
+        if self.city_index is None:
+            self.city_index = CityIndex(self.city_spending, self.width, self.height)
+        elif self.index_version != self.spending_version:  # spending changed since the last refresh
+            self.city_index.refresh()
+        self.index_version = self.spending_version
+        return self.city_index
+
+    def update_cell_sums(self, resident, sign):  # add (sign=1) or remove (sign=-1) a resident from its cell's sums
+        x, y = resident.pos
+        self.occupancy_version += 1
+        if self.history is not None:  # moving in or out of a cell XORs the same key
+            self.position_hash ^= position_key(resident.unique_id, x * self.height + y)
+        if self.occupancy_changed is not None:
+            self.occupancy_changed[x, y] = True  # tell cities around here (active-set scheduling)
+        self.cell_counts[x, y] += sign
+        self.cell_resources[x, y] += sign * resident.resources
+        self.cell_prefs[x, y] += sign * resident.preferences
+        self.cell_weighted_prefs[x, y] += sign * np.multiply(resident.resources, resident.preferences, dtype=self.cell_weighted_prefs.dtype)
+
+    def move_resident(self, resident, pos):  # move a resident on the grid, keeping the per-cell sums up to date
+        self.update_cell_sums(resident, -1)
+        self.grid.move_agent(resident, pos)
+        self.resident_x[resident.row], self.resident_y[resident.row] = pos
+        self.update_cell_sums(resident, 1)
+        self.movers += 1
+
+    def replace_gap(self, old, new):  # swap a resident's last gap (None before its first) for its new one in the running totals
+        if old is not None:
+            self.gap_total -= old
+            if self.gap_counts is not None:
+                self.gap_counts[self.summary.gap_bin(old)] -= 1
+        self.gap_total += new
+        if self.gap_counts is not None:
+            self.gap_counts[self.summary.gap_bin(new)] += 1
+
+    def reset_gap_totals(self):  # running totals from every resident's last gap (e.g. after restoring a checkpoint)
+        self.gap_total = 0.0
+        if self.gap_counts is not None:
+            self.gap_counts[:] = 0
+        for resident in self.residents:
+            if resident.current_gap is not None:
+                self.replace_gap(None, resident.current_gap)
+
+    def count_occupied(self):  # number of cities with at least one resident
+        if self.engine is not None:
+            return self.engine.occupied
+        return np.count_nonzero(self.cell_counts)
+
+    def resident_cells(self):  # every resident's flat cell index (x * height + y), in resident order
+        if self.engine is None:
+            x, y = self.resident_x, self.resident_y
+        else:
+            x, y = self.engine.gather() if hasattr(self.engine, 'gather') else (self.engine.x, self.engine.y)
+        return x * self.height + y
+
+    def get_spending_levels(self):  # current spending of every city, one row per city in coord_iter order
+        if self.engine is not None:
+            return self.engine.spending.reshape(self.num_cities, -1)
+        return self.city_spending  # the model's own array, not a copy
+
+    def get_neighborhood_aggregates(self, aggregation):  # aggregated neighbor preferences for every city at once (agents engine)
+        # cities only read resident positions, so one batch serves every city until somebody moves
+        if self.aggregates_version != self.occupancy_version:
+            self.neighborhood_aggregates = {}
+            self.aggregates_version = self.occupancy_version
+        if aggregation not in self.neighborhood_aggregates:
+            x, y = self.resident_x, self.resident_y
+            self.neighborhood_aggregates[aggregation] = neighborhood_aggregate(
+                get_aggregator(aggregation), x, y, self.resident_preferences.reshape(len(x), -1),
+                np.asarray(self.resident_resources), self.width, self.height)
+        return self.neighborhood_aggregates[aggregation]
+
+    def close(self):  # close the recording files and stop the tiled engine's workers (recordings stay readable)
+        for collector in (self.recorder, self.summary, self.profiler):
+            if collector is not None:
+                collector.close()
+        if self.engine is not None and hasattr(self.engine, 'close'):
+            self.engine.close()
+
+    def fingerprint(self):  # hashes of resident positions and city spending
+        position_hash = self.position_hash if self.engine is None else self.engine.position_hash()
+        return position_hash, spending_digest(self.get_spending_levels())
+
+    def active_residents(self):  # which residents have to step (active-set scheduling), in resident order
+        # (a mask over every resident, made in NumPy from the position arrays; only the active ones are visited)
+        x, y = self.resident_x, self.resident_y
+        radii = np.asarray(self.resident_resources)
+        active = self.occupancy_changed[x, y].copy()  # moved, or someone moved in or out of their cell
+        for radius in np.unique(radii):  # spending changed somewhere in their window
+            mine = radii == radius
+            active[mine] |= window_any(self.spending_changed, radius)[x[mine], y[mine]]
+        return active
+
+    def active_cities(self):  # which cities have to step: someone moved in or out of their neighborhood
+        return window_any(self.occupancy_changed, 1).ravel()  # coord_iter order, like self.cities
+
+    def step_phase(self, agents, active=None):  # step residents or cities (only the active ones, if given)
+        stepping = agents if active is None else [agents[i] for i in np.flatnonzero(active)]
+        if self.activation == 'simultaneous':  # all decide from the same state, then all act
+            for agent in stepping:
+                agent.decide()
+            for agent in stepping:
+                agent.advance()
+        else:
+            for agent in stepping:
+                agent.step()
 
     def step(self):  # run model, has agents move and update
         self.gap = 0  # reset gap
-        self.schedule.step()  # agents take step
-        self.datacollector.collect(self)  # collect data at each step, from instance of class
+        self.movers = 0  # reset movers
+        profiler = self.profiler
+        if self.summary is not None:
+            self.summary.start_step()  # agents add their gaps and spending to the summary as they step
+        if profiler is not None:
+            profiler.start_step()
+        if self.engine is not None:
+            self.engine.step()  # residents and cities update as whole arrays (the engine times its own phases)
+        active_set = self.occupancy_changed is not None
+        if self.engine is not None or (profiler is None and self.activation == 'sequential' and not active_set):
+            self.schedule.step()  # agents take step (under the array engine the schedule is empty and this just counts the step)
+        else:  # same order as the schedule (residents, then cities), one phase at a time (timed when profiling)
+            if profiler is not None:
+                profiler.start('residents')
+            active = None
+            if active_set:  # find who has to step from last step's changes, then start recording this step's
+                if self.schedule.steps > 0:  # everyone steps the first time
+                    active = self.active_residents()
+                self.occupancy_changed[:] = False
+            self.step_phase(self.residents, active)
+            if profiler is not None:
+                profiler.stop('residents')
+                profiler.start('cities')
+            if active_set:
+                if self.schedule.steps > 0:
+                    active = self.active_cities()
+                self.spending_changed[:] = False
+            self.step_phase(self.cities, active)
+            if profiler is not None:
+                profiler.stop('cities')
+            self.schedule.steps += 1  # what schedule.step() does after stepping the agents
+            self.schedule.time += 1
+        if active_set:  # residents and cities that didn't step keep their last gap and spending
+            self.gap = self.gap_total
+            if self.summary is not None:
+                self.summary.add_gap_counts(self.gap_counts)
+                self.summary.add_spending_block(np.reshape(self.city_spending, (-1,) + self.summary.spending_stats.shape))
+        if profiler is not None:
+            profiler.start('collect')
+        if self.recorder is not None:
+            positions = self.resident_cells() if self.recorder.records_positions else None
+            self.recorder.record(self.get_spending_levels(), self.gap, positions)  # record spending levels and gap (and positions)
+        self.datacollector.collect(self)  # collect the gap at each step, whatever else is collected
+        if self.summary is not None:
+            self.summary.end_step(self.gap, self.movers, self.count_occupied())  # add the step's summary statistics
+        if profiler is not None:
+            profiler.stop('collect')
+            profiler.count('moves', self.movers)
+            profiler.end_step()
         if self.gap < self.min_gap:  # check if gap is greater than some value
             self.running = False  # if gap small enough stop
+            self.stop_reason = 'min_gap'
+        elif self.history is not None:  # stop if the state repeats one of the last few
+            period = self.history.add(self.fingerprint())
+            if period is not None:
+                self.running = False
+                self.stop_reason = 'fixed_point' if period == 1 else 'cycle'
+                self.cycle_period = period
 
 
 if __name__ == '__main__':
@@ -64,39 +360,37 @@ if __name__ == '__main__':
     height = 5  # height of grid
     width = 5  # width of grid
     num_cities = height*width  # desired number of cities
-    preferences = np.random.randint(1, 21, size=[num_res, 4])  # resident preference array
-    resources = np.random.randint(0, 2, size=num_res)  # resident resources array (should really be correlated with preferences)
-    init_spending_lvls = np.random.randint(1, 21, size=[num_cities, 4])  # city spending levels array
+    # resident preferences and resources (correlated), city spending levels and starting cells, from one seed
+    # (Scenarios.py; the same call makes populations of millions)
+    scenario = make_scenario(num_res, width, height, num_prefs=4, seed=123)
+    init_spending_lvls = scenario['init_spending_lvls']  # city spending levels array
     min_gap = 5  # minimum total gap between spending and preferences that will make the model stop
     # (should scale to magnitude of preferences and spending)
-# create model
-    model = multigridmodel(num_res, height, width, num_cities, init_spending_lvls, preferences, resources, min_gap)
+# create model, recording spending and resident positions at every step (plots are drawn from the recording afterwards)
+    model = multigridmodel(min_gap=min_gap, collect=('full', 'positions'), **scenario)
 #    one city is made per cell (grid width x height)
 
     steps = 10  # max number of steps the model will take
     for step in range(steps):  # take 10 steps
         model.step()
         # print(model.schedule.steps)
-        model_out = model.datacollector.get_model_vars_dataframe()
-        #print(model_out.gap)
-        model_out.gap.plot()
-        '''for a single preference model spending levels is a series of identical lists, 
-        one for each step with every spending level that occurred.
-        For a multi preference model, spending levels is a series of lists of arrays. Each list is identical.
-        Each array is a city's spending levels. The lists lengths are thus the number of cities 
-         times the number of steps taken'''
-    df = pd.DataFrame(model_out.spending_levels)  # extract spending levels from model output as a data frame
-    row1 = pd.DataFrame(df.loc[0,'spending_levels'])  # get just the first row, since all rows are identical
-    #spending_matrix = np.reshape(row1.values, (steps, num_cities))  # reshape that row into a num of steps by num of cities array
-    #spending_matrix = np.vstack([spending_lvls, spending_matrix])  # add original spending preferences as first row of matrix
+    model_out = model.datacollector.get_model_vars_dataframe()
+    #print(model_out.gap)
+    model_out.gap.plot()  # plot the gap once, after stepping
+    # recorded spending levels are a (steps, num_cities, num preferences) array, one city's spending levels per row
+    spending_matrix = model.recorder.spending
+    spending_matrix = np.vstack([init_spending_lvls[np.newaxis], spending_matrix])  # add original spending levels as first step
 
     while model.running and model.schedule.steps < steps:  # run until gap falls below a threshold, or for N steps
         model.step()
-        model_out = model.datacollector.get_model_vars_dataframe()
-        # print(model_out.gap)
-        model_out.gap.plot()
+    model_out = model.datacollector.get_model_vars_dataframe()
+    # print(model_out.gap)
+    model_out.gap.plot()
     print(model.schedule.steps)  # how many steps did the model take
-    df = pd.DataFrame(model_out.spending_levels)  # extract spending levels from model output as a data frame
-    row1 = pd.DataFrame(df['spending_levels'].iloc[0])  # get just the first row, since all rows are identical
-    #spending_matrix = np.reshape(row1.values, (steps, num_cities))  # reshape that row into a num of steps by num of cities array
-    #spending_matrix = np.vstack([spending_lvls, spending_matrix])  # add original spending preferences as first row of matrix
+    spending_matrix = model.recorder.spending  # (steps, num_cities, num preferences) array of spending levels
+    spending_matrix = np.vstack([init_spending_lvls[np.newaxis], spending_matrix])  # add original spending levels as first step
+    # heatmap frames of every step, an animation of them and summary plots, drawn in worker processes (Offline_Renderer.py)
+    # into output/ (ignored by git, like every script's output)
+    from Offline_Renderer import render_run
+    render_run(model, 'output/multigrid_run')
+    model.close()
@@ -0,0 +1,302 @@
+'''
+Offline renderer for recorded runs: heatmap frames, animations and summary plots, in a worker pool
+'''
+################### Table of Contents ######################
+'''
+0. Required packages
+1. Settings: steps per frame task, figure size, colors
+2. RunHistory Class: A run's recorded spending, gap and resident positions (from a model or a recording directory)
+    2.1 from_model, from_path: Read a run's history
+    2.2 pick: The history of some of the steps (what a frame task gets)
+    2.3 layers: Spending on every preference, plus residents per cell, at one step
+3. survey: One pass over a run, its color scales and the series for the summary plots
+4. plot_summary: Gap, spending trajectories and movers over the run, as one image
+5. render_frames: Heatmap frames for a range of steps, drawn on one reused figure
+6. write_animation: Frames to an animated GIF (Pillow) or a video (ffmpeg)
+7. render_runs: Summaries, frames and animations for many runs, over one worker pool
+8. render_run: The same for one run
+
+Plotting while stepping (model_out.gap.plot() in the step loop) redraws a growing plot every step, so
+for sweeps it costs as much as simulating. Here runs are stepped with a recorder (collect='full', plus
+'positions' for resident density) and drawn afterwards, from the model or from the directory it
+recorded to (record_path). Everything is drawn in worker processes: first one task per run surveys the
+whole run (fixed color scales, so frames of a run can be compared, and the series for its summary
+plot), then frames are drawn in tasks of frames_per_task steps, and last every run's frames are put
+together into an animation. A frame task makes its figure once and for every step only swaps the
+image data and the title before saving, instead of building a new figure per frame.
+Tasks for runs recorded to disk carry only the recording's path and which steps to draw, and workers
+memory-map the arrays themselves; in-memory runs send just the steps a task draws.
+'''
+#############################################################
+# 0 Required Packages
+import multiprocessing as mp
+import os
+import shutil
+import subprocess
+import numpy as np
+from Recorder import load_recording, load_positions
+
+##### 1. Settings
+FRAMES_PER_TASK = 50  # steps a frame task draws (one figure each)
+PANEL_INCHES = 3.0  # width and height of one heatmap panel
+DPI = 100  # frame resolution
+FPS = 10  # animation frames per second
+COLORMAP = 'viridis'  # spending and resident density colors
+MAX_LINES = 200  # summary plots draw every city's spending up to this many cities, percentile bands above it
+FRAME_NAME = 'frame_%06d.png'  # frame file names, by step
+
+
+##### 2. RunHistory Class: A run's recorded spending, gap and resident positions
+class RunHistory:
+    # spending: (steps, num_cities[, P]) spending after every step, cities in coord_iter order (x * height + y)
+    # gap: (steps,) the model's gap after every step
+    # positions: (steps, num_residents) every resident's cell after every step, None if not recorded
+    # path: recording directory the arrays were memory-mapped from (None for in-memory arrays)
+    # rows: which of the recording's steps these are (row i is the run's step rows[i] + 1), None for all of them
+    def __init__(self, spending, gap, positions, width, height, path=None, rows=None):
+        self.spending = spending
+        self.gap = gap
+        self.positions = positions
+        self.width = width
+        self.height = height
+        self.path = path
+        self.rows = rows
+
+    # 2.1 from_model, from_path: Read a run's history
+    @classmethod
+    def from_model(cls, model):  # a multigridmodel or MiniModel that recorded with collect 'full' (and 'positions')
+        # (the model stays open: it's the caller's to step on or close)
+        if model.recorder is None:
+            raise ValueError("the model has no recorder, make it with collect='full' (and 'positions' for residents)")
+        if model.recorder.path is not None:  # already on disk, workers read it from there
+            model.recorder.flush()
+            return cls.from_path(model.recorder.path, model.width, model.height)
+        return cls(model.recorder.spending, model.recorder.gap, model.recorder.positions, model.width, model.height)
+
+    @classmethod
+    def from_path(cls, path, width, height):  # a model's record_path (the recording doesn't know the grid's shape)
+        spending, gap = load_recording(path)
+        return cls(spending, gap, load_positions(path), width, height, path=os.path.abspath(path))
+
+    def __len__(self):  # number of steps
+        return len(self.gap)
+
+    # 2.2 pick: The history of some of the steps (indices into this history, in order), read into memory
+    def pick(self, indices):
+        indices = np.asarray(indices, dtype=np.intp)
+        take = lambda values: None if values is None else np.asarray(values[indices])  # (reads only those rows)
+        rows = indices if self.rows is None else self.rows[indices]
+        return RunHistory(take(self.spending), take(self.gap), take(self.positions), self.width, self.height, self.path, rows)
+
+    def __getstate__(self):  # recorded to disk: send the path and rows, the worker maps the recording again
+        state = dict(self.__dict__)
+        if self.path is not None:
+            state['spending'] = state['gap'] = state['positions'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.path is not None:
+            whole = RunHistory.from_path(self.path, self.width, self.height)
+            picked = whole if self.rows is None else whole.pick(self.rows)
+            self.spending, self.gap, self.positions = picked.spending, picked.gap, picked.positions
+
+    @property
+    def num_prefs(self):
+        return 1 if self.spending.ndim == 2 else self.spending.shape[2]
+
+    def step_number(self, index):  # model step the index-th row of this history was recorded after
+        return (index if self.rows is None else self.rows[index]) + 1
+
+    # 2.3 layers: Spending on every preference (P, width, height), plus residents per cell (width, height) or None
+    def layers(self, index):
+        spending = np.asarray(self.spending[index], dtype=float).reshape(self.width, self.height, -1)
+        counts = None
+        if self.positions is not None:
+            counts = np.bincount(self.positions[index], minlength=self.width * self.height).reshape(self.width, self.height)
+        return np.moveaxis(spending, -1, 0), counts
+
+
+##### 3. survey: One pass over a run, its color scales and the series for the summary plots
+# returns {'scales': (spending low, high, most residents in a cell), 'series': {name: per-step values}}
+def survey(history, block=FRAMES_PER_TASK):
+    steps, num_prefs = len(history), history.num_prefs
+    low, high, most = np.inf, -np.inf, 1
+    mean, bands = np.empty((steps, num_prefs)), np.empty((steps, 2, num_prefs))  # mean, and 10th/90th percentiles
+    movers = np.full(steps, np.nan)  # residents whose cell changed since the step before (unknown for the first)
+    occupied = np.full(steps, np.nan)
+    for start in range(0, steps, block):  # a block of steps at a time, so memory-mapped runs aren't read in at once
+        stop = min(start + block, steps)
+        spending = np.asarray(history.spending[start:stop], dtype=float).reshape(stop - start, -1, num_prefs)
+        low, high = min(low, spending.min(initial=np.inf)), max(high, spending.max(initial=-np.inf))
+        mean[start:stop] = spending.mean(axis=1)
+        bands[start:stop] = np.moveaxis(np.percentile(spending, [10, 90], axis=1), 0, 1)
+        if history.positions is not None:
+            before = 1 if start > 0 else 0  # (with the step before, for movers)
+            positions = np.asarray(history.positions[start - before:stop])
+            movers[start + 1 - before:stop] = np.count_nonzero(positions[1:] != positions[:-1], axis=1)
+            for i, cells in enumerate(positions[before:], start=start):
+                counts = np.bincount(cells, minlength=history.width * history.height)
+                most = max(most, int(counts.max(initial=0)))
+                occupied[i] = np.count_nonzero(counts)
+    series = {'gap': np.asarray(history.gap, dtype=float), 'spending_mean': mean, 'spending_bands': bands}
+    if history.positions is not None:
+        series.update({'movers': movers, 'occupied': occupied})
+    return {'scales': (float(low), float(high), most), 'series': series}
+
+
+##### 4. plot_summary: Gap, spending trajectories and movers over the run, as one image
+def plot_summary(history, series, path):
+    import matplotlib  # only the workers draw, without a display
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    panels = 3 if 'movers' in series else 2
+    figure, axes = plt.subplots(1, panels, figsize=(5 * panels, 4), dpi=DPI)
+    steps = history.step_number(np.arange(len(history)))
+    axes[0].plot(steps, series['gap'], color='black')
+    axes[0].set(title='gap', xlabel='step')
+    num_cities = history.width * history.height
+    for p in range(history.num_prefs):  # every city's spending (like the scripts' spending plots), or bands for many cities
+        color = 'C%d' % p
+        if num_cities <= MAX_LINES:
+            spending = np.asarray(history.spending, dtype=float).reshape(len(history), num_cities, -1)[:, :, p]
+            axes[1].plot(steps, spending, color=color, alpha=0.1)
+        else:
+            axes[1].fill_between(steps, series['spending_bands'][:, 0, p], series['spending_bands'][:, 1, p], color=color,
+                                 alpha=0.2)
+        axes[1].plot(steps, series['spending_mean'][:, p], color=color, label='preference %d' % p)
+    axes[1].set(title='spending (mean%s)' % ('' if num_cities <= MAX_LINES else ', 10th to 90th percentile'), xlabel='step')
+    if history.num_prefs > 1:
+        axes[1].legend(fontsize='small')
+    if panels == 3:
+        axes[2].plot(steps, series['movers'], label='movers')
+        axes[2].plot(steps, series['occupied'], label='occupied cities')
+        axes[2].set(title='residents', xlabel='step')
+        axes[2].legend(fontsize='small')
+    figure.tight_layout()
+    figure.savefig(path)
+    plt.close(figure)
+    return path
+
+
+##### 5. render_frames: Heatmap frames for a range of steps, drawn on one reused figure
+# scales: from survey, fixed for the whole run; returns the frame paths
+def render_frames(history, out_dir, scales):
+    import matplotlib  # only the workers draw, without a display
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    low, high, most = scales
+    spending, counts = history.layers(0)
+    names = ['spending' if len(spending) == 1 else 'spending %d' % p for p in range(len(spending))]
+    layers = list(spending) + ([] if counts is None else [counts])
+    if counts is not None:
+        names.append('residents')
+    figure, axes = plt.subplots(1, len(layers), figsize=(PANEL_INCHES * len(layers), PANEL_INCHES + 0.5), dpi=DPI,
+                                squeeze=False)
+    images = []
+    for axis, name, layer in zip(axes[0], names, layers):  # x across, y up (like the grid and the live server)
+        scale = (0, most) if name == 'residents' else (low, high)
+        images.append(axis.imshow(layer.T, origin='lower', cmap=COLORMAP, vmin=scale[0], vmax=scale[1],
+                                  interpolation='nearest'))
+        axis.set_title(name, fontsize='small')
+        axis.set_xticks([])
+        axis.set_yticks([])
+        figure.colorbar(images[-1], ax=axis, fraction=0.046, pad=0.02)
+    title = figure.suptitle('')
+    paths = []
+    for index in range(len(history)):  # from here on only the image data and the title change
+        spending, counts = history.layers(index)
+        for image, layer in zip(images, list(spending) + ([] if counts is None else [counts])):
+            image.set_data(layer.T)
+        step = history.step_number(index)
+        title.set_text('step %d' % step)
+        paths.append(os.path.join(out_dir, FRAME_NAME % step))
+        figure.savefig(paths[-1])
+    plt.close(figure)
+    return paths
+
+
+##### 6. write_animation: Frames to an animated GIF (Pillow) or a video (ffmpeg, any other extension)
+def find_encoder(path):  # ffmpeg, for animations that aren't GIFs
+    ffmpeg = shutil.which('ffmpeg')
+    if ffmpeg is None:
+        raise ValueError('animation %r needs ffmpeg on the PATH (or give a .gif name)' % path)
+    return ffmpeg
+
+def write_animation(frames, path, fps=FPS):
+    if path.lower().endswith('.gif'):
+        from PIL import Image  # comes with matplotlib
+        images = (Image.open(frame) for frame in frames)  # opened one at a time as the GIF is written
+        first = next(images)
+        first.save(path, save_all=True, append_images=images, duration=int(1000 / fps), loop=0)
+        return path
+    ffmpeg = find_encoder(path)
+    listing = path + '.frames.txt'  # frame list for ffmpeg's concat reader (the frames needn't be numbered 1, 2, ...)
+    with open(listing, 'w') as file:
+        file.writelines("file '%s'\nduration %g\n" % (os.path.abspath(frame), 1 / fps) for frame in frames)
+    try:
+        subprocess.run([ffmpeg, '-y', '-loglevel', 'error', '-f', 'concat', '-safe', '0', '-i', listing,
+                        '-pix_fmt', 'yuv420p', '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', path], check=True)
+    finally:
+        os.remove(listing)
+    return path
+
+
+##### 7. render_runs: Summaries, frames and animations for many runs, over one worker pool
+def _survey_task(args):
+    out_dir, history, summary = args
+    surveyed = survey(history)
+    if summary:
+        surveyed['summary'] = plot_summary(history, surveyed['series'], os.path.join(out_dir, 'summary.png'))
+    return out_dir, surveyed
+
+def _frames_task(args):
+    out_dir, history, scales = args
+    return out_dir, render_frames(history, out_dir, scales)
+
+def _animation_task(args):
+    out_dir, frames, name, fps = args
+    return out_dir, write_animation(frames, os.path.join(out_dir, name), fps)
+
+# histories: {output directory: RunHistory}, e.g. one directory per sweep run
+# frames: draw heatmap frames (every `every` steps), animation: file name for them (.gif, or any video type with ffmpeg),
+#   None for no animation; summary: draw summary.png
+# returns {output directory: {'scales': ..., 'series': ..., 'summary': path, 'frames': [paths], 'animation': path}}
+def render_runs(histories, frames=True, every=1, animation='run.gif', summary=True, fps=FPS, processes=None,
+                frames_per_task=FRAMES_PER_TASK):
+    if frames and animation and not animation.lower().endswith('.gif'):
+        find_encoder(animation)  # before drawing anything
+    for out_dir in histories:
+        os.makedirs(out_dir, exist_ok=True)
+    with mp.Pool(processes) as pool:
+        results = dict(pool.imap_unordered(_survey_task, [(out_dir, history, summary)
+                                                          for out_dir, history in histories.items()]))
+        if not frames:
+            return results
+        tasks = []
+        for out_dir, history in histories.items():
+            results[out_dir]['frames'] = []
+            steps = np.arange(every - 1, len(history), every)  # every `every`th step
+            for start in range(0, len(steps), frames_per_task):
+                chunk = steps[start:start + frames_per_task]
+                # recorded to disk the task carries only the path and rows, in memory only the rows it draws
+                part = RunHistory(None, None, None, history.width, history.height, history.path,
+                                  chunk if history.rows is None else history.rows[chunk])
+                if history.path is None:
+                    part = history.pick(chunk)
+                tasks.append((out_dir, part, results[out_dir]['scales']))
+        for out_dir, paths in pool.imap_unordered(_frames_task, tasks):
+            results[out_dir]['frames'].extend(paths)
+        for result in results.values():
+            result['frames'].sort()  # (frame names sort by step)
+        if animation:
+            tasks = [(out_dir, result['frames'], animation, fps) for out_dir, result in results.items() if result['frames']]
+            for out_dir, path in pool.imap_unordered(_animation_task, tasks):
+                results[out_dir]['animation'] = path
+    return results
+
+
+##### 8. render_run: The same for one run (a model that recorded, or a RunHistory), into out_dir
+def render_run(run, out_dir, **options):
+    history = run if isinstance(run, RunHistory) else RunHistory.from_model(run)
+    return render_runs({out_dir: history}, **options)[out_dir]
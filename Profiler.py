@@ -0,0 +1,85 @@
+'''
+Per-step phase timing and hot-path counters for the Tiebout models
+'''
+################### Table of Contents ######################
+'''
+0. Required packages
+1. PHASES, COUNTERS: What is timed and counted
+2. StepProfiler Class
+    2.1 start_step: Forget the last step's times and counts
+    2.2 start, stop: Time a phase (a phase can be started and stopped more than once in a step, times add up)
+        add_time: Add time measured elsewhere (e.g. in worker processes)
+    2.3 count: Add to a counter
+    2.4 end_step: Add this step's row
+    2.5 to_frame: Per-step table, one row per step
+
+Models take profile=True to make a profiler (model.profiler, None otherwise). Agents and engines only
+check `model.profiler is not None`, so a model without one pays a single comparison per agent step.
+Counters, per step:
+    neighbor_visits: cells looked at by residents (cities in their windows) and by cities (cells in their neighborhoods)
+    gap_evaluations: resident-city gaps computed (the array engine computes every resident's gap at every
+        offset of the widest window, so this can be more than residents' own windows; with search='index'
+        residents only look at their Moore neighborhood plus the cities the index opens, see City_Index.py)
+    candidates: total size of residents' candidate lists (neighboring cities with the smallest gap)
+    moves: residents that moved
+Rows are kept in a RecordColumn (Recorder.py), streamed to path/profile.npy if a path is given.
+'''
+#############################################################
+# 0 Required Packages
+import os
+import time
+import numpy as np
+from Recorder import RecordColumn
+
+##### 1. PHASES, COUNTERS: What is timed and counted
+PHASES = ('residents', 'cities', 'collect')  # wall time of each part of a model step, in seconds
+COUNTERS = ('neighbor_visits', 'gap_evaluations', 'candidates', 'moves')
+
+
+##### 2. StepProfiler Class
+class StepProfiler:
+    def __init__(self, path=None):  # path: directory to stream rows to, None to keep them in memory
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+        self.column = RecordColumn((len(PHASES) + len(COUNTERS),), float,
+                                   None if path is None else os.path.join(path, 'profile.npy'))
+        self.started = {}  # phase: perf_counter when it was started
+        self.start_step()
+
+    # 2.1 start_step: Forget the last step's times and counts
+    def start_step(self):
+        self.times = dict.fromkeys(PHASES, 0.0)
+        self.counts = dict.fromkeys(COUNTERS, 0)
+
+    # 2.2 start, stop: Time a phase
+    def start(self, phase):
+        self.started[phase] = time.perf_counter()
+
+    def stop(self, phase):
+        self.times[phase] += time.perf_counter() - self.started.pop(phase)
+
+    def add_time(self, phase, seconds):
+        self.times[phase] += seconds
+
+    # 2.3 count: Add to a counter
+    def count(self, counter, n=1):
+        self.counts[counter] += n
+
+    # 2.4 end_step: Add this step's row
+    def end_step(self):
+        self.column.append([self.times[phase] for phase in PHASES] + [self.counts[counter] for counter in COUNTERS])
+
+    def __len__(self):  # number of steps profiled
+        return len(self.column)
+
+    # 2.5 to_frame: Per-step table, one row per step (phase times in seconds, then counters)
+    def to_frame(self):
+        import pandas as pd  # only needed here
+        values = self.column.values()
+        frame = pd.DataFrame(np.array(values), columns=[phase + '_s' for phase in PHASES] + list(COUNTERS))
+        frame[list(COUNTERS)] = frame[list(COUNTERS)].astype(np.int64)
+        frame.index = pd.RangeIndex(1, len(frame) + 1, name='step')
+        return frame
+
+    def close(self):
+        self.column.close()
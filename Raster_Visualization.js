@@ -0,0 +1,128 @@
+// Browser side of Raster_Visualization.py: raster heatmaps and a decimated line chart for ModularServer
+// (top-level names are declared with var: the file is included once per element class, and may load twice)
+
+// base64 text to bytes
+var decodeBytes = (text) => Uint8Array.from(atob(text), (c) => c.charCodeAt(0));
+
+// 256-entry color table, dark blue (low) to yellow (high), like viridis
+var RASTER_COLORS = (() => {
+  const stops = [[68, 1, 84], [59, 82, 139], [33, 145, 140], [94, 201, 98], [253, 231, 37]];
+  const table = new Uint8ClampedArray(256 * 4);
+  for (let i = 0; i < 256; i++) {
+    const t = (i / 255) * (stops.length - 1);
+    const k = Math.min(Math.floor(t), stops.length - 2);
+    for (let c = 0; c < 3; c++) {
+      table[4 * i + c] = stops[k][c] + (t - k) * (stops[k + 1][c] - stops[k][c]);
+    }
+    table[4 * i + 3] = 255;
+  }
+  return table;
+})();
+
+// One heatmap per layer: each keeps a raster-sized image, drawn scaled up onto its canvas
+var RasterModule = function (cellPixels) {
+  const container = document.createElement("div");
+  document.getElementById("elements").appendChild(container);
+  let raster = null; // layers, rows, columns, values (layer-major bytes) and one {image, small, context} per layer
+
+  const build = (frame) => {
+    container.innerHTML = "";
+    raster = { names: frame.layers.join(), rows: frame.rows, columns: frame.columns, layers: [] };
+    raster.values = new Uint8Array(frame.layers.length * frame.rows * frame.columns);
+    frame.layers.forEach((name) => {
+      const figure = document.createElement("figure");
+      figure.style = "display:inline-block;margin:4px";
+      const caption = document.createElement("figcaption");
+      caption.innerText = name;
+      const canvas = document.createElement("canvas");
+      canvas.width = frame.columns * cellPixels;
+      canvas.height = frame.rows * cellPixels;
+      figure.append(caption, canvas);
+      container.appendChild(figure);
+      const small = document.createElement("canvas"); // one pixel per raster cell
+      small.width = frame.columns;
+      small.height = frame.rows;
+      const context = canvas.getContext("2d");
+      context.imageSmoothingEnabled = false;
+      const smallContext = small.getContext("2d");
+      raster.layers.push({ canvas, context, small, smallContext, image: smallContext.createImageData(frame.columns, frame.rows), caption, name });
+    });
+  };
+
+  const paint = (layer, index, cell) => { // color one cell of a layer's image from its byte
+    const byte = raster.values[index * raster.rows * raster.columns + cell];
+    layer.image.data.set(RASTER_COLORS.subarray(4 * byte, 4 * byte + 4), 4 * cell);
+  };
+
+  const show = (layer) => {
+    layer.smallContext.putImageData(layer.image, 0, 0);
+    layer.context.drawImage(layer.small, 0, 0, layer.canvas.width, layer.canvas.height);
+  };
+
+  this.render = (frame) => {
+    const cellsPerLayer = () => raster.rows * raster.columns;
+    if (frame.type === "full") {
+      if (!raster || raster.names !== frame.layers.join() || raster.rows !== frame.rows || raster.columns !== frame.columns) {
+        build(frame);
+      }
+      raster.values.set(decodeBytes(frame.values));
+      raster.layers.forEach((layer, index) => {
+        const scale = frame.scales[layer.name === "residents" ? "residents" : "spending"];
+        layer.caption.innerText = `${layer.name} (${scale[0].toFixed(1)} to ${scale[1].toFixed(1)})`;
+        for (let cell = 0; cell < cellsPerLayer(); cell++) paint(layer, index, cell);
+        show(layer);
+      });
+    } else if (raster) { // delta: new bytes for the changed cells only
+      const cells = new Uint32Array(decodeBytes(frame.cells).buffer);
+      const values = decodeBytes(frame.values); // layer-major, one row of changed cells per layer
+      raster.layers.forEach((layer, index) => {
+        for (let i = 0; i < cells.length; i++) {
+          raster.values[index * cellsPerLayer() + cells[i]] = values[index * cells.length + i];
+          paint(layer, index, cells[i]);
+        }
+        show(layer);
+      });
+    }
+  };
+
+  this.reset = () => {
+    container.innerHTML = "";
+    raster = null;
+  };
+};
+
+// Line chart that keeps at most the server's max_points points: the server sends a point every stride steps,
+// and when the stride grows the points it now skips are dropped here
+var DecimatedChartModule = function (series, canvasWidth, canvasHeight) {
+  const canvas = document.createElement("canvas");
+  Object.assign(canvas, { width: canvasWidth, height: canvasHeight, style: "border:1px dotted" });
+  document.getElementById("elements").appendChild(canvas);
+  const datasets = series.map((s) => ({ label: s.Label, borderColor: s.Color, data: [], pointRadius: 0 }));
+  const chart = new Chart(canvas.getContext("2d"), {
+    type: "line",
+    data: { labels: [], datasets: datasets },
+    options: { responsive: true, animation: false, scales: { x: { ticks: { maxTicksLimit: 11 } } } },
+  });
+  let stride = 1;
+
+  this.render = (data) => {
+    if (data.stride > stride) { // keep only the points on the new stride
+      stride = data.stride;
+      const keep = chart.data.labels.map((step) => step % stride === 0);
+      chart.data.labels = chart.data.labels.filter((_, i) => keep[i]);
+      chart.data.datasets.forEach((dataset) => { dataset.data = dataset.data.filter((_, i) => keep[i]); });
+    }
+    if (data.values !== null) {
+      chart.data.labels.push(data.step);
+      data.values.forEach((value, i) => chart.data.datasets[i].data.push(value));
+    }
+    chart.update("none");
+  };
+
+  this.reset = () => {
+    stride = 1;
+    chart.data.labels = [];
+    chart.data.datasets.forEach((dataset) => { dataset.data = []; });
+    chart.update("none");
+  };
+};
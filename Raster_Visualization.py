@@ -0,0 +1,162 @@
+'''
+Raster visualization elements for mesa's ModularServer, for watching large grids live
+'''
+################### Table of Contents ######################
+'''
+0. Required packages
+1. Settings: raster size, delta share, key frames, chart points
+2. grid_layers: Spending on every preference plus residents per cell, as (layers, width, height) arrays
+3. downsample: Shrink layers to at most max_side cells a side (block means of spending, block sums of residents)
+4. quantize: Layers to one byte per cell, on fixed scales
+5. encode: Bytes to text for the websocket (base64)
+6. RasterGrid Class: Heatmap of every layer, sent as a full raster or only the cells that changed
+    6.1 render: This step's frame
+7. DecimatedChart Class: Line chart of model series with at most max_points points
+
+CanvasGrid sends a portrayal dict for every agent every frame, which browsers can't keep up with past
+a few hundred cells. RasterGrid sends the grid instead: one byte per cell for each preference's spending
+(heatmaps) and for the number of residents (density), as one base64 block. When fewer than delta_share
+of the cells changed since the last frame, only those cells are sent (their flat indices and new bytes).
+A full frame is sent for a new or reset model, when the resident scale has to grow, and every keyframe
+frames (so a dropped frame can't leave the picture wrong for long). Grids wider than max_side are shown
+at a coarser resolution, with each raster cell covering a block of cities.
+DecimatedChart keeps at most max_points points per series: when the chart fills up it keeps every other
+point and from then on only sends every other step (a stride that keeps doubling), so a run of any
+length draws in constant time.
+Both elements draw with Raster_Visualization.js, served from this directory by ModularServer.
+'''
+#############################################################
+# 0 Required Packages
+import base64
+import json
+import os
+import numpy as np
+from mesa.visualization.ModularVisualization import VisualizationElement, CHART_JS_FILE
+
+##### 1. Settings
+CELL_PIXELS = 4  # on-screen pixels per raster cell side
+MAX_SIDE = 256  # largest raster side, in cells (bigger grids are shown in blocks)
+DELTA_SHARE = 0.25  # send only the changed cells when fewer than this share of cells changed
+KEYFRAME = 100  # send a full frame at least this often (frames)
+MAX_POINTS = 500  # most points a chart series keeps
+
+
+##### 2. grid_layers: Spending on every preference plus residents per cell (multigridmodel, any engine)
+def grid_layers(model):  # returns (P, width, height) spending and (width, height) resident counts
+    spending = np.asarray(model.get_spending_levels(), dtype=float).reshape(model.width, model.height, -1)
+    if model.engine is None:
+        counts = model.cell_counts
+    else:
+        counts = np.bincount(model.resident_cells(), minlength=model.width * model.height).reshape(model.width, model.height)
+    return np.moveaxis(spending, -1, 0), counts
+
+
+##### 3. downsample: Shrink layers to at most max_side cells a side
+def block_starts(size, max_side):  # first cell of every block along one axis
+    return np.arange(0, size, -(-size // max_side))
+
+def downsample(spending, counts, max_side=MAX_SIDE):
+    _, width, height = spending.shape
+    if width <= max_side and height <= max_side:
+        return spending, counts
+    x_starts, y_starts = block_starts(width, max_side), block_starts(height, max_side)
+    block_sum = lambda values: np.add.reduceat(np.add.reduceat(values, x_starts, axis=-2), y_starts, axis=-1)
+    sizes = block_sum(np.ones((width, height)))  # cities per block (the last blocks can be smaller)
+    return block_sum(spending) / sizes, block_sum(counts)
+
+
+##### 4. quantize: Layers to one byte per cell, on fixed scales
+# spending between low and high, residents between 0 and resident_high (more is drawn as resident_high)
+# returns (layers, height, width) uint8, rows top (largest y) to bottom like CanvasGrid, columns x
+def quantize(spending, counts, low, high, resident_high):
+    span = max(high - low, 1e-12)
+    spending_bytes = np.clip(np.rint((spending - low) / span * 255), 0, 255)
+    resident_bytes = np.clip(np.rint(counts / resident_high * 255), 0, 255)
+    layers = np.concatenate([spending_bytes, resident_bytes[None]]).astype(np.uint8)
+    return np.ascontiguousarray(layers.transpose(0, 2, 1)[:, ::-1])
+
+
+##### 5. encode: Bytes to text for the websocket
+def encode(array):
+    return base64.b64encode(np.ascontiguousarray(array).tobytes()).decode('ascii')
+
+
+##### 6. RasterGrid Class: Heatmap of every layer, full or only the cells that changed
+class RasterGrid(VisualizationElement):
+    local_includes = ['Raster_Visualization.js']
+    local_dir = os.path.dirname(os.path.abspath(__file__))
+
+    def __init__(self, cell_pixels=CELL_PIXELS, max_side=MAX_SIDE, delta_share=DELTA_SHARE, keyframe=KEYFRAME):
+        super().__init__()
+        self.max_side = max_side
+        self.delta_share = delta_share
+        self.keyframe = keyframe
+        self.model = None  # model the last frame was drawn from
+        self.last = None  # last frame's bytes, what the browser is showing
+        self.since_full = 0  # frames since the last full frame
+        self.js_code = 'elements.push(new RasterModule(%s));' % json.dumps(cell_pixels)
+
+    def start(self, model, spending, counts):  # scales for a new (or reset) model, kept fixed so frames can be diffed
+        self.model = model
+        self.low = float(min(np.min(spending), np.min(model.resident_preferences)))
+        self.high = float(max(np.max(spending), np.max(model.resident_preferences)))
+        self.resident_high = max(1.0, float(np.max(counts, initial=0)))
+
+    # 6.1 render: This step's frame
+    def render(self, model):
+        spending, counts = downsample(*grid_layers(model), max_side=self.max_side)
+        full = model is not self.model or self.last is None or self.since_full + 1 >= self.keyframe
+        if model is not self.model:
+            self.start(model, spending, counts)
+        if np.max(counts, initial=0) > self.resident_high:  # more residents in a cell than the scale shows, double it
+            while np.max(counts) > self.resident_high:
+                self.resident_high *= 2
+            full = True
+        frame = quantize(spending, counts, self.low, self.high, self.resident_high)
+        layers, rows, columns = frame.shape
+        if not full:
+            changed = np.flatnonzero((frame != self.last).any(axis=0))  # flat indices (row * columns + column)
+            full = len(changed) > self.delta_share * rows * columns
+        self.last = frame
+        if full:
+            self.since_full = 0
+            names = ['spending %d' % i for i in range(layers - 1)] + ['residents']
+            return {'type': 'full', 'layers': names, 'rows': rows, 'columns': columns, 'values': encode(frame),
+                    'scales': {'spending': [self.low, self.high], 'residents': [0, self.resident_high]}}
+        self.since_full += 1
+        return {'type': 'delta', 'cells': encode(changed.astype('<u4')),
+                'values': encode(frame.reshape(layers, -1)[:, changed])}
+
+
+##### 7. DecimatedChart Class: Line chart of model series with at most max_points points
+class DecimatedChart(VisualizationElement):
+    package_includes = [CHART_JS_FILE]
+    local_includes = ['Raster_Visualization.js']
+    local_dir = os.path.dirname(os.path.abspath(__file__))
+
+    # series: like ChartModule, e.g. [{'Label': 'gap', 'Color': 'Black'}], values from the data collector if it has
+    #   them, else the model attribute of that name
+    def __init__(self, series, canvas_height=200, canvas_width=500, data_collector_name='datacollector',
+                 max_points=MAX_POINTS):
+        super().__init__()
+        self.series = series
+        self.data_collector_name = data_collector_name
+        self.max_points = max_points
+        self.model = None
+        self.stride = 1  # steps between points
+        self.js_code = 'elements.push(new DecimatedChartModule(%s, %d, %d));' % (json.dumps(series), canvas_width,
+                                                                                 canvas_height)
+
+    def value(self, model, label):  # latest value of one series
+        collector = getattr(model, self.data_collector_name, None)
+        values = collector.model_vars.get(label) if collector is not None else None
+        return float(values[-1]) if values else float(getattr(model, label, 0))
+
+    def render(self, model):  # the step's values, or none if the step falls between points; the browser drops points the stride skips
+        if model is not self.model:
+            self.model, self.stride = model, 1
+        step = model.schedule.steps
+        while step // self.stride > self.max_points:
+            self.stride *= 2
+        values = [self.value(model, s['Label']) for s in self.series] if step % self.stride == 0 else None
+        return {'step': step, 'stride': self.stride, 'values': values}
@@ -0,0 +1,354 @@
+'''
+Recorder for spending levels and gap over a model run
+'''
+################### Table of Contents ######################
+'''
+0. Required packages
+1. write_npy_header: Fixed-size .npy header, so the shape can be rewritten as the file grows
+2. RecordColumn Class: One appendable column (array that grows along its first axis, one row per step)
+3. SpendingRecorder Class: Spending snapshot (num_cities, P) and gap for every step (and resident positions, if asked)
+4. load_recording: Open a recording written to disk as memory-mapped arrays (load_positions for positions)
+5. RunningStats Class: Running mean and variance (Welford), one value or a block of values at a time
+6. SummaryCollector Class: Per-step summary statistics in constant memory, instead of full spending histories
+7. make_collectors: Recorder and/or summary collector for a model's collect mode
+8. gap_span: Largest gap a resident can have, for sizing the gap histogram
+
+Replaces the model level spending_levels list (which grew by one entry per city per step, and which
+DataCollector stored a reference to at every step). Rows go into a buffer that starts at INITIAL_ROWS
+rows and doubles as it fills; with a path the buffer stops growing at chunk_bytes and is flushed in
+chunks to .npy files (one per column) that can be memory-mapped, otherwise it stays in memory. Reading
+a column gives a view, not a copy.
+With collect 'positions' the recorder also keeps every resident's cell (flat index x * height + y) at
+every step, which is what the offline renderer (Offline_Renderer.py) needs for density frames.
+A checkpoint (Checkpoint.py) of a column streaming to disk keeps only its file and row count: resume
+continues a column from the first rows of such a file (moved into place, or copied on disk), so saving
+and restoring a long run doesn't read its recording into memory.
+For very long runs the summary collector keeps only per-step statistics (spending mean/variance,
+gap quantiles, movers, occupied cities), computed as agents step, in the same kind of columns. Its first
+row is the starting spending, before any step (as the initial-spending row of a full recording).
+Models collect the gap into their DataCollector every step in every mode, it's one number per step.
+'''
+#############################################################
+# 0 Required Packages
+import os
+import struct  # for the .npy header length
+import numpy as np
+
+QUANTILES = (0.1, 0.25, 0.5, 0.75, 0.9)  # default gap quantiles for the summary collector
+GAP_BINS = 200  # default number of histogram bins for gap quantiles
+
+HEADER_BYTES = 128  # total size of the .npy header we write (numpy wants a multiple of 64)
+CHUNK_BYTES = 64 * 2**20  # default buffered bytes before a flush to disk (columns streaming to a file only)
+INITIAL_ROWS = 64  # rows a buffer starts with, it doubles as it fills
+
+
+##### 1. write_npy_header: Fixed-size .npy header, so the shape can be rewritten as the file grows
+def write_npy_header(file, dtype, shape):
+    header = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" % (np.lib.format.dtype_to_descr(dtype), tuple(shape))
+    header = header.ljust(HEADER_BYTES - 11) + '\n'  # pad with spaces (10 bytes go to magic string/version/length)
+    file.seek(0)
+    file.write(b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header.encode('latin1'))
+
+
+##### 2. RecordColumn Class: One appendable column
+class RecordColumn:
+    def __init__(self, row_shape, dtype=float, path=None, chunk_bytes=CHUNK_BYTES):
+        self.row_shape = tuple(row_shape)
+        self.dtype = np.dtype(dtype)
+        self.path = path  # .npy file to stream to, None to keep everything in memory
+        row_bytes = max(1, self.dtype.itemsize * int(np.prod(self.row_shape)))
+        self.flush_rows = max(1, chunk_bytes // row_bytes)  # with a file, rows buffered before a flush
+        # start small and double (a short run, or a worker in a batch, doesn't reserve a whole chunk per column)
+        self.buffer = np.empty((min(INITIAL_ROWS, self.flush_rows) if path is not None else INITIAL_ROWS,)
+                               + self.row_shape, dtype=self.dtype)
+        self.filled = 0  # rows in the buffer
+        self.flushed = 0  # rows already written to disk
+        self.file = None
+        if path is not None:
+            self.file = open(path, 'w+b')
+            write_npy_header(self.file, self.dtype, (0,) + self.row_shape)
+
+    def __len__(self):
+        return self.flushed + self.filled
+
+    def append(self, row):
+        if self.filled == len(self.buffer):  # buffer is full
+            if self.file is not None and self.filled >= self.flush_rows:
+                self.flush()
+            else:  # double it (up to flush_rows with a file), copies now and then, not once per step
+                rows = 2 * len(self.buffer) if self.file is None else min(2 * len(self.buffer), self.flush_rows)
+                grown = np.empty((rows,) + self.row_shape, dtype=self.dtype)
+                grown[:self.filled] = self.buffer[:self.filled]
+                self.buffer = grown
+        self.buffer[self.filled] = row
+        self.filled += 1
+
+    def extend(self, rows):  # many rows, e.g. the rows of a restored checkpoint
+        for row in rows:
+            self.append(row)
+
+    def flush(self):  # write buffered rows to the end of the file and update the shape in its header
+        if self.file is None or self.filled == 0:
+            return
+        self.file.seek(0, os.SEEK_END)
+        self.file.write(self.buffer[:self.filled].tobytes())
+        self.flushed += self.filled
+        self.filled = 0
+        write_npy_header(self.file, self.dtype, (self.flushed,) + self.row_shape)
+        self.file.flush()
+
+    # resume: continue from the first rows of the .npy file source (written by a RecordColumn) instead of starting
+    #   empty, moving it into place (move=True, source is this column's file set aside) or copying it on disk
+    def resume(self, source, rows, move=False):
+        data_bytes = rows * self.dtype.itemsize * int(np.prod(self.row_shape))
+        self.filled = 0  # (a fresh collector may hold a starting row, the saved rows have it)
+        self.flushed = rows
+        self.file.close()
+        if move:
+            os.replace(source, self.path)
+        else:
+            with open(source, 'rb') as saved, open(self.path, 'wb') as file:
+                saved.seek(HEADER_BYTES)
+                file.seek(HEADER_BYTES)
+                copy_bytes(saved, file, data_bytes)
+        self.file = open(self.path, 'r+b')
+        self.file.truncate(HEADER_BYTES + data_bytes)  # drop rows written after the checkpoint
+        write_npy_header(self.file, self.dtype, (rows,) + self.row_shape)
+        self.file.flush()
+
+    def values(self):  # every row so far, as a view (memory-mapped when streaming to disk, also once closed)
+        if self.path is None:
+            return self.buffer[:self.filled]
+        self.flush()
+        if self.flushed == 0:  # can't memory-map an empty array
+            return np.empty((0,) + self.row_shape, dtype=self.dtype)
+        return np.load(self.path, mmap_mode='r')
+
+    def close(self):
+        if self.file is not None:
+            self.flush()
+            self.file.close()
+            self.file = None
+
+
+def copy_bytes(source, destination, size, block=CHUNK_BYTES):  # the next size bytes of one open file to another
+    while size > 0:
+        chunk = source.read(min(block, size))
+        if not chunk:
+            raise ValueError('recording %s is shorter than its checkpoint says' % source.name)
+        destination.write(chunk)
+        size -= len(chunk)
+
+
+##### 3. SpendingRecorder Class: Spending snapshot and gap for every step
+class SpendingRecorder:
+    # snapshot_shape: (num_cities, P) or (num_cities,)
+    # num_residents: also record every resident's cell at every step (positions.npy), None not to
+    def __init__(self, snapshot_shape, path=None, chunk_bytes=CHUNK_BYTES, num_residents=None):
+        self.path = path  # directory for spending.npy and gap.npy (and positions.npy), None to record in memory
+        spending_path = gap_path = positions_path = None
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+            spending_path = os.path.join(path, 'spending.npy')
+            gap_path = os.path.join(path, 'gap.npy')
+            positions_path = os.path.join(path, 'positions.npy')
+        self.spending_column = RecordColumn(snapshot_shape, float, spending_path, chunk_bytes)
+        self.gap_column = RecordColumn((), float, gap_path, chunk_bytes)
+        # flat cell index of every resident (int32: half the size of intp, and grids have far fewer cells than 2**31)
+        self.positions_column = None
+        if num_residents is not None:
+            self.positions_column = RecordColumn((num_residents,), np.int32, positions_path, chunk_bytes)
+
+    def __len__(self):  # number of steps recorded
+        return len(self.gap_column)
+
+    @property
+    def records_positions(self):  # whether record wants resident positions too
+        return self.positions_column is not None
+
+    def record(self, spending, gap, positions=None):  # add one step (positions: every resident's flat cell, if recording them)
+        self.spending_column.append(spending)
+        self.gap_column.append(gap)
+        if self.positions_column is not None:
+            self.positions_column.append(positions)
+
+    @property
+    def spending(self):  # (steps, num_cities[, P]) array of spending levels, cities in coord_iter order
+        return self.spending_column.values()
+
+    @property
+    def gap(self):  # (steps,) array of the model's gap
+        return self.gap_column.values()
+
+    @property
+    def positions(self):  # (steps, num_residents) array of resident cells (x * height + y), None if not recorded
+        return None if self.positions_column is None else self.positions_column.values()
+
+    def columns(self):  # the columns being recorded
+        return [column for column in (self.spending_column, self.gap_column, self.positions_column) if column is not None]
+
+    def flush(self):
+        for column in self.columns():
+            column.flush()
+
+    def close(self):
+        for column in self.columns():
+            column.close()
+
+
+##### 4. load_recording: Open a recording written to disk as memory-mapped arrays
+def load_recording(path):  # returns spending and gap arrays, without reading them into memory
+    return (np.load(os.path.join(path, 'spending.npy'), mmap_mode='r'),
+            np.load(os.path.join(path, 'gap.npy'), mmap_mode='r'))
+
+def load_positions(path):  # resident positions of a recording made with collect 'positions' (memory-mapped), else None
+    positions_path = os.path.join(path, 'positions.npy')
+    return np.load(positions_path, mmap_mode='r') if os.path.exists(positions_path) else None
+
+
+##### 5. RunningStats Class: Running mean and variance (Welford)
+class RunningStats:
+    def __init__(self, shape=()):  # shape of each value, e.g. (P,) for spending levels
+        self.shape = shape
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.mean = np.zeros(self.shape)
+        self.m2 = np.zeros(self.shape)  # sum of squared differences from the mean
+
+    def add(self, value):  # one value (e.g. one city's spending levels)
+        self.count += 1
+        delta = value - self.mean
+        self.mean = self.mean + delta / self.count
+        self.m2 = self.m2 + delta * (value - self.mean)
+
+    def add_block(self, values):  # many values at once, along the first axis (combined as in Chan et al.)
+        values = np.asarray(values, dtype=float)
+        block_count = len(values)
+        if block_count == 0:
+            return
+        block_mean = values.mean(axis=0)
+        block_m2 = ((values - block_mean) ** 2).sum(axis=0)
+        total = self.count + block_count
+        delta = block_mean - self.mean
+        self.mean = self.mean + delta * block_count / total
+        self.m2 = self.m2 + block_m2 + delta ** 2 * self.count * block_count / total
+        self.count = total
+
+    @property
+    def variance(self):  # sample variance (ddof=1), same as pandas var
+        if self.count < 2:
+            return np.full(self.shape, np.nan)
+        return self.m2 / (self.count - 1)
+
+
+##### 6. SummaryCollector Class: Per-step summary statistics in constant memory
+class SummaryCollector:
+    # spending_shape: shape of one city's spending, (P,) or () for a single preference
+    # gap_max: largest possible resident gap (gaps above it go in the top histogram bin)
+    # path: directory to stream the per-step rows to (summary_*.npy), None to keep them in memory
+    def __init__(self, spending_shape, gap_max, path=None, quantiles=QUANTILES, bins=GAP_BINS):
+        self.spending_stats = RunningStats(spending_shape)  # spending over cities, this step
+        self.quantiles = np.asarray(quantiles, dtype=float)
+        self.bins = bins
+        self.bin_width = gap_max / bins if gap_max > 0 else 1.0
+        self.gap_counts = np.zeros(bins, dtype=np.int64)  # histogram of resident gaps, this step
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+        shapes = {'gap': (), 'movers': (), 'occupied': (), 'spending_mean': spending_shape,
+                  'spending_var': spending_shape, 'gap_quantiles': self.quantiles.shape}
+        self.columns = {name: RecordColumn(shape, float, None if path is None else os.path.join(path, 'summary_%s.npy' % name))
+                        for name, shape in shapes.items()}
+
+    def start_step(self):  # forget the last step's values
+        self.spending_stats.reset()
+        self.gap_counts[:] = 0
+
+    def gap_bin(self, gap):  # histogram bin of one gap
+        return min(int(gap / self.bin_width), self.bins - 1)
+
+    def add_gap(self, gap):  # one resident's gap
+        self.gap_counts[self.gap_bin(gap)] += 1
+
+    def add_gaps(self, gaps):  # many residents' gaps at once
+        bins = np.minimum((np.asarray(gaps) / self.bin_width).astype(np.intp), self.bins - 1)
+        self.gap_counts += np.bincount(bins, minlength=self.bins)
+
+    def add_gap_counts(self, counts):  # histogram counts made elsewhere (with the same bins), e.g. in worker processes
+        self.gap_counts += counts
+
+    def add_spending(self, spending_levels):  # one city's spending
+        self.spending_stats.add(spending_levels)
+
+    def add_spending_block(self, spending_levels):  # many cities' spending, one row per city
+        self.spending_stats.add_block(spending_levels)
+
+    def gap_quantiles(self):  # quantiles of this step's gaps, interpolated within histogram bins
+        total = self.gap_counts.sum()
+        if total == 0:
+            return np.full(self.quantiles.shape, np.nan)
+        below = np.cumsum(self.gap_counts)  # residents in or below each bin
+        targets = self.quantiles * total
+        bins = np.minimum(np.searchsorted(below, targets), self.bins - 1)  # bin each quantile falls in
+        before = below[bins] - self.gap_counts[bins]  # residents below that bin
+        inside = np.clip((targets - before) / np.maximum(self.gap_counts[bins], 1), 0, 1)
+        return (bins + inside) * self.bin_width
+
+    def initial_row(self, spending_levels, occupied):  # row 0: the starting spending (one row per city), before any step
+        # (no gap has been measured yet and nobody has moved, so gap and its quantiles are NaN and movers 0)
+        self.start_step()
+        self.add_spending_block(np.reshape(spending_levels, (-1,) + self.spending_stats.shape))
+        self.end_step(np.nan, 0, occupied)
+
+    def end_step(self, gap, movers, occupied):  # add this step's row
+        self.columns['gap'].append(gap)
+        self.columns['movers'].append(movers)
+        self.columns['occupied'].append(occupied)
+        self.columns['spending_mean'].append(self.spending_stats.mean)
+        self.columns['spending_var'].append(self.spending_stats.variance)
+        self.columns['gap_quantiles'].append(self.gap_quantiles())
+
+    def __len__(self):  # number of rows (the starting row, then one per step)
+        return len(self.columns['gap'])
+
+    def values(self, name):  # one column, one row per step
+        return self.columns[name].values()
+
+    def to_frame(self):  # all columns as a data frame, one row per step
+        import pandas as pd  # only needed here
+        frame = {}
+        for name, column in self.columns.items():
+            values = column.values()
+            if values.ndim == 1:
+                frame[name] = values
+            elif name == 'gap_quantiles':
+                frame.update({'gap_q%g' % (100 * q): values[:, i] for i, q in enumerate(self.quantiles)})
+            else:
+                frame.update({'%s_%d' % (name, i): values[:, i] for i in range(values.shape[1])})
+        return pd.DataFrame(frame)
+
+    def close(self):
+        for column in self.columns.values():
+            column.close()
+
+
+##### 7. make_collectors: Recorder and/or summary collector for a model's collect mode
+# collect: 'full' (every step's spending, SpendingRecorder), 'summary' (SummaryCollector) or both, e.g. ('full', 'summary'),
+#   plus 'positions' to have the recorder keep num_residents resident positions too, e.g. ('full', 'positions')
+def make_collectors(collect, snapshot_shape, gap_max, path=None, num_residents=None):
+    modes = {collect} if isinstance(collect, str) else set(collect)
+    if not modes or not modes <= {'full', 'summary', 'positions'} or modes == {'positions'}:
+        raise ValueError("collect must be 'full', 'summary' or both (plus 'positions')")
+    if 'positions' in modes and 'full' not in modes:
+        raise ValueError("collect 'positions' is recorded with the spending, it needs 'full' too")
+    recorder = None
+    if 'full' in modes:
+        recorder = SpendingRecorder(snapshot_shape, path=path, num_residents=num_residents if 'positions' in modes else None)
+    summary = SummaryCollector(tuple(snapshot_shape[1:]), gap_max, path=path) if 'summary' in modes else None
+    return recorder, summary
+
+
+##### 8. gap_span: Largest gap a resident can have, for sizing the gap histogram
+def gap_span(preferences, spending_levels):  # largest gap possible: spending stays between the preferences and initial spending
+    return float(max(np.max(preferences), np.max(spending_levels)) - min(np.min(preferences), np.min(spending_levels)))
@@ -0,0 +1,184 @@
+'''
+Run cache: results of finished runs kept on disk, found again by what the run was
+'''
+################### Table of Contents ######################
+'''
+0. Required packages
+1. code_version: Hash of the source files the models are made of
+2. run_key: Hash of a run (model class, constructor arguments, seed, step cap, checkpoint, code version)
+    2.1 resolved: Constructor arguments with the ones settled at run time filled in (tiled engine strips)
+    2.2 feed: Add a value to a hash, the same way for equal values
+    2.3 file_digest: Hash of a file's contents (checkpoints runs fork from)
+3. RunCache Class: Results in a directory, bounded in size, least recently used ones evicted first
+    3.1 get: A run's result, or None
+    3.2 put: Store a run's result
+    3.3 evict: Delete the least recently used results until the cache fits its bound
+4. model_result: What a finished model collected, as arrays
+
+A run is keyed by everything its result depends on: the model class, every constructor argument
+(arrays by type, shape and contents), the seed, the step cap, the checkpoint it forks from (by
+contents) and the code itself (every .py file next to this one, so editing any of them starts a fresh
+cache rather than reading back results of older code). Equal keys mean equal results, so a repeated
+run, or a sweep point run before, is read back instead of simulated.
+Results are compressed .npz files, one per run, named by key: the per-step reporter (gap, or happy for
+Schelling), the recorded spending trajectory when the model records one, segregation for Schelling,
+and how the run ended. They hold arrays only, so they load without pickle.
+Reading a result touches its file, so file times order results from least to most recently used, and
+stores evict the oldest ones once the directory is over max_bytes. Files are written to a temporary name
+and renamed, so pool workers can share one cache directory.
+'''
+#############################################################
+# 0 Required Packages
+import functools
+import glob
+import hashlib
+import os
+import numpy as np
+
+FORMAT = 1  # result layout version, part of every key
+MAX_BYTES = 2**30  # default size bound of a cache directory
+
+
+##### 1. code_version: Hash of the source files the models are made of
+@functools.lru_cache(maxsize=None)  # once per process
+def code_version(directory=os.path.dirname(os.path.abspath(__file__))):
+    digest = hashlib.blake2b(digest_size=16)
+    for path in sorted(glob.glob(os.path.join(directory, '*.py'))):
+        feed(digest, os.path.basename(path))
+        digest.update(file_digest(path).encode())
+    return digest.hexdigest()
+
+
+##### 2. run_key: Hash of a run
+# class_name: model class (e.g. 'multigridmodel'), kwargs: constructor arguments, checkpoint: path of the checkpoint
+#   the run forks from, or None
+def run_key(class_name, kwargs, seed, max_steps, checkpoint=None):
+    digest = hashlib.blake2b(digest_size=16)
+    feed(digest, {'format': FORMAT, 'code': code_version(), 'model': class_name, 'kwargs': resolved(kwargs), 'seed': seed,
+                  'max_steps': max_steps, 'checkpoint': None if checkpoint is None else file_digest(checkpoint)})
+    return digest.hexdigest()
+
+# 2.1 resolved: the tiled engine's run depends on its number of strips, so key on the number it will use
+def resolved(kwargs):
+    if kwargs.get('engine') != 'tiled':
+        return kwargs
+    from Tiled_Engine import resolve_tiles
+    return dict(kwargs, tiles=resolve_tiles(kwargs.get('tiles'), kwargs['width'], kwargs['resident_resources']))
+
+# 2.2 feed: Add a value to a hash, the same way for equal values (numpy scalars as the python values they hold)
+def feed(digest, value):
+    if isinstance(value, np.generic):
+        value = value.item()
+    if value is None or isinstance(value, (bool, int, float, str, bytes)):
+        digest.update(b'%s:%s;' % (type(value).__name__.encode(), repr(value).encode()))
+    elif isinstance(value, np.ndarray):
+        array = np.ascontiguousarray(value)
+        digest.update(b'array:%s%s;' % (array.dtype.str.encode(), repr(array.shape).encode()))
+        digest.update(array.tobytes() if array.dtype != object else repr(array.tolist()).encode())
+    elif isinstance(value, dict):  # by sorted names, so argument order doesn't matter
+        digest.update(b'dict:%d;' % len(value))
+        for name in sorted(value):
+            feed(digest, name)
+            feed(digest, value[name])
+    elif isinstance(value, (list, tuple)):
+        digest.update(b'%s:%d;' % (type(value).__name__.encode(), len(value)))
+        for item in value:
+            feed(digest, item)
+    else:  # anything else may not be the same value from one process to the next
+        raise TypeError("can't key a run on a %s argument" % type(value).__name__)
+
+# 2.3 file_digest: Hash of a file's contents, read in blocks
+def file_digest(path, block=2**20):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(block), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+##### 3. RunCache Class: Results in a directory, least recently used ones evicted past max_bytes
+# (only the directory and bound are kept, so a cache can be sent to pool workers)
+class RunCache:
+    def __init__(self, path, max_bytes=MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(path, exist_ok=True)
+
+    def file(self, key):
+        return os.path.join(self.path, key + '.npz')
+
+    def __contains__(self, key):
+        return os.path.exists(self.file(key))
+
+    def __len__(self):
+        return len(self.entries())
+
+    def entries(self):  # (last used, size, path) of every result, least recently used first
+        entries = []
+        for path in glob.glob(os.path.join(self.path, '*.npz')):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:  # evicted by another process meanwhile
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, path))
+        return sorted(entries)
+
+    def size(self):  # bytes used
+        return sum(size for _, size, _ in self.entries())
+
+    # 3.1 get: A run's result (dict of arrays, see model_result), or None if it isn't cached
+    def get(self, key):
+        path = self.file(key)
+        try:
+            with np.load(path) as file:
+                result = {name: file[name] for name in file.files}
+            os.utime(path)  # now the most recently used
+        except FileNotFoundError:
+            return None
+        return result
+
+    # 3.2 put: Store a run's result (results bigger than the whole cache aren't kept)
+    def put(self, key, result):
+        path = self.file(key)
+        temporary = '%s.%d.tmp' % (path, os.getpid())
+        with open(temporary, 'wb') as file:
+            np.savez_compressed(file, **result)
+        if os.path.getsize(temporary) > self.max_bytes:
+            os.remove(temporary)
+            return
+        os.replace(temporary, path)
+        self.evict()
+
+    # 3.3 evict: Delete the least recently used results until the cache fits in max_bytes
+    def evict(self):
+        entries = self.entries()
+        used = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if used <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            used -= size
+
+    def clear(self):
+        for _, _, path in self.entries():
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+##### 4. model_result: What a finished model collected, as arrays
+# series: the per-step reporter (gap or happy), segregation: for Schelling models (None otherwise)
+def model_result(model, series, segregation=None):
+    result = {'series': np.asarray(series, dtype=float), 'steps': np.int64(model.schedule.steps),
+              'running': np.bool_(model.running)}
+    if hasattr(model, 'stop_reason'):  # min_gap, fixed_point or cycle ('' for None, it hit the step cap)
+        result['stop_reason'] = np.str_(model.stop_reason or '')
+    if getattr(model, 'recorder', None) is not None:  # every city's spending at every step
+        result['spending'] = np.asarray(model.recorder.spending)
+    if segregation is not None:
+        result['segregation'] = np.float64(segregation)
+    return result
@@ -0,0 +1,174 @@
+'''
+Scenario generator: seeded resident populations, city spending and starting positions, made in chunks
+'''
+################### Table of Contents ######################
+'''
+0. Required packages
+1. Settings: chunk size, random streams
+2. chunk_rng: Random number generator for one chunk of one stream
+3. normal_cdf: Standard normal CDF, for turning correlated normals into uniform levels
+4. Residents: Preferences and resources that go together (richer residents want more, or less, spending)
+    4.1 resident_chunk: One chunk of residents
+    4.2 make_residents: Every resident, chunk by chunk
+5. make_spending: Initial city spending, chunk by chunk
+6. make_positions: Starting cells of every resident, chunk by chunk
+7. make_scenario, mini_scenario: Constructor arguments for multigridmodel and MiniModel
+8. place_agents: Put many agents on a mesa MultiGrid at once
+    8.1 bulk_placement: Whether place_agents can fill the grid's cell lists itself
+
+The __main__ blocks set models up with np.random.randint, which draws whole populations in one go
+from the global random state, and makes resources independent of preferences. Here every array is
+made in chunks of CHUNK rows, and chunk i of a stream gets its own generator, seeded from (seed,
+stream, i): the arrays don't depend on how they're filled (all at once, into shared memory, or one
+chunk per worker), memory stays at one chunk of temporaries, and any chunk can be made again alone.
+Preferences and resources come from one latent "wealth" draw per resident (a Gaussian copula):
+every preference is a normal with the given correlation to wealth, and resources are wealth cut into
+equally likely levels. Each normal is turned into integer levels through the normal CDF, so every
+preference is uniform on [low, high] and resources uniform on [0, max_resources], like the randint
+scenarios, whatever the correlation.
+Models given resident_positions place their residents at those cells in bulk (place_agents groups
+them by cell in NumPy and extends each occupied cell's list once, on the mesa versions whose grid
+internals it knows, and falls back to grid.place_agent on others; per-cell sums are added up as
+arrays), and the array engines need no per-resident Python work at all, so a 10^7-resident model
+builds in seconds.
+'''
+#############################################################
+# 0 Required Packages
+import numpy as np
+
+##### 1. Settings
+CHUNK = 2**16  # rows per chunk (part of the seed: a different chunk size gives different arrays)
+STREAMS = {'residents': 0, 'spending': 1, 'positions': 2}  # independent random streams of a scenario
+
+
+##### 2. chunk_rng: Random number generator for one chunk of one stream
+def chunk_rng(seed, stream, chunk):
+    return np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(STREAMS[stream], chunk)))
+
+def chunks(total, size=CHUNK):  # (chunk, start, stop) for every chunk of total rows
+    for chunk, start in enumerate(range(0, total, size)):
+        yield chunk, start, min(start + size, total)
+
+def level_type(low, high):  # smallest signed integer type for values from low to high (as compact_prefs picks, for
+    # preferences and positions; resources and spending stay int64, models sum them per cell and take them as radii)
+    for dtype in (np.int8, np.int16, np.int32, np.int64):
+        if np.iinfo(dtype).min <= low and high <= np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
+
+##### 3. normal_cdf: Standard normal CDF (Abramowitz and Stegun 7.1.26 for erf, error below 1.5e-7)
+def normal_cdf(z):
+    x = np.abs(z) / np.sqrt(2)
+    t = 1 / (1 + 0.3275911 * x)
+    poly = t * (0.254829592 + t * (-0.284496736 + t * (1.421413741 + t * (-1.453152027 + t * 1.061405429))))
+    erf = 1 - poly * np.exp(-x * x)
+    return 0.5 * (1 + np.copysign(erf, z))
+
+def to_levels(z, low, high):  # normals to integers uniform on [low, high]
+    return low + np.minimum((normal_cdf(z) * (high - low + 1)).astype(np.int64), high - low)
+
+
+##### 4. Residents: Preferences and resources that go together
+# correlation: of every preference (a number, or one per preference) with wealth, which sets resources, in [-1, 1];
+#   0 for independent preferences and resources, negative for richer residents wanting less spending
+# 4.1 resident_chunk: Residents start to stop (one chunk), returns preferences (n, P) and resources (n,)
+def resident_chunk(seed, chunk, size, num_prefs, low=1, high=20, max_resources=1, correlation=0.5):
+    rng = chunk_rng(seed, 'residents', chunk)
+    correlation = np.broadcast_to(np.asarray(correlation, dtype=float), (num_prefs,))
+    if not np.all(np.abs(correlation) <= 1):  # (also catches NaN) sqrt(1 - correlation ** 2) would be NaN
+        raise ValueError('correlation must be between -1 and 1, got %s' % correlation.tolist())
+    wealth = rng.standard_normal(size)
+    noise = rng.standard_normal((size, num_prefs))
+    preferences = to_levels(correlation * wealth[:, None] + np.sqrt(1 - correlation ** 2) * noise, low, high)
+    resources = to_levels(wealth, 0, max_resources)
+    return preferences.astype(level_type(low, high)), resources
+
+# 4.2 make_residents: Every resident, chunk by chunk (into out=(preferences, resources) if given, e.g. shared arrays)
+def make_residents(num_residents, num_prefs, seed, low=1, high=20, max_resources=1, correlation=0.5, out=None,
+                   chunk_size=CHUNK):
+    if out is None:
+        out = (np.empty((num_residents, num_prefs), dtype=level_type(low, high)),
+               np.empty(num_residents, dtype=np.int64))
+    preferences, resources = out
+    for chunk, start, stop in chunks(num_residents, chunk_size):
+        preferences[start:stop], resources[start:stop] = resident_chunk(seed, chunk, stop - start, num_prefs, low, high,
+                                                                        max_resources, correlation)
+    return preferences, resources
+
+
+##### 5. make_spending: Initial city spending (num_cities, P), uniform on [low, high], chunk by chunk
+def make_spending(num_cities, num_prefs, seed, low=1, high=20, chunk_size=CHUNK):
+    spending = np.empty((num_cities, num_prefs), dtype=np.int64)
+    for chunk, start, stop in chunks(num_cities, chunk_size):
+        spending[start:stop] = chunk_rng(seed, 'spending', chunk).integers(low, high + 1, size=(stop - start, num_prefs))
+    return spending
+
+
+##### 6. make_positions: Starting cell (x, y) of every resident, uniform over the grid, chunk by chunk
+def make_positions(num_residents, width, height, seed, chunk_size=CHUNK):
+    positions = np.empty((num_residents, 2), dtype=level_type(0, max(width, height)))
+    for chunk, start, stop in chunks(num_residents, chunk_size):
+        rng = chunk_rng(seed, 'positions', chunk)
+        positions[start:stop, 0] = rng.integers(width, size=stop - start)
+        positions[start:stop, 1] = rng.integers(height, size=stop - start)
+    return positions
+
+
+##### 7. make_scenario, mini_scenario: Constructor arguments for multigridmodel and MiniModel
+# returns every argument but min_gap (and settings such as engine), e.g. multigridmodel(min_gap=5, **make_scenario(...))
+def make_scenario(num_residents, width, height, num_prefs=4, seed=None, low=1, high=20, max_resources=1,
+                  correlation=0.5, chunk_size=CHUNK):
+    seed = np.random.SeedSequence(seed).entropy  # (None draws fresh entropy, kept so every stream shares it)
+    preferences, resources = make_residents(num_residents, num_prefs, seed, low, high, max_resources, correlation,
+                                            chunk_size=chunk_size)
+    return {'residents': num_residents, 'height': height, 'width': width, 'num_cities': width * height,
+            'init_spending_lvls': make_spending(width * height, num_prefs, seed, low, high, chunk_size),
+            'resident_preferences': preferences, 'resident_resources': resources,
+            'resident_positions': make_positions(num_residents, width, height, seed, chunk_size)}
+
+# (MiniModel works on one resident's or city's number at a time, so its arrays are plain int64)
+def mini_scenario(num_residents, width, height, seed=None, low=1, high=20, chunk_size=CHUNK):  # one preference, no resources
+    seed = np.random.SeedSequence(seed).entropy
+    preferences, _ = make_residents(num_residents, 1, seed, low, high, correlation=0, chunk_size=chunk_size)
+    preferences = preferences.astype(np.int64)
+    return {'num_residents': num_residents, 'height': height, 'width': width, 'num_cities': width * height,
+            'init_spending_levels': make_spending(width * height, 1, seed, low, high, chunk_size)[:, 0],
+            'preferences': preferences[:, 0],
+            'resident_positions': make_positions(num_residents, width, height, seed, chunk_size)}
+
+
+##### 8. place_agents: Put many agents on a mesa MultiGrid at once
+# the grid ends up as if grid.place_agent(agent, (x, y)) had been called for every agent in order (agents are new,
+# so not on the grid yet); on the mesa versions whose MultiGrid internals are known, agents are grouped by cell in
+# NumPy and each occupied cell's list is extended once, otherwise (other versions or grids) grid.place_agent is used
+BULK_MESA = ('1.',)  # mesa versions whose MultiGrid keeps cell lists in _grid and empty cells in _empties
+def place_agents(grid, agents, x, y):
+    x, y = np.asarray(x, dtype=np.intp), np.asarray(y, dtype=np.intp)
+    cells = list(zip(x.tolist(), y.tolist()))  # python ints, as positions are elsewhere
+    if not bulk_placement(grid):
+        for agent, cell in zip(agents, cells):
+            grid.place_agent(agent, cell)
+        return
+    flat = x * grid.height + y
+    order = np.argsort(flat, kind='stable')  # agents by cell, in order within each cell
+    occupied, starts = np.unique(flat[order], return_index=True)
+    by_cell = np.empty(len(agents), dtype=object)
+    by_cell[:] = agents
+    by_cell = by_cell[order]
+    for cell, contents in zip(occupied.tolist(), np.split(by_cell, starts[1:])):
+        grid._grid[cell // grid.height][cell % grid.height].extend(contents.tolist())
+    for agent, cell in zip(agents, cells):  # every agent still has to be told its cell
+        agent.pos = cell
+    if grid._empties_built:
+        grid._empties.difference_update(zip((occupied // grid.height).tolist(), (occupied % grid.height).tolist()))
+
+# 8.1 bulk_placement: Whether place_agents can fill the grid's cell lists itself
+def bulk_placement(grid):
+    import mesa  # already imported by whoever made the grid
+    from mesa.space import MultiGrid
+    if type(grid) is not MultiGrid or not mesa.__version__.startswith(BULK_MESA):
+        return False
+    empties_built = getattr(grid, '_empties_built', None)  # (_empties is only made once empties are asked for)
+    return (isinstance(getattr(grid, '_grid', None), list) and isinstance(empties_built, bool)
+            and (not empties_built or isinstance(getattr(grid, '_empties', None), set)))
@@ -5,6 +5,8 @@ from mesa.time import RandomActivation
 from mesa.space import SingleGrid
 from mesa.datacollection import DataCollector
 import random
+import numpy as np
+from Schelling_Engine import SchellingEngine, segregation, EMPTY
 
 # create agents
 class SchellingAgent(Agent):
@@ -31,7 +33,10 @@ class SchellingAgent(Agent):
 # create model
 class SchellingModel(Model):
     # grid height & width, how much of grid is filled w/ agents, what prop minority, what prop need to not move
-    def __init__(self, height, width, density, minority_pc, homophily):
+    # engine: 'agents' steps SchellingAgents through a RandomActivation schedule, 'array' keeps the grid as one array of
+    #   types and steps every agent at once (Schelling_Engine.py), for grids of a million cells
+    # seed: seed for the model's random number generator (picked up by mesa's Model.__new__), agents activate in its order
+    def __init__(self, height, width, density, minority_pc, homophily, engine='agents', seed=None):
         self.height = height
         self.width = width
         self.density = density
@@ -42,6 +47,12 @@ class SchellingModel(Model):
         self.happy = 0  # start at 0 happy, will go through and check if agents happy
         self.datacollector = DataCollector({"happy": lambda m: m.happy})  # pull # of happy agents
         self.running = True  # whether ABM is still running
+        self.engine = None  # array engine, if used
+        if engine == 'array':  # agents live in the engine's grid array, schedule stays empty
+            self.engine = SchellingEngine(self)
+            return
+        if engine != 'agents':
+            raise ValueError("engine must be 'agents' or 'array'")
 
         for cell in self.grid.coord_iter():  # iterate through grid coords
             x = cell[1]
@@ -52,29 +63,40 @@ class SchellingModel(Model):
                 else:
                     agent_type = 0
                 agent = SchellingAgent((x, y), self, agent_type)  # agent w/ given params
-                self.grid.position_agent(agent, (x, y))  # place agent on grid
+                self.grid.place_agent(agent, (x, y))  # place agent on grid
                 self.schedule.add(agent)  # add agent to schedule so it'll move
 
+    def agent_count(self):
+        return self.schedule.get_agent_count() if self.engine is None else self.engine.num_agents
+
     def step(self):  # run model, has agent move and update
         self.happy = 0
-        self.schedule.step()
+        if self.engine is not None:
+            self.engine.step()  # every agent at once
+        self.schedule.step()  # (under the array engine the schedule is empty and this just counts the step)
         self.datacollector.collect(self)  # collect data at each step, from instance of class
-        if self.happy == self.schedule.get_agent_count():  # check if all agents happy
+        if self.happy == self.agent_count():  # check if all agents happy
             self.running = False
 
 
-model = SchellingModel(10, 10, .6, .9, 3)  # height, width, density, minority %, homophily
+# grid of agent types, (width, height) with EMPTY for empty cells
+def grid_types(model):
+    if model.engine is not None:
+        return model.engine.types
+    types = np.full((model.width, model.height), EMPTY, dtype=np.int8)
+    for agent in model.schedule.agents:
+        types[agent.pos] = agent.type
+    return types
 
-while model.running and model.schedule.steps < 10:
-    model.step()
 
-print(model.schedule.steps)
-model_out = model.datacollector.get_model_vars_dataframe()
-model_out.happy.plot()
+# get measure of segregation, prop segregated: agents with no neighbor of the other type, counted for every cell at
+# once by convolution (Schelling_Engine.py)
+def get_segregation(model):
+    return segregation(grid_types(model))
 
 
-# get measure of segregation, prop segregated
-def get_segregation(model):
+# the same, one agent at a time (reference)
+def get_segregation_loop(model):
     segregated_agents = 0
     for agent in model.schedule.agents:
         segregated = True
@@ -87,49 +109,49 @@ def get_segregation(model):
     return segregated_agents / model.schedule.get_agent_count()  # num segregated/total agent count
 
 
-get_segregation(model)
-
-# example test hypo; more density = more iteration?
-data = []
-for density in range(1, 10):
-    density = density / 10
-    model = SchellingModel(10, 10, density, 0.4, 3)
-    while model.running and model.schedule.steps < 100:
-        model.step()
-    iterations = model.schedule.steps
-    data.append([density, iterations])
-
-# messing with proportion minority
-data = []
-for minority in range(1, 50):
-    minority = minority / 100
-    model = SchellingModel(10, 10, 0.6, minority, 3)
-    while model.running and model.schedule.steps < 100:
-        model.step()
-    segregation = get_segregation(model)
-    data.append([minority, segregation])
-
-import pandas as pd
-
-df = pd.DataFrame(data, columns=['minority', 'segregation'])
-import matplotlib.pyplot as plt
+if __name__ == '__main__':  # run the example experiments when run as a script (not when imported)
+    model = SchellingModel(10, 10, .6, .9, 3)  # height, width, density, minority %, homophily
 
-plt.scatter(df.minority, df.segregation)
-plt.grid(True)
-
-# messing with grid shape
-data = []
-for width in range(1, 51):
-    model = SchellingModel(50, width, 0.6, 0.4, 3)
-    while model.running and model.schedule.steps < 100:
+    while model.running and model.schedule.steps < 10:
         model.step()
-    segregation = get_segregation(model)
-    data.append([width, segregation])
-
-import pandas as pd
-
-df = pd.DataFrame(data, columns=['width', 'segregation'])
-import matplotlib.pyplot as plt
 
-plt.scatter(df.width, df.segregation)
-plt.grid(True)
+    print(model.schedule.steps)
+    model_out = model.datacollector.get_model_vars_dataframe()
+    model_out.happy.plot()
+
+
+    get_segregation(model)
+
+    # sweeps run in parallel, one process per core (Batch_Runner.py); each row is one run
+    # on 1000 x 1000 grids with the array engine (Schelling_Engine.py), too big for one agent object per cell
+    # seeded, with results cached on disk (Run_Cache.py): running the script again reads the sweeps back, and an
+    # interrupted sweep only runs the points it hadn't finished
+    from Batch_Runner import run_batch
+    cache = 'output/schelling_runs'  # (output/ is ignored by git)
+
+    # example test hypo; more density = more iteration?
+    df = run_batch('schelling', {'height': 1000, 'width': 1000, 'density': [density / 10 for density in range(1, 10)],
+                                 'minority_pc': 0.4, 'homophily': 3, 'engine': 'array'}, max_steps=100,
+                   seed=1, cache=cache)
+    data = df[['density', 'steps']].values.tolist()  # density, iterations
+
+    # messing with proportion minority
+    df = run_batch('schelling', {'height': 1000, 'width': 1000, 'density': 0.6,
+                                 'minority_pc': [minority / 100 for minority in range(1, 50)], 'homophily': 3,
+                                 'engine': 'array'}, max_steps=100,
+                   seed=1, cache=cache)
+    df = df.rename(columns={'minority_pc': 'minority'})[['minority', 'segregation']]
+    import matplotlib.pyplot as plt
+
+    plt.scatter(df.minority, df.segregation)
+    plt.grid(True)
+
+    # messing with grid shape
+    df = run_batch('schelling', {'height': 1000, 'width': list(range(20, 1001, 20)), 'density': 0.6,
+                                 'minority_pc': 0.4, 'homophily': 3, 'engine': 'array'}, max_steps=100,
+                   seed=1, cache=cache)
+    df = df[['width', 'segregation']]
+    import matplotlib.pyplot as plt
+
+    plt.scatter(df.width, df.segregation)
+    plt.grid(True)
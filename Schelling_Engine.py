@@ -0,0 +1,147 @@
+'''
+Array-backed step engine for the Schelling model
+'''
+################### Table of Contents ######################
+'''
+0. Required packages
+1. neighbor_counts: Flagged cells in every cell's torus Moore neighborhood (a convolution, same neighbors as mesa)
+2. neighbor_types: Same-type and other-type neighbors of every cell
+3. segregation: Share of agents with no neighbor of the other type
+4. EmptyCells Class: Index of empty cells, O(1) to draw, take or give back a cell
+    4.1 relocate: Move a batch of agents, in order, each to a random empty cell
+5. SchellingEngine Class
+    5.1 step: Every agent checks its neighbors, the unhappy ones move to random empty cells
+
+The engine keeps the grid as one (width, height) array of agent types, indexed [x, y] like mesa's grid
+(-1 for an empty cell), and counts every cell's same-type neighbors at once: the Moore neighborhood sum
+is a torus convolution, done as shifted sums along x and then along y. Agents of one type are
+interchangeable, so the grid is the whole state.
+All agents decide from the same grid (happy or not), then the unhappy ones move in random order, each to
+an empty cell drawn uniformly from the cells empty at that moment, including cells that agents who
+moved before it just left (as move_to_empty does). The agent version instead moves each agent before
+the next one looks at its neighbors, so the two take different paths from the same start.
+Empty cells live in an array (plus a cell -> slot map): drawing one is picking a random slot, and the
+cell an agent leaves takes the slot of the one it moves to, so a move is O(1). Many draws land on
+different slots and are done as one array operation; draws that land on the same slot form a chain
+(the second mover gets the cell the first one left, and so on), which is resolved by sorting.
+'''
+#############################################################
+# 0 Required Packages
+import random  # global random, the agent version places agents with it
+import numpy as np
+from Array_Engine import axis_bounds
+
+EMPTY = -1  # type of an empty cell
+
+
+##### 1. neighbor_counts: Flagged cells in every cell's torus Moore neighborhood
+# flags: (width, height) bool or int; on grids narrower than 3 cells the neighborhood shrinks as mesa's does
+def neighbor_counts(flags):
+    width, height = flags.shape
+    flags = flags.astype(np.int16)
+    x_low, x_high = axis_bounds(1, width)
+    y_low, y_high = axis_bounds(1, height)
+    rows = np.zeros_like(flags)
+    for dx in range(int(x_low), int(x_high) + 1):
+        rows += np.roll(flags, -dx, axis=0)  # cell (x, y) picks up cell (x + dx, y)
+    counts = np.zeros_like(flags)
+    for dy in range(int(y_low), int(y_high) + 1):
+        counts += np.roll(rows, -dy, axis=1)
+    return counts - flags  # not the cell itself
+
+
+##### 2. neighbor_types: Same-type and other-type neighbors of every cell (only meaningful for occupied cells)
+def neighbor_types(types):  # types: (width, height), 0 or 1 for agents, EMPTY for empty cells
+    occupied = neighbor_counts(types != EMPTY)
+    zeros = neighbor_counts(types == 0)
+    same = np.where(types == 0, zeros, occupied - zeros)
+    return same, occupied - same
+
+
+##### 3. segregation: Share of agents with no neighbor of the other type
+def segregation(types):
+    agents = types != EMPTY
+    _, other = neighbor_types(types)
+    return np.count_nonzero(agents & (other == 0)) / np.count_nonzero(agents)
+
+
+##### 4. EmptyCells Class: Index of empty cells
+class EmptyCells:
+    def __init__(self, cells, num_cells):  # cells: flat indices (x * height + y) of the empty cells, in slot order
+        self.cells = np.array(cells, dtype=np.intp)  # empty cell in each slot
+        self.slot = np.full(num_cells, -1, dtype=np.intp)  # slot of every empty cell, -1 for occupied cells
+        self.slot[self.cells] = np.arange(len(self.cells))
+
+    def __len__(self):
+        return len(self.cells)
+
+    def sample(self, rng):  # a random empty cell (stays empty)
+        return self.cells[rng.integers(len(self.cells))]
+
+    def take(self, cell):  # the cell is no longer empty: the last slot's cell moves into its slot
+        i, last = self.slot[cell], self.cells[-1]
+        self.cells[i], self.slot[last] = last, i
+        self.cells = self.cells[:-1]
+        self.slot[cell] = -1
+
+    def give(self, cell):  # the cell is empty again
+        self.slot[cell] = len(self.cells)
+        self.cells = np.append(self.cells, cell)
+
+    # 4.1 relocate: Move a batch of agents, in order, each to a random empty cell (from the empties at its turn)
+    # leaving: flat cells the agents leave, in the order they move; returns the cells they move to
+    def relocate(self, leaving, rng):
+        moves = len(leaving)
+        if moves == 0:
+            return np.empty(0, dtype=np.intp)
+        if len(self.cells) == 0:
+            raise ValueError('no empty cells to move to')
+        draws = rng.integers(len(self.cells), size=moves)  # each mover's slot, the number of slots stays the same
+        order = np.argsort(draws, kind='stable')  # movers by slot, in moving order within a slot
+        slots, left = draws[order], np.asarray(leaving, dtype=np.intp)[order]
+        first = np.ones(moves, dtype=bool)  # first mover to draw each slot gets the cell in it
+        first[1:] = slots[1:] != slots[:-1]
+        arrived = np.empty(moves, dtype=np.intp)
+        arrived[first] = self.cells[slots[first]]
+        later = np.flatnonzero(~first)
+        arrived[later] = left[later - 1]  # later movers get the cell the mover before them (same slot) left
+        last = np.ones(moves, dtype=bool)  # the last mover's old cell stays in the slot
+        last[:-1] = first[1:]
+        self.slot[arrived] = -1
+        self.cells[slots[last]] = left[last]
+        self.slot[left[last]] = slots[last]
+        destinations = np.empty(moves, dtype=np.intp)
+        destinations[order] = arrived
+        return destinations
+
+
+##### 5. SchellingEngine Class
+class SchellingEngine:
+    def __init__(self, model):
+        self.model = model
+        self.width = model.width
+        self.height = model.height
+        # place agents exactly as the agent version does (global random, cell by cell in coord_iter order), so the same
+        # seed gives the same starting grid
+        self.types = np.full((self.width, self.height), EMPTY, dtype=np.int8)
+        for x in range(self.width):
+            for y in range(self.height):
+                if random.random() < model.density:
+                    self.types[x, y] = 1 if random.random() < model.minority_pc else 0
+        self.num_agents = int(np.count_nonzero(self.types != EMPTY))
+        self.empties = EmptyCells(np.flatnonzero(self.types.ravel() == EMPTY), self.width * self.height)
+
+    # 5.1 step: Every agent checks its neighbors, the unhappy ones move (in random order) to random empty cells
+    def step(self):
+        # numpy draws for this step come from the model's random number generator, so seeding (and checkpointing) it
+        # is enough to repeat a run
+        rng = np.random.default_rng(self.model.random.getrandbits(64))
+        same, _ = neighbor_types(self.types)
+        unhappy = (self.types != EMPTY) & (same < self.model.homophily)
+        movers = rng.permutation(np.flatnonzero(unhappy))
+        self.model.happy = self.num_agents - len(movers)
+        destinations = self.empties.relocate(movers, rng)
+        cells = self.types.reshape(-1)  # view, moves land in types
+        moving = cells[movers]
+        cells[movers] = EMPTY
+        cells[destinations] = moving
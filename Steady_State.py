@@ -0,0 +1,64 @@
+'''
+State fingerprints and fixed point / cycle detection, for stopping runs early
+'''
+################### Table of Contents ######################
+'''
+0. Required packages
+1. mix64: Scramble 64-bit integers (splitmix64 finalizer)
+2. position_hash: Hash of where every resident is, XOR of one key per (resident, cell)
+3. spending_digest: Hash of every city's spending
+4. StateHistory Class: Recent fingerprints, finds a repeat of one of the last max_period states
+
+A model's state after a step is where its residents are plus what its cities spend. Because the
+position hash is an XOR of per-resident keys, a move only has to XOR out the old key and XOR in the
+new one (position_key), so agent models keep it up to date as residents move; array engines hash
+their position arrays in one go. Spending is hashed once per step.
+A state equal to the one a step before is a fixed point: nobody moved (a move always changes
+position), so no random draws were made and every later step gives the same state again.
+A state equal to one 2..max_period steps before is a cycle. If residents broke ties at random
+along the way, the cycle may not repeat exactly, but the run has stopped going anywhere new.
+'''
+#############################################################
+# 0 Required Packages
+import hashlib
+from collections import deque
+import numpy as np
+
+
+##### 1. mix64: Scramble 64-bit integers (splitmix64 finalizer)
+def mix64(values):  # uint64 array in, uint64 array out (arithmetic wraps around, as it should)
+    z = np.asarray(values, dtype=np.uint64) + np.uint64(0x9E3779B97F4A7C15)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
+
+##### 2. position_hash: Hash of where every resident is
+def position_hash(ids, cells):  # resident ids and flat cell indices (x * height + y), as arrays
+    if len(ids) == 0:
+        return 0
+    keys = mix64(mix64(ids) ^ np.asarray(cells, dtype=np.uint64))  # one key per (resident, cell)
+    return int(np.bitwise_xor.reduce(keys))
+
+def position_key(id, cell):  # key of one resident in one cell, XOR it in or out of a position hash as residents move
+    return position_hash(np.array([id]), np.array([cell]))
+
+
+##### 3. spending_digest: Hash of every city's spending
+def spending_digest(spending):
+    return hashlib.blake2b(np.ascontiguousarray(spending, dtype=float).tobytes(), digest_size=8).hexdigest()
+
+
+##### 4. StateHistory Class: Recent fingerprints, finds a repeat of one of the last max_period states
+class StateHistory:
+    def __init__(self, max_period=2):  # max_period: longest cycle to look for (1 for fixed points only)
+        self.recent = deque(maxlen=max_period)
+
+    def add(self, fingerprint):  # returns the period if this state was seen in the last max_period steps, else None
+        period = None
+        for lag, seen in enumerate(reversed(self.recent), start=1):
+            if seen == fingerprint:
+                period = lag
+                break
+        self.recent.append(fingerprint)
+        return period
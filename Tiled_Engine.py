@@ -0,0 +1,297 @@
+'''
+Tiled step engine for the multigrid ABM: the grid split into strips, each stepped by its own worker process
+'''
+################### Table of Contents ######################
+'''
+0. Required packages
+1. tile_bounds: Split the grid's x axis into one strip per worker
+    1.1 resolve_tiles: Number of strips a model gets (a fixed default, not the number of cores)
+2. halo_rows: Grid rows of a strip plus its halo rows (wrapping round the torus)
+3. TileWorker Class: One strip's residents, stepped in a worker process
+    3.1 resident_step: Residents compare cities over their strip plus halo, and (maybe) move
+    3.2 hand_off: Pass residents that moved off the strip to the neighboring strips
+    3.3 city_step: Cities in the strip set spending from the cell sums of the strip plus one halo row
+4. run_worker: Worker process loop, steps its strip on request
+5. TiledEngine Class
+        start_workers: Shared memory blocks and one worker process per strip
+    5.1 step: Step every strip in parallel and add up the results
+    5.2 gather: Collect every resident's position from the workers
+        position_hash: Hash of resident positions, XOR of the strips' hashes
+    5.3 close: Stop the workers and free shared memory
+
+For one very large run. Each worker owns a strip of whole grid rows (x from start to stop) and the
+residents in it. City spending and the per-cell sums live in shared memory; a worker reads its strip
+plus halo rows on each side (as wide as the largest search radius, at least 1) and only writes its own rows.
+A step is:
+    residents decide and move, reading spending from the strip and its halo (nobody writes spending now)
+    residents that moved off the strip are handed to the neighboring strip (moves are one cell at most)
+    each worker writes its cells' sums, then waits for every other worker (barrier)
+    each worker sets its cities' spending from the sums of its strip plus one halo row on each side
+The parent waits for every worker before the next step, so the next step reads finished spending.
+The same kernels as the array engine do the work (Array_Engine.py), on a strip padded with halo rows.
+Every strip must be at least 2 * halo + 1 rows wide, so no window reaches past the halo or wraps onto itself.
+Ties between candidate cities are broken with each worker's own NumPy generator (seeded from the
+model's random), so a run follows the same rules as the other engines but not the same random draws,
+and depends on the number of tiles. That is why tiles=None means a fixed DEFAULT_TILES (fewer on grids
+too narrow for them), not one per core: the same arguments give the same run on any machine.
+'''
+#############################################################
+# 0 Required Packages
+import functools
+import multiprocessing as mp
+import operator
+import time
+import weakref
+from multiprocessing import shared_memory
+import numpy as np
+from Steady_State import position_hash
+from Array_Engine import (ArrayEngine, window_offsets, scan_windows, move_residents, cell_sums, neighborhood_means,
+                          resident_work)
+
+DEFAULT_TILES = 4  # strips when none are given (the same on every machine, since the run depends on it)
+
+
+##### 1. tile_bounds: Split the grid's x axis into one strip per worker
+def tile_bounds(width, tiles, halo):  # start and stop (exclusive) x of each strip
+    edges = np.linspace(0, width, tiles + 1).astype(int)
+    if np.diff(edges).min() < 2 * halo + 1:
+        raise ValueError('grid is too narrow for %d tiles: each needs at least %d rows' % (tiles, 2 * halo + 1))
+    return list(zip(edges[:-1], edges[1:]))
+
+# 1.1 resolve_tiles: Number of strips for tiles (None for DEFAULT_TILES, as many as fit on narrow grids)
+# resources: every resident's resources, whose largest sets the halo
+def resolve_tiles(tiles, width, resources):
+    if tiles is not None:
+        return tiles
+    halo = max(1, int(np.max(resources, initial=0)))
+    return max(1, min(DEFAULT_TILES, width // (2 * halo + 1)))
+
+##### 2. halo_rows: Grid rows of a strip plus its halo rows (wrapping round the torus)
+def halo_rows(start, stop, halo, width):
+    return np.arange(start - halo, stop + halo) % width
+
+
+##### 3. TileWorker Class: One strip's residents, stepped in a worker process
+class TileWorker:
+    # residents: dict of the strip's resident ids, x, y, preferences and resources
+    # specs: shared memory names of spending and the cell sums, gap_bins: (bin width, bins) of the summary's gap histogram
+    # hash_positions: hash the strip's resident positions after every step (for the model's steady-state check)
+    def __init__(self, index, bounds, width, height, halo, residents, specs, inboxes, barrier, seed, gap_bins=None,
+                 hash_positions=False):
+        self.index = index
+        self.start, self.stop = bounds[index]
+        self.tiles = len(bounds)
+        self.width = width
+        self.height = height
+        self.halo = halo
+        self.residents = residents
+        self.inboxes = inboxes  # one queue per worker, for residents handed off to it
+        self.barrier = barrier
+        self.rng = np.random.default_rng(seed)
+        self.gap_bins = gap_bins
+        self.hash_positions = hash_positions
+        self.blocks = {name: shared_memory.SharedMemory(name=block_name) for name, (block_name, _, _) in specs.items()}
+        self.shared = {name: np.ndarray(shape, dtype=dtype, buffer=self.blocks[name].buf)
+                       for name, (_, shape, dtype) in specs.items()}
+
+    # returns this strip's gap, gap histogram, movers, occupied cities, phase times, counts and position hash
+    def step(self, profile=False):
+        start = time.perf_counter()
+        gap, gap_counts, movers, counts = self.resident_step(profile)
+        self.hand_off()
+        middle = time.perf_counter()
+        occupied = self.city_step()
+        if profile:  # every city sums over its Moore neighborhood
+            counts['neighbor_visits'] = (counts.get('neighbor_visits', 0) + len(window_offsets(1, self.width, self.height))
+                                         * (self.stop - self.start) * self.height)
+        positions = None
+        if self.hash_positions:  # XOR of the strips' hashes is the hash of every position
+            positions = position_hash(self.residents['id'], self.residents['x'] * self.height + self.residents['y'])
+        return gap, gap_counts, movers, occupied, (middle - start, time.perf_counter() - middle), counts, positions
+
+    # 3.1 resident_step: Residents compare cities over their strip plus halo, and (maybe) move
+    def resident_step(self, profile=False):
+        residents = self.residents
+        counts = {}
+        if len(residents['x']) == 0:
+            return 0.0, None if self.gap_bins is None else np.zeros(self.gap_bins[1], dtype=np.int64), 0, counts
+        rows = halo_rows(self.start, self.stop, self.halo, self.width)
+        spending = self.shared['spending'][rows]  # read the strip and its halo (a copy)
+        x = (residents['x'] - self.start + self.halo)[None]  # position in the padded strip, never wraps
+        y = residents['y'][None]
+        preferences, resources = residents['preferences'], residents['resources']
+        min_gap, current_gap, near, near_gaps = scan_windows(spending[None], x, y, preferences[None], resources[None])
+        is_candidate = near_gaps == min_gap
+        num_candidates = is_candidate.sum(axis=0)
+        movers = np.nonzero((min_gap < current_gap) & (num_candidates > 0))
+        picks = (self.rng.random(len(movers[0])) * num_candidates[movers]).astype(np.intp)  # one of the candidates at random
+        move_residents(x, y, near, is_candidate, movers, picks, len(rows), self.height)
+        residents['x'] = (x[0] - self.halo + self.start) % self.width  # back to grid positions
+        residents['y'] = y[0]
+        gap_counts = None
+        if self.gap_bins is not None:  # histogram of gaps for the summary collector
+            bin_width, bins = self.gap_bins
+            gap_counts = np.bincount(np.minimum((current_gap[0] / bin_width).astype(np.intp), bins - 1), minlength=bins)
+        if profile:
+            counts = resident_work(resources, num_candidates[0], self.width, self.height)
+        return float(current_gap.sum()), gap_counts, len(picks), counts
+
+    # 3.2 hand_off: Pass residents that moved off the strip to the neighboring strips
+    def hand_off(self):
+        if self.tiles == 1:
+            return
+        residents = self.residents
+        x = residents['x']
+        left = x == (self.start - 1) % self.width  # moved off the low edge
+        right = x == self.stop % self.width  # moved off the high edge
+        # always send both messages (maybe empty) so every worker knows how many to wait for
+        self.inboxes[(self.index - 1) % self.tiles].put(('right', {name: values[left] for name, values in residents.items()}))
+        self.inboxes[(self.index + 1) % self.tiles].put(('left', {name: values[right] for name, values in residents.items()}))
+        stay = ~(left | right)
+        arrivals = dict([self.inboxes[self.index].get(), self.inboxes[self.index].get()])  # from the left and right strips
+        # residents that stayed, then arrivals from the left, then from the right (the same order whichever arrives first)
+        self.residents = {name: np.concatenate([values[stay], arrivals['left'][name], arrivals['right'][name]])
+                          for name, values in residents.items()}
+
+    # 3.3 city_step: Cities in the strip set spending from the cell sums of the strip plus one halo row
+    def city_step(self):
+        residents = self.residents
+        own = slice(self.start, self.stop)
+        shape = (1, self.stop - self.start, self.height, self.shared['spending'].shape[-1])
+        sums = cell_sums(shape, (residents['x'] - self.start)[None], residents['y'][None],
+                         residents['preferences'][None], residents['resources'][None])
+        for name, values in zip(('counts', 'weights', 'pref_sums', 'weighted_sums'), sums):
+            self.shared[name][own] = values[0]  # write this strip's sums
+        self.barrier.wait()  # every strip's sums are written (and every strip has finished reading spending)
+        rows = halo_rows(self.start, self.stop, 1, self.width)
+        spending = neighborhood_means(self.shared['spending'][rows][None],
+                                      *(self.shared[name][rows][None] for name in ('counts', 'weights', 'pref_sums',
+                                                                                   'weighted_sums')))
+        self.shared['spending'][own] = spending[0, 1:-1]  # halo rows are other strips' cities
+        return int(np.count_nonzero(sums[0]))
+
+    def close(self):
+        for block in self.blocks.values():
+            block.close()
+
+
+##### 4. run_worker: Worker process loop, steps its strip on request
+def run_worker(conn, *args):
+    worker = TileWorker(*args)
+    while True:
+        command = conn.recv()
+        if command == 'step':
+            conn.send(worker.step())
+        elif command == 'profile':  # step and count work for the profiler
+            conn.send(worker.step(profile=True))
+        elif command == 'gather':
+            conn.send({name: worker.residents[name] for name in ('id', 'x', 'y')})
+        else:  # 'close'
+            worker.close()
+            conn.close()
+            return
+
+
+def shutdown(conns, processes, blocks):  # stop workers and free shared memory (also run when the engine is collected)
+    for conn in conns:
+        try:
+            conn.send('close')
+        except (BrokenPipeError, OSError):
+            pass
+    for process in processes:
+        process.join()
+    for block in blocks:
+        block.close()
+        block.unlink()
+
+
+##### 5. TiledEngine Class
+class TiledEngine(ArrayEngine):
+    # tiles: number of strips (and worker processes), None for DEFAULT_TILES (see resolve_tiles)
+    def __init__(self, model, tiles=None):
+        super().__init__(model)  # spending, resident arrays and placement as in the array engine
+        tiles = resolve_tiles(tiles, self.width, self.resources)
+        halo = max(1, int(self.resources.max(initial=0)))  # widest search radius, at least the Moore neighborhood
+        self.bounds = tile_bounds(self.width, tiles, halo)
+        # shared memory and workers go in these lists as they're made, and the finalizer is registered before any
+        # of them, so whatever was made is freed if making the rest fails
+        self.blocks, self.conns, self.processes = [], [], []
+        self.finalizer = weakref.finalize(self, shutdown, self.conns, self.processes, self.blocks)
+        try:
+            self.start_workers(model, tiles, halo)
+        except BaseException:
+            self.finalizer()
+            raise
+        self.positions = None  # hash of resident positions after the last step
+
+    def start_workers(self, model, tiles, halo):
+        # spending and cell sums in shared memory, written by the workers (spending becomes a view of it)
+        shapes = {'spending': (self.spending.shape, np.float64), 'counts': ((self.width, self.height), np.int64),
+                  'weights': ((self.width, self.height), np.float64),
+                  'pref_sums': (self.spending.shape, np.float64), 'weighted_sums': (self.spending.shape, np.float64)}
+        specs, self.shared = {}, {}
+        for name, (shape, dtype) in shapes.items():
+            block = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize))
+            self.blocks.append(block)
+            self.shared[name] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+            specs[name] = (block.name, shape, np.dtype(dtype).str)
+        self.shared['spending'][...] = self.spending
+        self.spending = self.shared['spending']
+        gap_bins = None if model.summary is None else (model.summary.bin_width, model.summary.bins)
+        seeds = np.random.SeedSequence(model.random.getrandbits(64)).spawn(tiles)
+        inboxes = [mp.Queue() for _ in range(tiles)]
+        barrier = mp.Barrier(tiles)
+        ids = np.arange(len(self.x))
+        for i, (start, stop) in enumerate(self.bounds):
+            mine = (self.x >= start) & (self.x < stop)  # residents that start in this strip
+            residents = {'id': ids[mine], 'x': self.x[mine], 'y': self.y[mine], 'preferences': self.preferences[mine],
+                         'resources': self.resources[mine]}
+            parent_conn, child_conn = mp.Pipe()
+            process = mp.Process(target=run_worker, args=(child_conn, i, self.bounds, self.width, self.height, halo,
+                                                          residents, specs, inboxes, barrier, seeds[i], gap_bins,
+                                                          model.history is not None),
+                                 daemon=True)
+            process.start()
+            child_conn.close()
+            self.conns.append(parent_conn)
+            self.processes.append(process)
+
+    # 5.1 step: Step every strip in parallel and add up the results
+    def step(self):
+        profiler = self.model.profiler
+        for conn in self.conns:
+            conn.send('step' if profiler is None else 'profile')
+        results = [conn.recv() for conn in self.conns]  # waits for every strip, in strip order
+        gaps, gap_counts, movers, occupied, times, counts, positions = zip(*results)
+        if positions[0] is not None:
+            self.positions = functools.reduce(operator.xor, positions)
+        self.model.gap += sum(gaps)
+        self.model.movers += sum(movers)
+        self.occupied = sum(occupied)
+        if self.model.summary is not None:
+            for strip_counts in gap_counts:
+                self.model.summary.add_gap_counts(strip_counts)
+            self.model.summary.add_spending_block(self.spending.reshape(self.width * self.height, self.num_prefs))
+        if profiler is not None:  # the slowest strip sets the time of each phase
+            profiler.add_time('residents', max(resident_time for resident_time, _ in times))
+            profiler.add_time('cities', max(city_time for _, city_time in times))
+            for strip_counts in counts:
+                for counter, n in strip_counts.items():
+                    profiler.count(counter, n)
+
+    # 5.2 gather: Collect every resident's position from the workers (into x and y, in resident order)
+    def gather(self):
+        for conn in self.conns:
+            conn.send('gather')
+        for residents in [conn.recv() for conn in self.conns]:
+            self.x[residents['id']] = residents['x']
+            self.y[residents['id']] = residents['y']
+        return self.x, self.y
+
+    def position_hash(self):  # the workers hash their residents after each step, before that x and y are current
+        return super().position_hash() if self.positions is None else self.positions
+
+    # 5.3 close: Stop the workers and free shared memory
+    def close(self):
+        self.spending = np.array(self.spending)  # keep the last spending once shared memory is gone
+        self.finalizer()
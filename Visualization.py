@@ -1,26 +1,18 @@
 import mesa
-import numpy as np
+import Agents as ag
 from Multigrid_Tiebout_ABM import multigridmodel
+from Raster_Visualization import RasterGrid, DecimatedChart
+from Scenarios import make_scenario
+from Models import load_model_class
 
-# set model parameters
-if __name__ == '__main__':
-    num_res = 5  # desired number of residents
-    height = 5  # height of grid
-    width = 5  # width of grid
-    num_cities = height*width  # desired number of cities
-    preferences = np.random.randint(1,21, size=[num_res,4])  # resident preference array
-    resources = np.random.randint(0,2, size=num_res) # resident resources array
-    init_spending_lvls = np.random.randint(1,21, size=[num_cities,4])  # city spending levels array
-    min_gap = 5  # minimum total gap between spending and preferences that will make the model stop
-
-#set agent portrayal rules
+#set agent portrayal rules (CanvasGrid, for small grids: it sends every agent every frame)
 def agent_portrayal(agent):
     portrayal = {
         "Shape": "circle",
         "Filled": "true",
         "r": 0.5}
-    # use id # to color cities and residents differently
-    if agent.unique_id > num_res-1:  #city portrayal
+    # color cities and residents differently
+    if isinstance(agent, ag.City):  #city portrayal
         portrayal["Color"] = "navy"
         portrayal["Layer"] = 0
     else: #resident portrayal
@@ -29,15 +21,60 @@ def agent_portrayal(agent):
         portrayal["r"] = 0.2
     return portrayal
 
-grid = mesa.visualization.CanvasGrid(agent_portrayal, height, width, 500, 500)
-chart = mesa.visualization.ChartModule([{"Label": "gap",
-                      "Color": "Black"}],
-                    data_collector_name='datacollector')
-server = mesa.visualization.ModularServer(
-    multigridmodel, [grid, chart], "Multigrid Model", {'residents':num_res, 'height':height, 'width':width,
-                                                'num_cities':num_cities, 'init_spending_lvls':init_spending_lvls,
-                                                'resident_preferences':preferences, 'resident_resources':resources,
-                                                'min_gap':min_gap}
-)
-server.port = 8521 #default
-server.launch()
\ No newline at end of file
+#mini model agents, cities (they have a spending level) under residents
+def mini_portrayal(agent):
+    portrayal = agent_portrayal(agent)
+    if hasattr(agent, 'spending_level'):  # city portrayal (isinstance would need the mini model's module)
+        portrayal.update({"Color": "navy", "Layer": 0, "r": 0.5})
+    return portrayal
+
+#Schelling agents, one square each, colored by type
+def schelling_portrayal(agent):
+    return {"Shape": "rect", "Filled": "true", "w": 1, "h": 1, "Layer": 0,
+            "Color": "crimson" if agent.type == 1 else "steelblue"}
+
+# servers, by model name (model_params: constructor arguments, e.g. from Scenarios.make_scenario)
+def multigrid_server(model_params):
+    # spending heatmap for every preference plus resident density, sent as a raster (only changed cells when few change)
+    # (for a small grid, mesa.visualization.CanvasGrid(agent_portrayal, height, width, 500, 500) draws every agent)
+    grid = RasterGrid()
+    chart = DecimatedChart([{"Label": "gap",
+                          "Color": "Black"}],
+                        data_collector_name='datacollector')
+    return mesa.visualization.ModularServer(multigridmodel, [grid, chart], "Multigrid Model", model_params)
+
+def mini_server(model_params):  # draws every agent, so small grids only
+    grid = mesa.visualization.CanvasGrid(mini_portrayal, model_params['width'], model_params['height'], 500, 500)
+    chart = DecimatedChart([{"Label": "gap",
+                          "Color": "Black"}],
+                        data_collector_name='datacollector')
+    return mesa.visualization.ModularServer(load_model_class('mini'), [grid, chart], "Mini Model", model_params)
+
+def schelling_server(model_params):  # draws every agent, so agents engine (and small grids) only
+    if model_params.get('engine', 'agents') != 'agents':
+        raise ValueError("the Schelling server draws agent objects, use engine='agents'")
+    grid = mesa.visualization.CanvasGrid(schelling_portrayal, model_params['width'], model_params['height'], 500, 500)
+    chart = DecimatedChart([{"Label": "happy",
+                          "Color": "Black"}],
+                        data_collector_name='datacollector')
+    return mesa.visualization.ModularServer(load_model_class('schelling'), [grid, chart], "Schelling Model",
+                                            model_params)
+
+SERVERS = {'multigrid': multigrid_server, 'mini': mini_server, 'schelling': schelling_server}
+
+# start a server and serve until interrupted
+def launch(model, model_params, port=8521):  #8521 is mesa's default
+    server = SERVERS[model](model_params)
+    server.port = port
+    server.launch()
+
+# set model parameters
+if __name__ == '__main__':
+    num_res = 20000  # desired number of residents
+    height = 200  # height of grid
+    width = 200  # width of grid
+    # resident preferences and resources (correlated), city spending levels and starting cells, from one seed
+    scenario = make_scenario(num_res, width, height, num_prefs=4, seed=123)
+    min_gap = 5  # minimum total gap between spending and preferences that will make the model stop
+
+    launch('multigrid', dict(scenario, min_gap=min_gap))
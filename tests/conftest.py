@@ -0,0 +1,8 @@
+'''
+Tests: shared setup
+'''
+import os
+import sys
+
+# the models are flat modules in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
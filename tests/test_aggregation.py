@@ -0,0 +1,31 @@
+'''
+Tests: every aggregation kernel's batched neighborhood table matches the per-agent reference
+'''
+import random
+import numpy as np
+import pytest
+import Agents as ag
+from Aggregation import AGGREGATORS
+from Multigrid_Tiebout_ABM import multigridmodel
+
+
+@pytest.mark.parametrize('aggregation', sorted(AGGREGATORS))
+@pytest.mark.parametrize('seed', range(2))
+def test_table_matches_per_city(aggregation, seed):
+    rng = np.random.default_rng(seed)
+    random.seed(seed)
+    model = multigridmodel(300, 10, 10, 100, rng.integers(1, 21, (100, 3)), rng.integers(1, 21, (300, 3)),
+                           rng.integers(0, 3, 300), -1, aggregation=aggregation, seed=seed)
+    for _ in range(2):  # residents have moved
+        model.step()
+    table, counts = model.get_neighborhood_aggregates(aggregation)
+    for city in model.cities:
+        cell = city.pos[0] * model.height + city.pos[1]
+        neighborhood = model.grid.get_neighborhood(city.pos, moore=True, include_center=True)
+        residents = [a for a in model.grid.iter_cell_list_contents(neighborhood) if isinstance(a, ag.Resident)]
+        assert counts[cell] == len(residents)
+        if residents:
+            reference = ag.aggregate_prefs(aggregation, [r.preferences for r in residents], 3,
+                                           [r.resources for r in residents])
+            assert np.allclose(table[cell], reference)
+    model.close()
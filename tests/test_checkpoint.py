@@ -0,0 +1,93 @@
+'''
+Tests: a model saved and restored from a checkpoint steps on exactly as the original
+'''
+import random
+import numpy as np
+import pytest
+from Models import load_model_class
+from Checkpoint import save_checkpoint, load_checkpoint
+
+
+def equal(a, b):
+    a, b = np.asarray(a), np.asarray(b)
+    try:
+        return np.array_equal(a, b, equal_nan=True)
+    except TypeError:  # not numbers
+        return np.array_equal(a, b)
+
+
+# save after some steps, step on, then restore and step on again: both runs must end the same
+def round_trip(make, state, path, before=4, after=6):
+    random.seed(11)
+    model = make()
+    for _ in range(before):
+        model.step()
+    save_checkpoint(model, path)
+    for _ in range(after):
+        if model.running:
+            model.step()
+    restored = load_checkpoint(path)
+    for _ in range(after):
+        if restored.running:
+            restored.step()
+    original, copy = state(model), state(restored)
+    same_random = model.random.getstate() == restored.random.getstate()
+    for m in (model, restored):
+        if hasattr(m, 'close'):
+            m.close()
+    assert len(original) == len(copy)
+    assert all(equal(a, b) for a, b in zip(original, copy))
+    assert same_random
+
+
+def multigrid_state(model):
+    state = [model.recorder.gap, model.recorder.spending, model.datacollector.model_vars['gap'],
+             [model.schedule.steps, model.running, str(model.stop_reason)], model.cell_prefs]
+    if model.summary is not None:
+        state += [model.summary.values('gap_quantiles'), model.summary.values('spending_var')]
+    if model.engine is None:
+        state.append([r.pos for r in model.residents])
+    else:
+        state += [model.engine.x, model.engine.y]
+    return state
+
+
+def multigrid(**options):
+    rng = np.random.default_rng(0)
+    return lambda: load_model_class('multigrid')(
+        residents=200, height=10, width=8, num_cities=80, init_spending_lvls=rng.integers(1, 21, (80, 3)),
+        resident_preferences=rng.integers(1, 21, (200, 3)), resident_resources=rng.integers(0, 3, 200),
+        min_gap=0, seed=4, **options)
+
+
+@pytest.mark.parametrize('options', [
+    {}, {'activation': 'simultaneous'}, {'search': 'index'}, {'aggregation': 'median'},
+    {'engine': 'array', 'collect': ('full', 'summary')},
+    {'active_set': True, 'max_period': 3, 'collect': ('full', 'summary'), 'profile': True}])
+def test_multigrid(tmp_path, options):
+    round_trip(multigrid(**options), multigrid_state, str(tmp_path / 'checkpoint.npz'))
+
+
+def test_multigrid_recorded_on_disk(tmp_path):  # recordings on disk are truncated back to the saved step
+    make = multigrid(record_path=str(tmp_path / 'recordings'))
+    round_trip(make, multigrid_state, str(tmp_path / 'checkpoint.npz'))
+
+
+def test_mini(tmp_path):
+    rng = np.random.default_rng(1)
+    make = lambda: load_model_class('mini')(150, 8, 8, 64, rng.integers(1, 21, 64), rng.integers(1, 21, 150), 0,
+                                            collect=('full', 'summary'), seed=3)
+    state = lambda m: [m.recorder.gap, m.recorder.spending, m.datacollector.model_vars['gap'],
+                       [r.pos for r in m.residents], m.summary.values('gap')]
+    round_trip(make, state, str(tmp_path / 'checkpoint.npz'))
+
+
+@pytest.mark.parametrize('engine', ['agents', 'array'])
+def test_schelling(tmp_path, engine):
+    make = lambda: load_model_class('schelling')(10, 10, .7, .4, 3, engine=engine, seed=5)
+    def state(m):
+        if m.engine is not None:
+            return [m.datacollector.model_vars['happy'], m.engine.types, [m.schedule.steps, m.running]]
+        return [m.datacollector.model_vars['happy'], [list(a.pos) + [a.type] for a in m.schedule.agents],
+                [m.schedule.steps, m.running]]
+    round_trip(make, state, str(tmp_path / 'checkpoint.npz'), 2, 5)
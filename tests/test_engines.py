@@ -0,0 +1,60 @@
+'''
+Tests: the multigrid engines and step options give the same run
+'''
+import random
+import numpy as np
+import pytest
+from Multigrid_Tiebout_ABM import multigridmodel
+
+# residents, height, width, preferences, max resources
+CONFIGS = [(30, 5, 5, 4, 1), (300, 10, 10, 4, 2), (50, 4, 6, 3, 3), (100, 7, 4, 10, 2), (40, 3, 3, 4, 0)]
+
+
+# a small seeded model, same inputs for every engine and option
+def make_model(config, seed, **options):
+    residents, height, width, num_prefs, max_resources = config
+    rng = np.random.RandomState(seed)
+    preferences = rng.randint(1, 21, size=[residents, num_prefs])
+    resources = rng.randint(0, max_resources + 1, size=residents)
+    spending = rng.randint(1, 21, size=[height * width, num_prefs])
+    random.seed(seed)  # residents are placed with the global random
+    return multigridmodel(residents, height, width, height * width, spending, preferences, resources, -1, seed=seed, **options)
+
+
+# spending, gaps and resident positions after some steps
+def run(model, steps=8):
+    gaps = []
+    for _ in range(steps):
+        model.step()
+        gaps.append(model.gap)
+    model.close()
+    return np.asarray(model.recorder.spending), np.asarray(gaps), np.asarray(model.resident_cells())
+
+
+@pytest.mark.parametrize('config', CONFIGS)
+@pytest.mark.parametrize('seed', range(3))
+def test_array_matches_agents(config, seed):
+    spending, gaps, cells = run(make_model(config, seed))
+    array_spending, array_gaps, array_cells = run(make_model(config, seed, engine='array'))
+    assert np.array_equal(spending, array_spending)
+    assert np.array_equal(gaps, array_gaps)
+    assert np.array_equal(cells, array_cells)
+
+
+@pytest.mark.parametrize('options', [{'search': 'index'}, {'activation': 'simultaneous'}])
+@pytest.mark.parametrize('config', CONFIGS[:3])
+def test_options_match_default(config, options):
+    spending, gaps, cells = run(make_model(config, 1))
+    other_spending, other_gaps, other_cells = run(make_model(config, 1, **options))
+    assert np.array_equal(spending, other_spending)
+    assert np.array_equal(gaps, other_gaps)
+    assert np.array_equal(cells, other_cells)
+
+
+@pytest.mark.parametrize('config', CONFIGS[:3])
+def test_active_set_matches_full_step(config):
+    spending, gaps, cells = run(make_model(config, 2))
+    active_spending, active_gaps, active_cells = run(make_model(config, 2, active_set=True))
+    assert np.array_equal(spending, active_spending)
+    assert np.array_equal(cells, active_cells)
+    assert np.allclose(gaps, active_gaps)  # the active set keeps the gap as a running total
@@ -0,0 +1,30 @@
+'''
+Tests: the Schelling array engine starts from the agents' grid, and segregation matches the per-agent count
+'''
+import random
+import pytest
+from Models import load_model_class, load_model_module
+from Schelling_Engine import segregation
+
+schelling = load_model_module('schelling')
+
+
+def make(engine, seed):
+    random.seed(seed)  # both engines place agents with the global random
+    return load_model_class('schelling')(12, 10, .7, .3, 3, engine=engine, seed=seed)
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_array_matches_agents(seed):
+    agents, array = make('agents', seed), make('array', seed)
+    assert (schelling.grid_types(agents) == schelling.grid_types(array)).all()
+    assert segregation(array.engine.types) == pytest.approx(schelling.get_segregation_loop(agents))
+    assert schelling.get_segregation(array) == pytest.approx(schelling.get_segregation(agents))
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_segregation_matches_loop(seed):  # the convolution against the one-agent-at-a-time reference, as agents move
+    model = make('agents', seed)
+    for _ in range(5):
+        assert schelling.get_segregation(model) == pytest.approx(schelling.get_segregation_loop(model))
+        model.step()